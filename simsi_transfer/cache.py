@@ -0,0 +1,279 @@
+import os
+import time
+import uuid
+import socket
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# number of bytes read from the start, middle and end of a file for its fingerprint
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+MZML = 'mzML'
+
+# seconds after which the lease of a run on another host is considered stale, e.g. because the run was killed
+LEASE_TIMEOUT = 7 * 24 * 3600.0
+
+
+def fingerprint_file(path: Path, sample_size: int = FINGERPRINT_SAMPLE_SIZE) -> str:
+    """
+    Computes a fast content fingerprint of a (large) file by hashing its size and three sampled blocks, such that
+    renamed or moved files keep their fingerprint and changed files get a new one without reading the whole file.
+    :param path: file to fingerprint
+    :param sample_size: number of bytes to read at the start, middle and end of the file
+    :return: hexadecimal fingerprint
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, 'little'))
+    with open(path, 'rb') as f:
+        if size <= 3 * sample_size:
+            digest.update(f.read())
+        else:
+            for offset in [0, size // 2 - sample_size // 2, size - sample_size]:
+                f.seek(offset)
+                digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def hash_file(path: Path, chunk_size: int = FINGERPRINT_SAMPLE_SIZE) -> str:
+    """
+    Computes the content hash of the whole file, unlike fingerprint_file every byte of the file changes the hash.
+    :param path: file to hash
+    :param chunk_size: number of bytes to read at a time
+    :return: hexadecimal hash
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Stores artifacts such as converted mzML files by the fingerprint of the file they were created from, e.g.
+    <cache_folder>/store/mzML/ab/ab12...ef.mzML. Projects get hardlinks (or symlinks or copies if hardlinks are not
+    possible) of the stored files, such that shared, renamed or moved raw files are converted only once and changed
+    raw files are never matched with a stale artifact.
+
+    Every run lists the files it uses in a lease file in <cache_folder>/leases, such that the eviction of another
+    run that shares the store never removes them. A lease ends with release(), with the end of its process if it was
+    written on the same POSIX host, or after LEASE_TIMEOUT seconds without new entries otherwise.
+    """
+
+    def __init__(self, cache_folder: Path, derived_files: Optional[Callable[[Path], List[Path]]] = None):
+        """
+        :param cache_folder: folder that contains the store
+        :param derived_files: returns the cached files created from a project file, e.g. dat files and extracted
+                              reporter ions of an mzML file, which are removed together with a replaced project file
+        """
+        self.cache_folder = cache_folder
+        self.derived_files = derived_files
+        self.store_folder = cache_folder / Path('store')
+        self.start_time = time.time()
+        # project files that were replaced because their raw file changed since they were created
+        self.changed_files: List[Path] = []
+        self.lease_folder = cache_folder / Path('leases')
+        self.lease_file = self.lease_folder / Path(f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}.lease')
+        self.leased_paths = set()
+
+    def get_store_path(self, kind: str, fingerprint: str, suffix: str) -> Path:
+        return self.store_folder / Path(kind) / Path(fingerprint[:2]) / Path(f'{fingerprint}{suffix}')
+
+    def link(self, kind: str, fingerprint: str, target_path: Path) -> bool:
+        """
+        Places the stored artifact at target_path, replacing a different file at that path
+        :return: True if the artifact was found in the store
+        """
+        store_path = self.get_store_path(kind, fingerprint, target_path.suffix)
+        if not store_path.is_file():
+            return False
+
+        # marks the artifact as recently used for the LRU eviction
+        self.lease([store_path])
+        os.utime(store_path)
+        if os.path.lexists(target_path):
+            if target_path.exists() and os.path.samefile(store_path, target_path):
+                return True
+            logger.info(f'{target_path} belongs to a different version of its raw file, replacing it')
+            self.remove_changed(target_path)
+        link_file(store_path, target_path)
+        return True
+
+    def add(self, kind: str, fingerprint: str, source_path: Path):
+        """
+        Moves a newly created artifact into the store and links it back to its original path
+        """
+        store_path = self.get_store_path(kind, fingerprint, source_path.suffix)
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        # the store entry only appears once it is complete, so concurrent runs never see a partial file
+        tmp_path = store_path.with_name(f'{store_path.name}.{os.getpid()}.tmp')
+        self.lease([store_path])
+        shutil.move(str(source_path), str(tmp_path))
+        os.utime(tmp_path)
+        os.replace(tmp_path, store_path)
+        link_file(store_path, source_path)
+
+    def remove_stale(self, target_path: Path):
+        """
+        Removes a project file that has no store entry, e.g. an mzML file of a previous version of its raw file
+        """
+        if os.path.lexists(target_path):
+            logger.info(f'{target_path} is not the conversion of the current raw file, converting it again')
+            self.remove_changed(target_path)
+
+    def remove_changed(self, target_path: Path):
+        self.changed_files.append(target_path)
+        target_path.unlink()
+        if self.derived_files is not None:
+            for derived_file in self.derived_files(target_path):
+                if derived_file.is_file():
+                    logger.debug(f'Removing {derived_file}')
+                    derived_file.unlink()
+
+    def lease(self, paths: Iterable[Path]):
+        """
+        Adds files to the lease of this run, such that concurrent runs do not evict them. The files do not have to
+        exist yet, e.g. the dat files of the mzML files.
+        """
+        new_paths = [str(Path(path).absolute()) for path in paths]
+        new_paths = [path for path in new_paths if path not in self.leased_paths]
+        if len(new_paths) == 0:
+            return
+        self.lease_folder.mkdir(parents=True, exist_ok=True)
+        # appending keeps the entries of worker processes that add to the lease of the run that started them
+        with open(self.lease_file, 'a') as f:
+            f.write(''.join(f'{path}\n' for path in new_paths))
+        self.leased_paths.update(new_paths)
+
+    def release(self):
+        """
+        Ends the lease of this run
+        """
+        if self.lease_file.is_file():
+            self.lease_file.unlink()
+        self.leased_paths = set()
+
+    def get_leased_files(self) -> List[Path]:
+        """
+        :return: files in the leases of the other runs that are still running, stale leases are removed
+        """
+        leased_files = []
+        for lease_file in self.lease_folder.glob('*.lease'):
+            if lease_file == self.lease_file:
+                continue
+            try:
+                if not is_lease_live(lease_file):
+                    logger.info(f'Removing stale lease {lease_file}')
+                    lease_file.unlink()
+                    continue
+                with open(lease_file) as f:
+                    leased_files += [Path(line.rstrip('\n')) for line in f if len(line.rstrip('\n')) > 0]
+            except FileNotFoundError:
+                # released in the meantime
+                continue
+        return leased_files
+
+    def evict(self, max_size: int, folders: Iterable[Path], used_files: Iterable[Path] = ()):
+        """
+        Removes the least recently used files in the store and the given cache folders until their total size is
+        below max_size. Hardlinks of the same file are counted and removed together, files that were created or
+        used during this run or that are leased by a concurrent run are never removed.
+        :param max_size: maximum total size in bytes
+        :param folders: cache folders besides the store, e.g. mzML, dat_files and extracted
+        :param used_files: files that were used during this run without being modified
+        """
+        used_inodes = set()
+        for path in [*used_files, *self.get_leased_files()]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                used_inodes.add((stat.st_dev, stat.st_ino))
+
+        groups: Dict[tuple, List[Path]] = dict()
+        last_used: Dict[tuple, float] = dict()
+        sizes: Dict[tuple, int] = dict()
+        symlinks = []
+        for folder in [self.store_folder, *folders]:
+            if not folder.is_dir():
+                continue
+            for path in folder.rglob('*'):
+                if path.is_symlink():
+                    symlinks.append(path)
+                    continue
+                if not path.is_file():
+                    continue
+                stat = path.stat()
+                key = (stat.st_dev, stat.st_ino)
+                groups.setdefault(key, []).append(path)
+                last_used[key] = max(last_used.get(key, 0.0), stat.st_mtime, stat.st_atime)
+                sizes[key] = stat.st_size
+
+        total_size = sum(sizes.values())
+        logger.info(f'Cache size is {total_size / 1e9:.2f} GB, limit is {max_size / 1e9:.2f} GB')
+        candidates = [key for key in groups.keys() if last_used[key] < self.start_time and key not in used_inodes]
+        for key in sorted(candidates, key=lambda k: last_used[k]):
+            if total_size <= max_size:
+                break
+            for path in groups[key]:
+                logger.debug(f'Evicting {path} from the cache')
+                path.unlink()
+            total_size -= sizes[key]
+
+        if total_size > max_size:
+            logger.warning(f'Cache size is {total_size / 1e9:.2f} GB, it cannot be reduced further without removing '
+                           f'files used in this run')
+
+        # symlinks to evicted files, e.g. in the mzML folder if the store is on a different file system
+        for path in symlinks:
+            if not path.exists():
+                path.unlink()
+
+
+def is_lease_live(lease_file: Path) -> bool:
+    """
+    Checks if the run that wrote the lease is still running, by its process ID if it runs on this host and by the
+    time of its last entry otherwise
+    """
+    host, pid, _ = lease_file.stem.rsplit('_', 2)
+    # os.kill terminates the process on Windows instead of checking it
+    if host == socket.gethostname() and os.name == 'posix':
+        return is_process_running(int(pid))
+    return time.time() - lease_file.stat().st_mtime < LEASE_TIMEOUT
+
+
+def is_process_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+def link_file(source_path: Path, target_path: Path):
+    """
+    Creates a hardlink, or a symlink if the paths are on different file systems, or a copy if neither is supported
+    """
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(source_path.absolute(), target_path)
+        return
+    except OSError:
+        pass
+    shutil.copy2(source_path, target_path)
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from . import __version__
+from .cache import hash_file
+from .utils.executor import write_pickle
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+
+# name of the artifact that holds the result of StageCheckpoints.run
+RESULT = 'result'
+
+
+class StageCheckpoints:
+    """
+    Persists the outputs of the stages of a run, e.g. the MaxQuant tables or the annotated clusters of a stringency,
+    in <cache_folder>/checkpoints together with a manifest of the input hashes and parameters of each stage.
+    A rerun skips every stage whose inputs did not change and whose outputs still exist, e.g. a run with a different
+    --maximum_pep only repeats the identity transfer and the evidence building.
+
+    A stage is complete as soon as its pickled artifacts are written and all output tables it submitted for export
+    are written, such that a run that fails while writing the output tables does not leave complete stages with
+    missing or partial output tables behind.
+    """
+
+    def __init__(self, checkpoint_folder: Optional[Path] = None):
+        """
+        :param checkpoint_folder: folder for the manifest and the pickled stage outputs, None to run every stage
+                                  without checkpoints
+        """
+        self.checkpoint_folder = checkpoint_folder
+        self.enabled = checkpoint_folder is not None
+        self.stages: Dict[str, dict] = dict()
+        self.complete: Dict[str, bool] = dict()
+        # stages that are running, with the number of exports that were submitted but are not written yet
+        self.running: Dict[str, dict] = dict()
+        self.lock = threading.Lock()
+        if not self.enabled:
+            return
+
+        self.checkpoint_folder.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = checkpoint_folder / Path(MANIFEST_FILE)
+        if self.manifest_file.is_file():
+            with open(self.manifest_file) as f:
+                self.stages = json.load(f)
+
+    def get_key(self, parameters: Dict[str, Any], input_files: Iterable[Path] = (),
+                upstream_keys: Iterable[Optional[dict]] = ()) -> Optional[dict]:
+        """
+        Describes the inputs of a stage, a stage has to run again if any of them changes
+        :param parameters: command line arguments and other settings that change the outputs of the stage
+        :param input_files: files read by the stage, identified by the hash of their whole content
+        :param upstream_keys: keys of the stages whose outputs are read by this stage
+        :return: json-serializable description of the inputs with their combined hash under 'key', None without
+                 checkpoints
+        """
+        if not self.enabled:
+            return None
+        description = {'version': __version__,
+                       'parameters': {name: str(value) for name, value in parameters.items()},
+                       'inputs': {str(path): hash_file(path) for path in input_files},
+                       'upstream': [key['key'] for key in upstream_keys]}
+        description['key'] = hashlib.blake2b(json.dumps(description, sort_keys=True).encode(),
+                                             digest_size=16).hexdigest()
+        return description
+
+    def is_complete(self, stage: str, key: Optional[dict]) -> bool:
+        """
+        Checks that the stage finished with the same inputs and that its artifacts and output tables still exist
+        """
+        if not self.enabled:
+            return False
+        if stage not in self.complete:
+            self.complete[stage] = self._check(stage, key)
+        return self.complete[stage]
+
+    def _check(self, stage: str, key: dict) -> bool:
+        record = self.stages.get(stage)
+        if record is None:
+            return False
+        if record['key'] != key['key']:
+            logger.info(f'Inputs of stage {stage} changed, running it again')
+            return False
+        files = list(record['artifacts'].values()) + record['outputs']
+        missing = [f for f in files if not os.path.isfile(f) or os.path.getsize(f) == 0]
+        if len(missing) > 0:
+            logger.info(f'Outputs of stage {stage} are missing, running it again: {missing[:5]}')
+            return False
+        logger.info(f'Skipping stage {stage}, resuming from its checkpoint')
+        return True
+
+    def run(self, stage: str, key: Optional[dict], function: Callable, *args, needed: bool = True, **kwargs):
+        """
+        Runs a stage and saves its result, or loads the result of a complete stage
+        :param needed: whether the result is used, the result of a complete stage is only loaded if it is needed
+        :return: result of the function or of the checkpoint, None if the stage is complete and its result is not
+                 needed
+        """
+        if self.is_complete(stage, key):
+            if not needed or RESULT not in self.stages[stage]['artifacts']:
+                return None
+            return self.load(stage, RESULT)
+        self.start(stage, key)
+        result = function(*args, **kwargs)
+        if result is not None:
+            self.save(stage, RESULT, result)
+        self.finish(stage)
+        return result
+
+    def start(self, stage: str, key: Optional[dict]):
+        """
+        Invalidates the previous checkpoint of the stage, such that it is not used if this run fails
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.complete.pop(stage, None)
+            self.stages.pop(stage, None)
+            self.running[stage] = {'key': key, 'artifacts': dict(), 'outputs': [], 'pending': 0, 'finished': False}
+            self._write_manifest()
+
+    def save(self, stage: str, name: str, content: Any):
+        """
+        Pickles an output of the stage that later stages of a rerun need, e.g. the annotated clusters
+        """
+        if not self.enabled:
+            return
+        artifact_file = self.get_artifact_file(stage, name)
+        artifact_file.parent.mkdir(exist_ok=True)
+        write_pickle(artifact_file, content)
+        with self.lock:
+            self.running[stage]['artifacts'][name] = str(artifact_file)
+
+    def load(self, stage: str, name: str) -> Any:
+        with open(self.stages[stage]['artifacts'][name], 'rb') as f:
+            return pickle.load(f)
+
+    def get_artifact_file(self, stage: str, name: str) -> Path:
+        return self.checkpoint_folder / Path(stage) / Path(f'{name}.pkl')
+
+    def export(self, stage: str, export: Callable) -> Callable:
+        """
+        Wraps the export of a stage, e.g. ExportQueue.submit, such that the written output tables are recorded and
+        the stage is only complete after they are written
+        :param export: called with an export function and its arguments
+        :return: export with the same arguments that tracks the output tables of the stage
+        """
+        if not self.enabled:
+            return export
+
+        def tracked_export(export_function: Callable, *args, **kwargs):
+            with self.lock:
+                self.running[stage]['pending'] += 1
+
+            def tracked_export_function(*export_args, **export_kwargs):
+                written_files = export_function(*export_args, **export_kwargs)
+                with self.lock:
+                    self.running[stage]['outputs'] += list(map(str, written_files))
+                    self.running[stage]['pending'] -= 1
+                    self._commit(stage)
+                return written_files
+
+            export(tracked_export_function, *args, **kwargs)
+
+        return tracked_export
+
+    def finish(self, stage: str):
+        """
+        Marks the computation of the stage as done, the stage is complete once its pending exports are written
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.running[stage]['finished'] = True
+            self._commit(stage)
+
+    def _commit(self, stage: str):
+        running = self.running[stage]
+        if not running['finished'] or running['pending'] > 0:
+            return
+        del self.running[stage]
+        self.stages[stage] = {'key': running['key']['key'], 'parameters': running['key']['parameters'],
+                              'inputs': running['key']['inputs'], 'upstream': running['key']['upstream'],
+                              'artifacts': running['artifacts'], 'outputs': running['outputs'],
+                              'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self._write_manifest()
+        logger.debug(f'Wrote checkpoint of stage {stage}')
+
+    def _write_manifest(self):
+        tmp_file = self.manifest_file.with_suffix('.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
@@ -58,15 +58,56 @@ def parse_args(argv):
 
     apars.add_argument('--num_threads', type=int, default=min(multiprocessing.cpu_count(), 4), metavar='N',
                        help='''
-                       Number of threads, by default this is equal to min(4, number of CPU cores available on the device).
+                       Number of threads, by default this is equal to min(4, number of CPU cores available on the device). 
+                       Stages that run at the same time, e.g. with --concurrent_stages or --pipelined_conversion, share 
+                       these threads.
                        ''')
     
     apars.add_argument('--num_threads_per_precursor_bin', type=int, default=0, metavar='N',
                        help='''
-                       Number of threads per precursor bin in maracluster. If set to 0 (default), no parallelization across precursor bins is applied.
+                       Number of threads per precursor bin of average size in maracluster. Larger bins get proportionally more threads 
+                       and smaller bins fewer, the largest bins are processed first. If set to 0 (default), no parallelization across 
+                       precursor bins is applied.
                        ''')
     
 
+    apars.add_argument('--incremental_clustering', default=False, action='store_true',
+                       help='''
+                       When mzML files are added to a previous run in the same output folder, reuses the dat files of 
+                       unchanged mzML files and the p-values of precursor bins that receive no new spectra, which 
+                       needs --num_threads_per_precursor_bin. The reused p-values are based on the peak counts of 
+                       the previous run, so results can differ slightly from a run from scratch.
+                       ''')
+
+    apars.add_argument('--work_queue_folder', type=Path, default=None, metavar="DIR",
+                       help='''
+                       Distributes the precursor bins of maracluster to workers on other nodes through a work queue in 
+                       this folder, which needs --num_threads_per_precursor_bin. The folder and the output folder have 
+                       to be on a file system shared with the workers, which are started with 
+                       python -m simsi_transfer.maracluster worker --work_queue_folder DIR
+                       ''')
+
+    apars.add_argument('--num_local_queue_workers', type=int, default=1, metavar='N',
+                       help='''
+                       Number of workers processing the work queue on this node with --work_queue_folder or --executor shared_fs.
+                       ''')
+
+    apars.add_argument('--executor', default='process', metavar="S",
+                       help='''
+                       Runs the jobs of the conversion, reporter ion extraction and evidence building stages: 
+                       'serial' in the main thread, 'thread' in a thread pool per stage, 'process' in a new process 
+                       pool per stage, 'warm' in one process pool of --num_threads processes that is reused by all 
+                       stages, 'shared_fs' by workers on any node through a queue in --executor_queue_folder.
+                       ''')
+
+    apars.add_argument('--executor_queue_folder', type=Path, default=None, metavar="DIR",
+                       help='''
+                       Work queue folder for --executor shared_fs. The folder, the cache folder and the output folder 
+                       have to be on a file system shared with the workers, which are started with 
+                       python -m simsi_transfer.utils.executor worker --work_queue_folder DIR. 
+                       --num_local_queue_workers threads of this process also run jobs.
+                       ''')
+
     apars.add_argument('--tmt_reporter_correction_file', default="", metavar="DIR",
                        help='''
                        Path to TMT correction factor file, as exported from MaxQuant.
@@ -127,6 +168,129 @@ def parse_args(argv):
                        Maximum Posterior Error Probability (PEP) in percent of PSMs to be considered for transfers.
                        ''')
 
+    apars.add_argument('--memory_lean', default=False, action='store_true',
+                       help='''
+                       Loads the string columns of the MaxQuant tables, e.g. Raw file, Modified sequence and Proteins, 
+                       as categoricals with one shared dictionary per column and keeps them encoded until export. 
+                       This strongly reduces memory usage for large data sets.
+                       ''')
+
+    apars.add_argument('--memory_map_scan_index', default=False, action='store_true',
+                       help='''
+                       Stores the scan indices used for annotating the clusters as memory-mapped files in the cache folder
+                       instead of keeping them in memory.
+                       ''')
+
+    apars.add_argument('--output_format', default='tsv', metavar="S",
+                       help='''
+                       File format of the output tables in the summaries folder: 
+                       'tsv' writes MaxQuant-like tab-separated .txt files.
+                       'parquet' writes typed .parquet files with dictionary-encoded strings, sorted like the .txt files.
+                       'both' writes both formats.
+                       ''')
+
+    apars.add_argument('--compression', default='none', metavar="S",
+                       help='''
+                       Compression of the .txt output tables: 'none', 'gzip' (.txt.gz) or 'zstd' (.txt.zst). 
+                       Compression runs in parallel to writing the tables.
+                       ''')
+
+    apars.add_argument('--compression_level', type=int, default=None, metavar='N',
+                       help='''
+                       Compression level of the .txt output tables. Defaults to 6 for gzip and 3 for zstd.
+                       ''')
+
+    apars.add_argument('--compression_threads', type=int, default=0, metavar='N',
+                       help='''
+                       Number of threads for compressing each output table. Set to 0 to use the value of --num_threads.
+                       ''')
+
+    apars.add_argument('--output_columns', type=Path, default=None, metavar="FILE",
+                       help='''
+                       YAML or JSON file that lists the columns to write for each output table, e.g. 
+                       "msmsScans: [Raw file, scanID, Modified sequence]". Possible tables are annotated_clusters, 
+                       msmsScans, msms and evidence; tables that are not listed are written with all columns. Columns 
+                       that are not needed for any output table are dropped as early as possible.
+                       ''')
+
+    apars.add_argument('--num_export_threads', type=int, default=1, metavar='N',
+                       help='''
+                       Number of background threads writing the output tables while the next tables are computed. 
+                       Set to 0 to write the output tables before continuing the computation.
+                       ''')
+
+    apars.add_argument('--streaming_evidence', default=False, action='store_true',
+                       help='''
+                       Writes the evidence of each raw file to a temporary chunk file in the cache folder as soon as 
+                       it is built and merges the sorted chunks into p<x>_evidence.txt, instead of keeping the full 
+                       evidence table in memory. In this mode, the evidence ids are unique across raw files.
+                       ''')
+
+    apars.add_argument('--batch_conversion', default=False, action='store_true',
+                       help='''
+                       Converts the .raw files with one ThermoRawFileParser process per thread, each converting a 
+                       group of raw files of about equal total size, instead of starting a process for every raw file.
+                       ''')
+
+    apars.add_argument('--pipelined_conversion', default=False, action='store_true',
+                       help='''
+                       With --tmt_requantify, starts the reporter ion extraction of each .mzML file as soon as it is 
+                       converted instead of after all .raw files are converted and clustered, such that the 
+                       conversion, the extraction and the clustering overlap.
+                       ''')
+
+    apars.add_argument('--concurrent_stages', default=False, action='store_true',
+                       help='''
+                       Runs the MaRaCluster clustering in the background while the MaxQuant tables are read and 
+                       preprocessed. With --tmt_requantify, the reporter ion extraction also runs in the background. 
+                       The extraction gets half of --num_threads and the clustering the other half, on top of the 
+                       thread reading the tables.
+                       ''')
+
+    apars.add_argument('--memory_aware_conversion', default=False, action='store_true',
+                       help='''
+                       Estimates the memory usage of each .raw file conversion from the file size and only runs as 
+                       many conversions in parallel as fit in the conversion memory limit and the available memory, 
+                       starting with the largest files. At most --num_threads conversions run at the same time.
+                       ''')
+
+    apars.add_argument('--conversion_memory_limit', type=float, default=0, metavar='GB',
+                       help='''
+                       Memory budget in GB for parallel .raw file conversions with --memory_aware_conversion. 
+                       Set to 0 to use 80%% of the memory available at the start of the conversion.
+                       ''')
+
+    apars.add_argument('--content_store', default=False, action='store_true',
+                       help='''
+                       Stores converted mzML files in the cache folder by a fingerprint of the content of their 
+                       .raw file and links them into the mzML cache folder, such that raw files shared between 
+                       projects, renamed or moved are only converted once and changed raw files are converted again.
+                       ''')
+
+    apars.add_argument('--cache_size_limit', type=float, default=0, metavar='GB',
+                       help='''
+                       Maximum size of the cache folder in GB. At the end of the run, the least recently used 
+                       mzML, MaRaCluster dat and extracted reporter ion files are removed until the cache fits in 
+                       this limit. Files used in the current run are never removed. Set to 0 for no limit.
+                       ''')
+
+    apars.add_argument('--checkpoint_stages', default=False, action='store_true',
+                       help='''
+                       Stores the MaxQuant tables, the annotated clusters and the transferred identifications of
+                       each stringency in <cache_folder>/checkpoints, with a manifest of the input fingerprints and
+                       parameters of each stage. A rerun resumes from the first stage whose inputs changed, e.g.
+                       a rerun with a different --maximum_pep or --ambiguity_decision skips reading the MaxQuant
+                       tables and annotating the clusters. Needs disk space for a copy of the MaxQuant tables and
+                       of the annotated clusters of every stringency.
+                       ''')
+
+    apars.add_argument('--profile_memory', default=False, action='store_true',
+                       help='''
+                       Records the memory usage of the input and output tables of each stage in SIMSI.profile.json,
+                       in addition to the wall time, CPU time, peak memory and number of rows that are always
+                       recorded. Measuring the memory of string columns takes a pass over all strings.
+                       ''')
+
     # ------------------------------------------------
     args = apars.parse_args(argv)
 
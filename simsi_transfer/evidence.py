@@ -1,14 +1,58 @@
 import logging
-from typing import List
+from pathlib import Path
+from typing import List, Optional
 
 import numpy as np
 import pandas as pd
 
 from .merging_functions import merge_summary_with_evidence
 from .utils import utils
+from .utils import table_writer
+from .utils import profiler
+from .utils.executor import ExecutorBackend, get_executor
 
 logger = logging.getLogger(__name__)
 
+# columns of the SIMSI-Transfer msms.txt dataframe that are read by build_evidence, excluding the reporter channels
+REQUIRED_COLUMNS = [
+    "Sequence",
+    "Length",
+    "Modifications",
+    "Modified sequence",
+    "Missed cleavages",
+    "Proteins",
+    "Gene Names",
+    "Protein Names",
+    "Raw file",
+    "Fraction",
+    "Experiment",
+    "Charge",
+    "m/z",
+    "Mass",
+    "Mass error [ppm]",
+    "Retention time",
+    "MS scan number",
+    "PEP",
+    "scanID",
+    "Score",
+    "Delta score",
+    "Reverse",
+    "summary_ID",
+    "identification",
+]
+
+
+def get_required_columns(plex: int) -> List[str]:
+    """
+    Columns of the SIMSI-Transfer msms.txt dataframe that are needed to build the evidence
+    :param plex: number of TMT channels
+    """
+    return (
+        REQUIRED_COLUMNS
+        + [f"Reporter intensity {i}" for i in range(1, plex + 1)]
+        + [f"Reporter intensity corrected {i}" for i in range(1, plex + 1)]
+    )
+
 
 def assign_evidence_type(summary: pd.DataFrame, type_column_name: str = "new_type"):
     """
@@ -46,7 +90,7 @@ def assign_missing_precursors(summary: pd.DataFrame, allpeptides: pd.DataFrame):
     """
     group_key = ["Raw file", "Charge"]
     allpeptides_grouped = {
-        group: df_grouped for group, df_grouped in allpeptides.groupby(group_key)
+        group: df_grouped for group, df_grouped in allpeptides.groupby(group_key, observed=True)
     }
 
     missing_precursor = summary["new_type"] == "MSMS"
@@ -129,11 +173,11 @@ def assign_evidence_feature(
     # store number of rows of summary dataframe to check if we have the same number after merging
     summary_length_before_processing = len(summary.index)
 
-    summary = merge_summary_with_evidence(summary, evidence)
-    summary = assign_evidence_type(summary)
-    summary = remove_duplicate_msms(summary)
-    summary = assign_missing_precursors(summary, allpeptides)
-    summary = fill_missing_evidence_ids(summary)
+    summary = profiler.call("merge_summary_with_evidence", merge_summary_with_evidence, summary, evidence)
+    summary = profiler.call("assign_evidence_type", assign_evidence_type, summary)
+    summary = profiler.call("remove_duplicate_msms", remove_duplicate_msms, summary)
+    summary = profiler.call("assign_missing_precursors", assign_missing_precursors, summary, allpeptides)
+    summary = profiler.call("fill_missing_evidence_ids", fill_missing_evidence_ids, summary)
 
     if not len(summary) == summary_length_before_processing:
         raise ValueError(
@@ -161,13 +205,6 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
         by=["Sequence", "Modified sequence", "Raw file", "Charge"]
     ).reset_index(drop=True)
 
-    # add semicolon to columns which will be concatenated. this allows us to use the
-    # fast "sum" aggfunc instead of a slow custom string function
-    concat_cols = ["Proteins", "Leading proteins", "scanID", "summary_ID"]
-    summary[concat_cols] = summary[concat_cols].apply(
-        lambda column: column.astype(str) + ";"
-    )
-
     summary_grouped = summary.groupby("evidence_ID")
 
     # Column generation
@@ -189,8 +226,10 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
             "Missed cleavages": pd.NamedAgg(
                 column="Missed cleavages", aggfunc="first"
             ),  # from msms.txt
-            "Proteins": pd.NamedAgg(column="Proteins", aggfunc="sum"),  # from msms.txt
-            "Leading proteins": pd.NamedAgg(column="Leading proteins", aggfunc="sum"),
+            # the semicolon-separated list columns are placeholders here, they are filled by
+            # utils.csv_unique_grouped below
+            "Proteins": pd.NamedAgg(column="Proteins", aggfunc="first"),  # from msms.txt
+            "Leading proteins": pd.NamedAgg(column="Leading proteins", aggfunc="first"),
             # from evidence.txt, NaN if scan not matched to precursor in evidence.txt
             "Gene Names": pd.NamedAgg(
                 column="Gene Names", aggfunc="first"
@@ -222,7 +261,7 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
                 column="Sequence", aggfunc="size"
             ),  # calculated by SIMSI-Transfer
             "MS/MS all scan numbers": pd.NamedAgg(
-                column="scanID", aggfunc="sum"
+                column="scanID", aggfunc="first"
             ),  # calculated by SIMSI-Transfer
             "MS/MS scan number": pd.NamedAgg(
                 column="scanID", aggfunc="first"
@@ -254,7 +293,7 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
             },  # calculated by SIMSI-Transfer
             "Reverse": pd.NamedAgg(column="Reverse", aggfunc="first"),  # from msms.txt
             "summary_ID": pd.NamedAgg(
-                column="summary_ID", aggfunc="sum"
+                column="summary_ID", aggfunc="first"
             ),  # assigned by SIMSI-Transfer
             "Transferred spectra count": pd.NamedAgg(
                 column="identification", aggfunc="sum"
@@ -262,14 +301,15 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
         }
     )
 
-    for col in [
-        "Proteins",
-        "Leading proteins",
-        "MS/MS all scan numbers",
-        "MS/MS scan number",
-        "summary_ID",
+    for col, summary_col in [
+        ("Proteins", "Proteins"),
+        ("Leading proteins", "Leading proteins"),
+        ("MS/MS all scan numbers", "scanID"),
+        ("summary_ID", "summary_ID"),
     ]:
-        evidence[col] = evidence[col].apply(utils.csv_unique)
+        evidence[col] = utils.csv_unique_grouped(
+            summary[summary_col].astype(str), summary["evidence_ID"]
+        )
 
     evidence["Transferred spectra count"] = evidence[
         "Transferred spectra count"
@@ -286,6 +326,8 @@ def calculate_evidence_columns(summary: pd.DataFrame, plex: int):
         logger.warning(
             f'No metadata fetched from evidence for {no_metadata_rawfiles}; autofilling with Fraction = -1 and Experiment = "UNKNOWN"'
         )
+    if isinstance(evidence["Experiment"].dtype, pd.CategoricalDtype):
+        evidence["Experiment"] = utils.add_categories(evidence["Experiment"], pd.Series(["UNKNOWN"]))
     evidence.loc[no_fraction_rows, "Experiment"] = "UNKNOWN"
     evidence.loc[no_fraction_rows, "Fraction"] = -1
     evidence = evidence.astype(
@@ -314,6 +356,7 @@ def build_evidence_grouped(
     allpeptides: pd.DataFrame,
     plex: int,
     num_threads: int,
+    executor_backend: Optional[ExecutorBackend] = None,
 ):
     """
     Optimized merging function to group dataframes by 'Raw file', perform the merge per group,
@@ -322,27 +365,68 @@ def build_evidence_grouped(
     :param msms_df: MaxQuant msms.txt dataframe
     :return: Merged dataframe
     """
-    # logger.debug(f"summary memory usage: {utils.get_dataframe_size(summary)}")
-    # logger.debug(f"evidence memory usage: {utils.get_dataframe_size(evidence)}")
-    # logger.debug(f"allPeptides memory usage: {utils.get_dataframe_size(allpeptides)}")
+    # jobs are submitted while iterating over the raw files, such that the groups of all raw files are never held in
+    # memory at the same time
+    executor = get_executor(executor_backend, num_threads, summary["Raw file"].nunique())
+    for _, args in get_evidence_groups(summary, evidence, allpeptides, plex):
+        executor.submit(profiler.profiled(build_evidence), args)
+    evidences = profiler.collect(executor.wait())
+
+    return pd.concat(evidences, ignore_index=True)
+
+
+def build_evidence_streamed(
+    summary: pd.DataFrame,
+    evidence: pd.DataFrame,
+    allpeptides: pd.DataFrame,
+    plex: int,
+    num_threads: int,
+    chunk_folder: Path,
+    executor_backend: Optional[ExecutorBackend] = None,
+) -> table_writer.SortedChunks:
+    """
+    Builds the evidence per raw file like build_evidence_grouped, but each worker writes its sorted evidence slice
+    to a chunk file instead of returning it, such that the full evidence table is never held in memory. The chunks
+    are merged into the sorted output file by simsi_output.export_simsi_evidence_chunks.
+
+    The evidence IDs of each raw file start at 0, they are made unique across raw files by adding running offsets
+    while merging the chunks.
+    :param summary: msms.txt dataframe of SIMSI-Transfer
+    :param evidence: MaxQuant evidence.txt dataframe
+    :param allpeptides: MaxQuant allPeptides.txt dataframe
+    :param plex: number of TMT channels
+    :param num_threads: number of parallel processes
+    :param chunk_folder: folder to store the chunk files in
+    :param executor_backend: runs the jobs per raw file, defaults to a new process pool of num_threads processes
+    :return: chunk files in raw file order
+    """
+    chunk_folder.mkdir(parents=True, exist_ok=True)
+
+    executor = get_executor(executor_backend, num_threads, summary["Raw file"].nunique())
+    chunk_files = []
+    for i, (_, args) in enumerate(get_evidence_groups(summary, evidence, allpeptides, plex)):
+        chunk_files.append(chunk_folder / f"evidence_chunk_{i}.pkl")
+        executor.submit(profiler.profiled(build_evidence_chunk), (*args, chunk_files[-1]))
+    results = profiler.collect(executor.wait())
 
+    # concatenating the empty templates gives the dtypes that pd.concat would give for the full evidence slices
+    templates = [template for template, _ in results]
+    template = pd.concat(templates, ignore_index=True) if templates else pd.DataFrame()
+    id_offsets = np.cumsum([0] + [num_ids for _, num_ids in results[:-1]]).tolist()
+    return table_writer.SortedChunks(chunk_files, template, "id", id_offsets)
+
+
+def get_evidence_groups(
+    summary: pd.DataFrame, evidence: pd.DataFrame, allpeptides: pd.DataFrame, plex: int
+):
+    """
+    Groups the dataframes by 'Raw file' and yields the arguments for build_evidence for each raw file
+    """
     # Group dataframes by 'Raw file'
-    summary_groups = summary.groupby("Raw file")
-    evidence_groups = evidence.groupby("Raw file")
-    allpeptides_groups = allpeptides.groupby("Raw file")
-
-    multithreading = num_threads > 1
-    if multithreading:
-        from job_pool import JobPool
-
-        job_pool = JobPool(
-            processes=num_threads,
-            write_progress_to_logger=True,
-            total_jobs=len(summary_groups),
-        )
+    summary_groups = summary.groupby("Raw file", observed=True)
+    evidence_groups = evidence.groupby("Raw file", observed=True)
+    allpeptides_groups = allpeptides.groupby("Raw file", observed=True)
 
-    # Iterate through each group and merge
-    evidences = []
     for raw_file, summary_group in summary_groups:
         if raw_file not in evidence_groups.groups:
             logger.warning(f"{raw_file} missing in evidence.txt, skipping this file")
@@ -354,20 +438,31 @@ def build_evidence_grouped(
         evidence_group = evidence_groups.get_group(raw_file)
         allpeptides_group = allpeptides_groups.get_group(raw_file)
 
-        args = (summary_group, evidence_group, allpeptides_group, plex)
-        if multithreading:
-            job_pool.applyAsync(build_evidence, args)
-        else:
-            evidences.append(build_evidence(*args))
+        yield raw_file, (summary_group, evidence_group, allpeptides_group, plex)
 
-    if multithreading:
-        evidences = job_pool.checkPool()
 
-    return pd.concat(evidences, ignore_index=True)
+def build_evidence_chunk(
+    summary: pd.DataFrame,
+    evidence: pd.DataFrame,
+    allpeptides: pd.DataFrame,
+    plex: int,
+    chunk_file: Path,
+):
+    """
+    Builds the evidence of a single raw file and writes it to chunk_file
+    :return: empty dataframe with the columns and dtypes of the evidence slice, number of used evidence IDs
+    """
+    evidence = build_evidence(summary, evidence, allpeptides, plex)
+    table_writer.write_sorted_chunk(evidence, chunk_file)
+    num_ids = int(evidence["id"].max()) + 1 if len(evidence.index) > 0 else 0
+    return evidence.iloc[:0], num_ids
 
 
 def build_evidence(
-    summary: pd.DataFrame, evidence: pd.DataFrame, allpeptides: pd.DataFrame, plex: int
+    summary: pd.DataFrame,
+    evidence: pd.DataFrame,
+    allpeptides: pd.DataFrame,
+    plex: int,
 ):
     evidence = evidence[evidence["Type"] != "MSMS"]
     evidence = evidence.sort_values(
@@ -380,5 +475,5 @@ def build_evidence(
     )
     evidence.insert(len(evidence.columns), "evidence_ID", range(len(evidence)))
     summary = assign_evidence_feature(summary, evidence, allpeptides)
-    evidence = calculate_evidence_columns(summary, plex)
+    evidence = profiler.call("calculate_evidence_columns", calculate_evidence_columns, summary, plex)
     return evidence
@@ -4,20 +4,37 @@ from pathlib import Path
 from datetime import datetime
 import logging
 import time
+import shutil
+import tempfile
+from functools import partial
 
 from . import __version__, __copyright__
 from . import command_line_interface as cli
 from . import maxquant as mq
+from . import merging_functions as mf
 from . import simsi_output
 from . import thermo_raw as raw
 from . import maracluster as cluster
+from . import scan_index
 from . import tmt_processing
 from . import transfer
 from . import evidence
 from .utils import utils
+from .utils.compression import Compression, COMPRESSION_METHODS
+from .utils.scheduler import BackgroundStages
+from .utils.cpu_budget import CpuBudget
+from .utils.executor import ExecutorBackend, EXECUTOR_BACKENDS
+from .utils import profiler
+from .cache import ContentStore
+from .checkpoint import StageCheckpoints, RESULT
 
 logger = logging.getLogger(__name__)
 
+MAXQUANT_FILES = ['msmsScans.txt', 'msms.txt', 'evidence.txt', 'allPeptides.txt']
+
+# tables of the maxquant stage that are stored in its checkpoint
+MAXQUANT_ARTIFACTS = ['msmsScans', 'msms', 'rawfile_metadata', 'evidence', 'allPeptides']
+
 
 class NullWriter:
     softspace = 0
@@ -40,16 +57,12 @@ if sys.stderr is None:
 def main(argv):
     args = cli.parse_args(argv)
 
-    # Validate ms2/ms3 argument
-    if args.tmt_ms_level not in ["ms2", "ms3"]:
-        logger.error("Invalid ms_level argument. Expected 'ms2' or 'ms3'.")
-        sys.exit(1)
+    validate_args(args)
+
+    output_columns = dict()
+    if args.output_columns:
+        output_columns = simsi_output.read_output_columns(args.output_columns)
 
-    # Validate ambiguity_decision argument
-    valid_ambiguity_decisions = ["keep_all", "all", "majority"]
-    if args.ambiguity_decision not in valid_ambiguity_decisions:
-        logger.error(f"Invalid ambiguity_decision argument. Expected one of {valid_ambiguity_decisions}.")
-        sys.exit(1)
     pvals = cli.parse_stringencies(args.stringencies)
     meta_input_df = cli.get_input_folders(args)
     tmt_ms_level = cli.parse_tmt_ms_level(args.tmt_ms_level)
@@ -68,6 +81,8 @@ def main(argv):
     logging.getLogger(module_name).addHandler(file_logger)
 
     starttime = datetime.now()
+    profiler.reset()
+    profiler.set_dataframe_memory(args.profile_memory)
 
     logger.info(f'SIMSI-Transfer version {__version__}')
     logger.info(f'{__copyright__}')
@@ -83,6 +98,12 @@ def main(argv):
     logger.info(f"Number of threads per precursor bin = {args.num_threads_per_precursor_bin}")
     logger.info(f"TMT correction file = {tmt_correction_files}")
     logger.info(f"TMT MS level = {tmt_ms_level}")
+    logger.info(f"Output format = {args.output_format}")
+    logger.info(f"Output compression = {args.compression}")
+    logger.info(f"Content store = {args.content_store}")
+    logger.info(f"Cache size limit = {args.cache_size_limit} GB")
+    logger.info(f"Executor = {args.executor}")
+    logger.info(f"Checkpoint stages = {args.checkpoint_stages}")
     logger.info('')
 
     logger.info(f'Starting SIMSI-Transfer')
@@ -94,115 +115,532 @@ def main(argv):
 
     raw_filenames_input = {i.stem for i in raw_files}
 
-    logger.info(f'Converting .raw files')
+    plex = mq.get_plex(mq_txt_folders)
+
     mzml_folder = args.cache_folder / Path('mzML')
-    mzml_files = raw.convert_raw_mzml_batch(raw_files, mzml_folder, args.num_threads)
+    dat_files_folder = args.cache_folder / Path('dat_files')
+    extracted_folder = args.cache_folder / Path('extracted')
+    content_store = ContentStore(args.cache_folder, partial(get_derived_cache_files, dat_files_folder=dat_files_folder,
+                                                            extracted_folder=extracted_folder))
+
+    # stages that overlap with other stages share the threads, stages that run on their own get all threads
+    cpu_budget = CpuBudget(args.num_threads)
+    executor_backend = ExecutorBackend(args.executor, args.num_threads, args.executor_queue_folder,
+                                       args.num_local_queue_workers)
+
+    extraction_queue = None
+    if args.tmt_requantify and args.pipelined_conversion:
+        logger.info(f'Extracting correct reporter ion intensities from .mzML files as soon as they are converted')
+        extraction_queue = tmt_processing.ReporterExtractionQueue(
+            extracted_folder, {raw_file.stem: path for raw_file, path in zip(raw_files, correction_factor_paths)},
+            plex=plex, extraction_level=tmt_ms_level,
+            num_threads=cpu_budget.acquire('reporter ion extraction', args.num_threads // 2),
+            total_jobs=len(raw_files), executor_backend=executor_backend)
 
+    logger.info(f'Converting .raw files')
+    with cpu_budget.quota('conversion') as num_threads, profiler.stage('conversion'):
+        mzml_files = raw.convert_raw_mzml_batch(raw_files, mzml_folder, num_threads,
+                                                content_store=content_store if args.content_store else None,
+                                                batch_conversion=args.batch_conversion,
+                                                memory_aware=args.memory_aware_conversion,
+                                                memory_budget=int(args.conversion_memory_limit * 1e9) or None,
+                                                on_converted=extraction_queue.submit if extraction_queue else None,
+                                                executor_backend=executor_backend)
+
+    # protects the mzML files and the files created from them against the cache eviction of concurrent runs
+    content_store.lease(mzml_files + [f for mzml_file in mzml_files for f in content_store.derived_files(mzml_file)])
+
+    if args.tmt_requantify and args.concurrent_stages and extraction_queue is None:
+        logger.info(f'Extracting correct reporter ion intensities from .mzML files in the background')
+        extraction_queue = tmt_processing.ReporterExtractionQueue(
+            extracted_folder, {raw_file.stem: path for raw_file, path in zip(raw_files, correction_factor_paths)},
+            plex=plex, extraction_level=tmt_ms_level,
+            num_threads=cpu_budget.acquire('reporter ion extraction', args.num_threads // 2),
+            total_jobs=len(mzml_files), executor_backend=executor_backend)
+        extraction_queue.submit(mzml_files)
+
+    background_stages = BackgroundStages(1 if args.concurrent_stages else 0)
     cluster_result_folder = args.output_folder / Path('maracluster_output')
-    if not cluster.has_previous_run(cluster_result_folder, mzml_files, pvals):
+    if len(content_store.changed_files) > 0 or not cluster.has_previous_run(cluster_result_folder, mzml_files, pvals):
         logger.info(f'Clustering .mzML files')
-        dat_files_folder = args.cache_folder / Path('dat_files')
-        cluster.cluster_mzml_files(mzml_files, pvals, cluster_result_folder, dat_files_folder, args.num_threads, args.num_threads_per_precursor_bin)
+        background_stages.submit('clustering', cpu_budget.run, 'clustering', profiler.call, 'clustering',
+                                 cluster.cluster_mzml_files, mzml_files, pvals, cluster_result_folder,
+                                 dat_files_folder, cpu_budget.acquire('clustering'),
+                                 args.num_threads_per_precursor_bin, args.work_queue_folder,
+                                 args.num_local_queue_workers, args.incremental_clustering)
     else:
         logger.info("Found previous MaRaCluster run, skipping clustering")
 
-    plex = mq.get_plex(mq_txt_folders)
+    checkpoints = StageCheckpoints(args.cache_folder / Path('checkpoints') if args.checkpoint_stages else None)
+    maxquant_key = checkpoints.get_key(*get_maxquant_stage_inputs(args, mq_txt_folders, raw_filenames_input,
+                                                                  mzml_files, correction_factor_paths))
+    resume_maxquant = checkpoints.is_complete('maxquant', maxquant_key)
 
-    logger.info(f'Reading in MaxQuant msmsscans.txt file')
-    msmsscans_mq = utils.process_and_concat(mq_txt_folders, mq.read_msmsscans_txt, tmt_requantify=args.tmt_requantify,
-                                         plex=plex)
+    annotation_index = scan_index_folder = None
+    if resume_maxquant:
+        if extraction_queue is not None:
+            extraction_queue.close()
+            cpu_budget.release('reporter ion extraction')
+    else:
+        checkpoints.start('maxquant', maxquant_key)
+        msmsscans_mq, raw_file_dictionary = read_msmsscans(args, mq_txt_folders, plex, raw_filenames_input)
+
+        if args.tmt_requantify:
+            if extraction_queue is not None:
+                logger.info(f'Waiting for the reporter ion extraction to finish')
+                with profiler.stage('reporter ion extraction'):
+                    extraction_queue.close()
+                cpu_budget.release('reporter ion extraction')
+            else:
+                logger.info(f'Extracting correct reporter ion intensities from .mzML files')
+                with cpu_budget.quota('reporter ion extraction') as num_threads, \
+                        profiler.stage('reporter ion extraction'):
+                    tmt_processing.extract_tmt_reporters(mzml_files=mzml_files, output_path=extracted_folder,
+                                                         correction_factor_paths=correction_factor_paths, plex=plex,
+                                                         extraction_level=tmt_ms_level, num_threads=num_threads,
+                                                         executor_backend=executor_backend)
+
+            msmsscans_mq = profiler.call('requantification', add_corrected_tmt, msmsscans_mq, mzml_files,
+                                         extracted_folder, plex, raw_file_dictionary)
+
+        msms_mq, evidence_mq, allpeptides_mq, rawfile_metadata, modified_sequence_dictionary = read_maxquant_tables(
+            args, mq_txt_folders, msmsscans_mq, raw_file_dictionary)
+
+        transfer_columns = msms_columns = evidence_columns = None
+        if args.output_columns:
+            msmsscans_mq, msms_mq, transfer_columns, msms_columns, evidence_columns = get_required_columns(
+                args, output_columns, plex, msmsscans_mq, msms_mq)
+
+        for name, table in zip(MAXQUANT_ARTIFACTS, [msmsscans_mq, msms_mq, rawfile_metadata, evidence_mq,
+                                                    allpeptides_mq]):
+            checkpoints.save('maxquant', name, table)
+        checkpoints.save('maxquant', 'dictionaries', (raw_file_dictionary, modified_sequence_dictionary,
+                                                      transfer_columns, msms_columns, evidence_columns))
+        checkpoints.finish('maxquant')
+
+        annotation_index, scan_index_folder = build_annotation_index(args, msmsscans_mq, msms_mq, raw_file_dictionary)
+
+    evidence_chunk_folder = None
+    if args.streaming_evidence:
+        (args.cache_folder / Path('evidence_chunks')).mkdir(exist_ok=True)
+        evidence_chunk_folder = Path(tempfile.mkdtemp(dir=args.cache_folder / Path('evidence_chunks')))
+
+    background_stages.close()
+
+    stage_keys = {pval: get_stringency_stage_keys(checkpoints, args, pval, maxquant_key, cluster_result_folder)
+                  for pval in ['p' + str(i) for i in pvals]}
+
+    if resume_maxquant:
+        # only the tables used by the stages that run again are loaded
+        needs_annotation = any(not checkpoints.is_complete(f'annotation_{pval}', keys['annotation'])
+                               for pval, keys in stage_keys.items())
+        needs_evidence = not args.skip_evidence and any(
+            not checkpoints.is_complete(f'evidence_{pval}', keys['evidence']) for pval, keys in stage_keys.items())
+        needed = {'msmsScans': needs_annotation, 'msms': needs_annotation, 'rawfile_metadata': needs_annotation,
+                  'evidence': needs_evidence, 'allPeptides': needs_evidence}
+        with profiler.stage('loading checkpoint'):
+            msmsscans_mq, msms_mq, rawfile_metadata, evidence_mq, allpeptides_mq = [
+                checkpoints.load('maxquant', name) if needed[name] else None for name in MAXQUANT_ARTIFACTS]
+            raw_file_dictionary, modified_sequence_dictionary, transfer_columns, msms_columns, evidence_columns = \
+                checkpoints.load('maxquant', 'dictionaries')
+        # the dictionary was built from the raw files checked against msmsScans.txt when the checkpoint was written
+        check_raw_files(raw_file_dictionary, raw_filenames_input)
+        if needs_annotation:
+            annotation_index, scan_index_folder = build_annotation_index(args, msmsscans_mq, msms_mq,
+                                                                         raw_file_dictionary)
 
-    raw_filenames_mq = set(msmsscans_mq['Raw file'].unique())
-    if raw_filenames_mq != raw_filenames_input:
-        raise ValueError(
-            f'The raw files listed as input and the raw files in the MaxQuant search results are not the same!')
+    statistics = dict()
+    export_queue = simsi_output.ExportQueue(args.num_export_threads)
+    compression = Compression(args.compression, args.compression_level,
+                              args.compression_threads if args.compression_threads > 0 else args.num_threads)
 
-    if args.tmt_requantify:
-        logger.info(f'Extracting correct reporter ion intensities from .mzML files')
-        extracted_folder = args.cache_folder / Path('extracted')
-        tmt_processing.extract_tmt_reporters(mzml_files=mzml_files, output_path=extracted_folder,
-                                             correction_factor_paths=correction_factor_paths, plex=plex,
-                                             extraction_level=tmt_ms_level, num_threads=args.num_threads)
+    for pval, keys in stage_keys.items():
+        logger.info('')
 
-        corrected_tmt = tmt_processing.assemble_corrected_tmt_table(mzml_files, extracted_folder, plex)
-        msmsscans_mq = tmt_processing.merge_with_corrected_tmt(msmsscans_mq, corrected_tmt)
+        with profiler.stage(pval):
+            annotation_stage, transfer_stage, evidence_stage = \
+                f'annotation_{pval}', f'transfer_{pval}', f'evidence_{pval}'
+            needs_evidence = not args.skip_evidence and not checkpoints.is_complete(evidence_stage, keys['evidence'])
+            if checkpoints.is_complete(transfer_stage, keys['transfer']):
+                checkpoints.run(annotation_stage, keys['annotation'], annotate_stringency, args, pval,
+                                cluster_result_folder, msmsscans_mq, msms_mq, rawfile_metadata, raw_file_dictionary,
+                                annotation_index, checkpoints.export(annotation_stage, export_queue.submit),
+                                args.output_folder, compression, output_columns, needed=False)
+                msms_simsi = checkpoints.load(transfer_stage, RESULT) if needs_evidence else None
+                if 'statistics' in checkpoints.stages[transfer_stage]['artifacts']:
+                    statistics[pval] = checkpoints.load(transfer_stage, 'statistics')
+            else:
+                checkpoints.start(transfer_stage, keys['transfer'])
+                # the annotated clusters are passed on without keeping a reference, such that they can be freed
+                # after the transfer
+                msms_simsi = transfer_identifications(
+                    args, pval,
+                    checkpoints.run(annotation_stage, keys['annotation'], annotate_stringency, args, pval,
+                                    cluster_result_folder, msmsscans_mq, msms_mq, rawfile_metadata,
+                                    raw_file_dictionary, annotation_index,
+                                    checkpoints.export(annotation_stage, export_queue.submit), args.output_folder,
+                                    compression, output_columns),
+                    checkpoints.export(transfer_stage, export_queue.submit), args.output_folder, compression,
+                    output_columns, transfer_columns, msms_columns)
+                if msms_simsi is not None:
+                    statistics[pval] = simsi_output.count_clustering_parameters(msms_simsi)
+                    checkpoints.save(transfer_stage, RESULT, msms_simsi)
+                    checkpoints.save(transfer_stage, 'statistics', statistics[pval])
+                checkpoints.finish(transfer_stage)
+            if msms_simsi is None:
+                continue
+
+            if needs_evidence:
+                checkpoints.start(evidence_stage, keys['evidence'])
+                export = checkpoints.export(evidence_stage, export_queue.submit)
+                logger.info(f'Starting SIMSI-Transfer evidence.txt building for {pval}.')
+                msms_simsi = get_evidence_input(msms_simsi, raw_file_dictionary, modified_sequence_dictionary,
+                                                evidence_columns)
+                with cpu_budget.quota('evidence building') as num_threads, \
+                        profiler.stage('evidence', msms_simsi) as evidence_profile:
+                    if args.streaming_evidence:
+                        evidence_simsi = evidence.build_evidence_streamed(
+                            msms_simsi, evidence_mq, allpeptides_mq, plex, num_threads=num_threads,
+                            chunk_folder=evidence_chunk_folder / Path(pval), executor_backend=executor_backend)
+                    else:
+                        evidence_simsi = evidence.build_evidence_grouped(
+                            msms_simsi, evidence_mq, allpeptides_mq, plex, num_threads=num_threads,
+                            executor_backend=executor_backend)
+                        evidence_profile.output(evidence_simsi)
+                if args.streaming_evidence:
+                    export(simsi_output.export_simsi_evidence_chunks, evidence_simsi, args.output_folder,
+                           pval, args.output_format, compression, output_columns.get('evidence'))
+                else:
+                    export(simsi_output.export_simsi_evidence_file, evidence_simsi, args.output_folder, pval,
+                           args.output_format, compression, output_columns.get('evidence'))
+                checkpoints.finish(evidence_stage)
+                logger.info(f'Finished SIMSI-Transfer evidence.txt building.')
+                logger.info('')
+                del evidence_simsi
+
+            del msms_simsi
+
+    logger.info('Waiting for output files to be written.')
+    with profiler.stage('writing output tables'):
+        export_queue.close()
+    executor_backend.close()
+
+    del annotation_index
+    if scan_index_folder is not None:
+        shutil.rmtree(scan_index_folder, ignore_errors=True)
+    if evidence_chunk_folder is not None:
+        shutil.rmtree(evidence_chunk_folder, ignore_errors=True)
+
+    if args.cache_size_limit > 0:
+        used_files = mzml_files + [f for mzml_file in mzml_files for f in content_store.derived_files(mzml_file)]
+        content_store.evict(int(args.cache_size_limit * 1e9), [mzml_folder, dat_files_folder, extracted_folder],
+                            used_files)
+    content_store.release()
 
-    logger.info(f'Reading in MaxQuant msms.txt file')
-    msms_mq = utils.process_and_concat(mq_txt_folders, mq.read_msms_txt)
-    if args.filter_decoys:
-        logger.info(f'Filtering out decoy hits')
-        msms_mq = msms_mq[msms_mq['Reverse'] != '+']
+    endtime = datetime.now()
+    logger.info(f'Successfully finished transfers for all stringencies.')
+    logger.info('')
+    profiler.log_profile()
+    profiler.write_profile(args.output_folder / Path('SIMSI.profile.json'), version=__version__,
+                           wall_time=(endtime - starttime).total_seconds(), num_threads=args.num_threads,
+                           statistics=statistics)
+    logger.info(f"SIMSI-Transfer finished in {(endtime - starttime).total_seconds()} seconds (wall clock).")
 
-    logger.info(f'Reading in MaxQuant evidence.txt file')
-    evidence_mq = utils.process_and_concat(mq_txt_folders, mq.read_evidence_txt)
-    if args.filter_decoys:
-        logger.info(f'Filtering out decoy hits')
-        evidence_mq = evidence_mq[evidence_mq['Reverse'] != '+']
-    rawfile_metadata = mq.get_rawfile_metadata(evidence_mq)
 
-    logger.info(f'Reading in MaxQuant allPeptides.txt file')
-    allpeptides_mq = utils.process_and_concat(mq_txt_folders, mq.read_allpeptides_txt)
-    allpeptides_mq = mq.fill_missing_min_max_scans(allpeptides_mq, msmsscans_mq)
+def validate_args(args):
+    # Validate ms2/ms3 argument
+    if args.tmt_ms_level not in ["ms2", "ms3"]:
+        logger.error("Invalid ms_level argument. Expected 'ms2' or 'ms3'.")
+        sys.exit(1)
 
-    statistics = dict()
+    # Validate ambiguity_decision argument
+    valid_ambiguity_decisions = ["keep_all", "all", "majority"]
+    if args.ambiguity_decision not in valid_ambiguity_decisions:
+        logger.error(f"Invalid ambiguity_decision argument. Expected one of {valid_ambiguity_decisions}.")
+        sys.exit(1)
 
-    for pval in ['p' + str(i) for i in pvals]:
-        logger.info('')
+    # Validate compression argument
+    if args.compression not in COMPRESSION_METHODS:
+        logger.error(f"Invalid compression argument. Expected one of {COMPRESSION_METHODS}.")
+        sys.exit(1)
+
+    # Validate output_format argument
+    if args.output_format not in simsi_output.OUTPUT_FORMATS:
+        logger.error(f"Invalid output_format argument. Expected one of {simsi_output.OUTPUT_FORMATS}.")
+        sys.exit(1)
+
+    # Validate work_queue_folder and incremental_clustering arguments
+    if args.work_queue_folder is not None and args.num_threads_per_precursor_bin <= 0:
+        logger.error("The work_queue_folder argument requires num_threads_per_precursor_bin to be set.")
+        sys.exit(1)
+    if args.incremental_clustering and args.num_threads_per_precursor_bin <= 0:
+        logger.error("The incremental_clustering argument requires num_threads_per_precursor_bin to be set.")
+        sys.exit(1)
+
+    # Validate executor arguments
+    if args.executor not in EXECUTOR_BACKENDS:
+        logger.error(f"Invalid executor argument. Expected one of {EXECUTOR_BACKENDS}.")
+        sys.exit(1)
+    if args.executor == 'shared_fs' and args.executor_queue_folder is None:
+        logger.error("The shared_fs executor requires the executor_queue_folder argument to be set.")
+        sys.exit(1)
 
-        logger.info(f'Starting MaxQuant and MaRaCluster file merge for {pval}.')
 
-        cluster_results = cluster.read_cluster_results(cluster_result_folder, pval)
-        annotated_clusters = simsi_output.annotate_clusters(msmsscans_mq, msms_mq, rawfile_metadata, cluster_results)
-        del cluster_results
+def read_msmsscans(args, mq_txt_folders, plex, raw_filenames_input):
+    """
+    Reads msmsScans.txt of all MaxQuant searches and checks that they contain the input raw files
+    :return: msmsScans.txt dataframe with scan keys and the raw file dictionary of the scan keys
+    """
+    logger.info(f'Reading in MaxQuant msmsscans.txt file')
+    msmsscans_mq = profiler.call('reading msmsScans.txt', utils.process_and_concat, mq_txt_folders,
+                                 mq.read_msmsscans_txt, tmt_requantify=args.tmt_requantify, plex=plex,
+                                 dictionary_encode=args.memory_lean)
 
-        if not args.skip_annotated_clusters:
-            simsi_output.export_annotated_clusters(annotated_clusters, args.output_folder, pval)
-        logger.info(f'Finished file merge.')
+    check_raw_files(msmsscans_mq['Raw file'].unique(), raw_filenames_input)
 
-        if args.skip_msmsscans and args.skip_msms and args.skip_evidence:
-            del annotated_clusters
-            continue
+    raw_file_dictionary = mf.get_raw_file_dictionary(raw_filenames_input)
+    msmsscans_mq = mf.add_scan_keys(msmsscans_mq, raw_file_dictionary)
+    return msmsscans_mq, raw_file_dictionary
 
-        logger.info(f'Starting cluster-based identity transfer for {pval}.')
-        annotated_clusters = transfer.flag_ambiguous_clusters(annotated_clusters)
-        msmsscans_simsi = transfer.transfer(annotated_clusters, ambiguity_decision=args.ambiguity_decision, max_pep=args.maximum_pep)
-        del annotated_clusters
 
-        if not args.skip_msmsscans:
-            simsi_output.export_msmsscans(msmsscans_simsi, args.output_folder, pval)
-        logger.info(f'Finished identity transfer.')
+def check_raw_files(raw_filenames_mq, raw_filenames_input):
+    """
+    Checks that the MaxQuant search results contain exactly the input raw files
+    :param raw_filenames_mq: raw file names in the MaxQuant search results
+    :param raw_filenames_input: raw file names without path or extension of the input raw files
+    """
+    if set(raw_filenames_mq) != set(raw_filenames_input):
+        raise ValueError(
+            f'The raw files listed as input and the raw files in the MaxQuant search results are not the same!')
 
-        if args.skip_msms and args.skip_evidence:
-            del msmsscans_simsi
-            continue
 
-        logger.info(f'Building SIMSI-Transfer msms.txt file for {pval}.')
-        msms_simsi = simsi_output.remove_unidentified_scans(msmsscans_simsi)
-        del msmsscans_simsi
-        
-        if args.add_plotting_columns:
-            raise NotImplementedError()
-        
-        if not args.skip_msms:
-            simsi_output.export_msms(msms_simsi, args.output_folder, pval)
-        logger.info(f'Finished SIMSI-Transfer msms.txt assembly.')
+def add_corrected_tmt(msmsscans_mq, mzml_files, extracted_folder, plex, raw_file_dictionary):
+    """
+    Replaces the reporter ion intensities of msmsScans.txt by the extracted reporter ion intensities
+    """
+    corrected_tmt = tmt_processing.assemble_corrected_tmt_table(mzml_files, extracted_folder, plex)
+    corrected_tmt = mf.add_scan_keys(corrected_tmt, raw_file_dictionary)
+    return tmt_processing.merge_with_corrected_tmt(msmsscans_mq, corrected_tmt)
 
-        statistics[pval] = simsi_output.count_clustering_parameters(msms_simsi)
 
-        if not args.skip_evidence:
-            logger.info(f'Starting SIMSI-Transfer evidence.txt building for {pval}.')
-            evidence_simsi = evidence.build_evidence_grouped(msms_simsi, evidence_mq, allpeptides_mq, plex, num_threads=args.num_threads)
-            simsi_output.export_simsi_evidence_file(evidence_simsi, args.output_folder, pval)
-            logger.info(f'Finished SIMSI-Transfer evidence.txt building.')
-            logger.info('')
-            del evidence_simsi
+def read_maxquant_tables(args, mq_txt_folders, msmsscans_mq, raw_file_dictionary):
+    """
+    Reads msms.txt, evidence.txt and allPeptides.txt of all MaxQuant searches
+    :return: msms.txt, evidence.txt and allPeptides.txt dataframes, the raw file metadata and the modified sequence
+             dictionary of the precursor keys
+    """
+    logger.info(f'Reading in MaxQuant msms.txt file')
+    msms_mq = profiler.call('reading msms.txt', utils.process_and_concat, mq_txt_folders, mq.read_msms_txt,
+                            dictionary_encode=args.memory_lean)
+    if args.filter_decoys:
+        logger.info(f'Filtering out decoy hits')
+        msms_mq = msms_mq[msms_mq['Reverse'] != '+']
+    msms_mq = mf.add_scan_keys(msms_mq, raw_file_dictionary)
 
-        del msms_simsi
+    logger.info(f'Reading in MaxQuant evidence.txt file')
+    evidence_mq = profiler.call('reading evidence.txt', utils.process_and_concat, mq_txt_folders,
+                                mq.read_evidence_txt, dictionary_encode=args.memory_lean)
+    if args.filter_decoys:
+        logger.info(f'Filtering out decoy hits')
+        evidence_mq = evidence_mq[evidence_mq['Reverse'] != '+']
+    rawfile_metadata = mq.get_rawfile_metadata(evidence_mq)
+    modified_sequence_dictionary = mf.get_modified_sequence_dictionary(evidence_mq)
+    evidence_mq = mf.add_precursor_keys(evidence_mq, raw_file_dictionary, modified_sequence_dictionary)
 
-    endtime = datetime.now()
-    logger.info(f'Successfully finished transfers for all stringencies.')
-    logger.info('')
-    logger.info(f"SIMSI-Transfer finished in {(endtime - starttime).total_seconds()} seconds (wall clock).")
+    logger.info(f'Reading in MaxQuant allPeptides.txt file')
+    allpeptides_mq = profiler.call('reading allPeptides.txt', utils.process_and_concat, mq_txt_folders,
+                                   mq.read_allpeptides_txt, dictionary_encode=args.memory_lean)
+    allpeptides_mq = profiler.call('filling missing scans', mq.fill_missing_min_max_scans, allpeptides_mq,
+                                   msmsscans_mq)
+
+    if args.memory_lean:
+        logger.info(f'Sharing string dictionaries across MaxQuant tables')
+        utils.unify_categories([msmsscans_mq, msms_mq, evidence_mq, allpeptides_mq, rawfile_metadata])
+
+    return msms_mq, evidence_mq, allpeptides_mq, rawfile_metadata, modified_sequence_dictionary
+
+
+def transfer_stringency(args, pval, cluster_result_folder, msmsscans_mq, msms_mq, rawfile_metadata,
+                        raw_file_dictionary, annotation_index, export, output_folder, compression, output_columns,
+                        transfer_columns=None, msms_columns=None):
+    """
+    Annotates the clusters of one stringency and transfers the identifications within the clusters
+    :param export: called with an export function and its arguments for every output table, e.g. to write the
+                   tables in the background
+    :param transfer_columns: columns needed after the cluster annotation, None to keep all columns
+    :param msms_columns: columns needed after the identity transfer, None to keep all columns
+    :return: SIMSI-Transfer msms.txt dataframe, or None if neither msms.txt nor evidence.txt are requested
+    """
+    # the annotated clusters are passed on without keeping a reference, such that they can be freed after the transfer
+    return transfer_identifications(args, pval,
+                                    annotate_stringency(args, pval, cluster_result_folder, msmsscans_mq, msms_mq,
+                                                        rawfile_metadata, raw_file_dictionary, annotation_index,
+                                                        export, output_folder, compression, output_columns),
+                                    export, output_folder, compression, output_columns, transfer_columns,
+                                    msms_columns)
+
+
+def annotate_stringency(args, pval, cluster_result_folder, msmsscans_mq, msms_mq, rawfile_metadata,
+                        raw_file_dictionary, annotation_index, export, output_folder, compression, output_columns):
+    """
+    Annotates the clusters of one stringency with the MaxQuant identifications
+    :return: annotated clusters dataframe
+    """
+    logger.info(f'Starting MaxQuant and MaRaCluster file merge for {pval}.')
+
+    cluster_results = profiler.call('reading clusters', cluster.read_cluster_results, cluster_result_folder, pval)
+    cluster_results = mf.add_scan_keys(cluster_results, raw_file_dictionary)
+    if args.memory_lean:
+        cluster_results['Raw file'] = cluster_results['Raw file'].astype(msmsscans_mq['Raw file'].dtype)
+    with profiler.stage('annotation', cluster_results) as annotation_profile:
+        annotated_clusters = simsi_output.annotate_clusters(msmsscans_mq, msms_mq, rawfile_metadata,
+                                                            cluster_results, annotation_index)
+        annotation_profile.output(annotated_clusters)
+    del cluster_results
+
+    if not args.skip_annotated_clusters:
+        export(simsi_output.export_annotated_clusters, annotated_clusters, output_folder, pval,
+               args.output_format, compression, output_columns.get('annotated_clusters'))
+    logger.info(f'Finished file merge.')
+    return annotated_clusters
+
+
+def transfer_identifications(args, pval, annotated_clusters, export, output_folder, compression, output_columns,
+                             transfer_columns=None, msms_columns=None):
+    """
+    Transfers the identifications within the annotated clusters of one stringency
+    :return: SIMSI-Transfer msms.txt dataframe, or None if neither msms.txt nor evidence.txt are requested
+    """
+    if args.skip_msmsscans and args.skip_msms and args.skip_evidence:
+        return None
+
+    logger.info(f'Starting cluster-based identity transfer for {pval}.')
+    if transfer_columns is not None:
+        annotated_clusters = simsi_output.drop_unused_columns(annotated_clusters, transfer_columns)
+    annotated_clusters = profiler.call('flagging', transfer.flag_ambiguous_clusters, annotated_clusters)
+    msmsscans_simsi = profiler.call('transfer', transfer.transfer, annotated_clusters,
+                                    ambiguity_decision=args.ambiguity_decision, max_pep=args.maximum_pep)
+    del annotated_clusters
+
+    if not args.skip_msmsscans:
+        export(simsi_output.export_msmsscans, msmsscans_simsi, output_folder, pval,
+               args.output_format, compression, output_columns.get('msmsScans'))
+    logger.info(f'Finished identity transfer.')
+
+    if args.skip_msms and args.skip_evidence:
+        return None
+
+    logger.info(f'Building SIMSI-Transfer msms.txt file for {pval}.')
+    if msms_columns is not None:
+        msmsscans_simsi = simsi_output.drop_unused_columns(msmsscans_simsi, msms_columns)
+    msms_simsi = profiler.call('msms assembly', simsi_output.remove_unidentified_scans, msmsscans_simsi)
+    del msmsscans_simsi
+
+    if args.add_plotting_columns:
+        raise NotImplementedError()
+
+    if not args.skip_msms:
+        export(simsi_output.export_msms, msms_simsi, output_folder, pval, args.output_format,
+               compression, output_columns.get('msms'))
+    logger.info(f'Finished SIMSI-Transfer msms.txt assembly.')
+    return msms_simsi
+
+
+def build_annotation_index(args, msmsscans_mq, msms_mq, raw_file_dictionary):
+    """
+    :return: annotation index and the folder of its memory-mapped files, None if it is held in memory
+    """
+    scan_index_folder = None
+    if args.memory_map_scan_index:
+        (args.cache_folder / Path('scan_index')).mkdir(exist_ok=True)
+        scan_index_folder = Path(tempfile.mkdtemp(dir=args.cache_folder / Path('scan_index')))
+    with profiler.stage('annotation index', msmsscans_mq):
+        annotation_index = scan_index.build_annotation_index(msmsscans_mq, msms_mq, raw_file_dictionary,
+                                                             scan_index_folder)
+    return annotation_index, scan_index_folder
+
+
+def get_maxquant_stage_inputs(args, mq_txt_folders, raw_filenames_input, mzml_files, correction_factor_paths):
+    """
+    Returns the parameters and input files that change the MaxQuant tables after reading, requantification and
+    dropping unused columns
+    """
+    parameters = {name: getattr(args, name) for name in ['tmt_requantify', 'filter_decoys', 'memory_lean',
+                                                         'skip_annotated_clusters', 'skip_msmsscans', 'skip_msms',
+                                                         'skip_evidence']}
+    parameters['raw_files'] = ','.join(sorted(raw_filenames_input))
+    input_files = [mq_txt_folder / Path(f) for mq_txt_folder in mq_txt_folders for f in MAXQUANT_FILES]
+    if args.output_columns:
+        input_files.append(args.output_columns)
+    if args.tmt_requantify:
+        parameters['tmt_ms_level'] = args.tmt_ms_level
+        parameters['tmt_correction_files'] = ','.join(map(str, correction_factor_paths))
+        input_files += mzml_files + [path for path in set(correction_factor_paths) if path.is_file()]
+    return parameters, input_files
+
+
+def get_stringency_stage_keys(checkpoints, args, pval, maxquant_key, cluster_result_folder):
+    """
+    Returns the keys of the annotation, transfer and evidence stages of one stringency, each stage depends on the
+    previous one
+    """
+    export_parameters = {'output_folder': args.output_folder.resolve(), 'output_format': args.output_format,
+                         'compression': args.compression, 'compression_level': args.compression_level}
+    annotation_key = checkpoints.get_key(
+        {**export_parameters, 'pval': pval},
+        [cluster_result_folder / Path(f'MaRaCluster.clusters_{pval}.tsv')], [maxquant_key])
+    transfer_key = checkpoints.get_key(
+        {**export_parameters, 'ambiguity_decision': args.ambiguity_decision, 'maximum_pep': args.maximum_pep,
+         'add_plotting_columns': args.add_plotting_columns}, [], [annotation_key])
+    evidence_key = checkpoints.get_key(export_parameters, [], [transfer_key])
+    return {'annotation': annotation_key, 'transfer': transfer_key, 'evidence': evidence_key}
+
+
+def get_evidence_input(msms_simsi, raw_file_dictionary, modified_sequence_dictionary, evidence_columns=None):
+    """
+    Adds the precursor keys to the SIMSI-Transfer msms.txt dataframe for the evidence building
+    :param evidence_columns: columns needed for the evidence building, None to keep all columns
+    """
+    if evidence_columns is not None:
+        msms_simsi = simsi_output.drop_unused_columns(msms_simsi, evidence_columns)
+    return mf.add_precursor_keys(msms_simsi, raw_file_dictionary, modified_sequence_dictionary)
+
+
+def get_derived_cache_files(mzml_file, dat_files_folder, extracted_folder):
+    """
+    Returns the MaRaCluster dat file and extracted reporter ion intensities of an mzML file, which have to be created
+    again if the mzML file is replaced by the conversion of a changed .raw file.
+    """
+    return [dat_files_folder / Path(f'{mzml_file.stem}.dat'),
+            Path(tmt_processing.get_extracted_tmt_file_name(extracted_folder, mzml_file))]
+
+
+def get_required_columns(args, output_columns, plex, msmsscans_mq, msms_mq):
+    """
+    Determines the columns that each stage needs to carry, such that columns which are neither written to a requested
+    output table nor used internally are dropped as early as possible. Output tables without an --output_columns
+    entry need all columns.
+    :return: msmsScans.txt and msms.txt dataframes without unused columns, and the columns needed after the cluster
+             annotation, after the identity transfer and for the evidence building
+    """
+    def get_output_columns(table, skip):
+        return [] if skip else output_columns.get(table)
+
+    evidence_columns = simsi_output.get_required_columns(
+        [] if args.skip_evidence else evidence.get_required_columns(plex))
+    msms_columns = simsi_output.get_required_columns(
+        get_output_columns('msms', args.skip_msms), evidence_columns, simsi_output.STATISTICS_COLUMNS)
+    transfer_columns = simsi_output.get_required_columns(
+        get_output_columns('msmsScans', args.skip_msmsscans), msms_columns, transfer.REQUIRED_COLUMNS)
+    if args.skip_msmsscans and args.skip_msms and args.skip_evidence:
+        transfer_columns = set()
+    annotation_columns = simsi_output.get_required_columns(
+        get_output_columns('annotated_clusters', args.skip_annotated_clusters), transfer_columns,
+        ['Raw file', 'scanID'])
+
+    return (simsi_output.drop_unused_columns(msmsscans_mq, annotation_columns),
+            simsi_output.drop_unused_columns(msms_mq, annotation_columns),
+            transfer_columns, msms_columns, evidence_columns)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,37 @@
 from sys import platform
+import os
+import time
+import json
+import uuid
+import threading
+import hashlib
 import subprocess
 import logging
-from typing import List
+from typing import List, Optional
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.feather
 
 from .utils import subprocess_with_logger as subprocess
+from .utils.scheduler import ScheduledJob, run_scheduled, estimate_makespan
+from .utils.work_queue import WorkQueue, run_worker, HEARTBEAT_TIMEOUT, DONE
+from .cache import fingerprint_file
 
 logger = logging.getLogger(__name__)
 
+INDEX_MARKER = 'MaRaCluster.index.done'
+
+# seconds after which the p-value computation of a precursor bin is considered hung and stopped
+PRECURSOR_BIN_TIMEOUT = 10800
+
+# fraction of the running time of a precursor bin that is spread over its threads, the rest does not speed up with
+# more threads
+PRECURSOR_BIN_PARALLEL_FRACTION = 0.9
+
 
 def has_previous_run(mainpath: Path, mzml_files: List[Path], pvals: List[float]):
     if not (mainpath / Path(f'file_list.txt')).is_file():
@@ -32,13 +54,58 @@ def has_previous_run(mainpath: Path, mzml_files: List[Path], pvals: List[float])
     return True
 
 
-def read_cluster_results(mainpath, pval):
-    maracluster_df = pd.read_csv(mainpath / Path(f'MaRaCluster.clusters_{pval}.tsv'),
-                                 sep='\t', names=['Raw file', 'scanID', 'clusterID'], engine="pyarrow")
-    maracluster_df['Raw file'] = maracluster_df['Raw file'].apply(get_file_name)
+def read_cluster_results(mainpath, pval, use_binary_copy: bool = True):
+    """
+    Reads the MaRaCluster clusters file of a stringency. The first read stores a binary copy next to the clusters
+    file, which is used instead of the clusters file as long as it is newer than the clusters file.
+    :param mainpath: MaRaCluster output folder
+    :param pval: stringency of the clustering, e.g. p10
+    :param use_binary_copy: read from and write the binary copy
+    :return: dataframe with categorical 'Raw file' and int32 'scanID' and 'clusterID' columns
+    """
+    cluster_file = mainpath / Path(f'MaRaCluster.clusters_{pval}.tsv')
+    binary_file = mainpath / Path(f'MaRaCluster.clusters_{pval}.feather')
+    if use_binary_copy and binary_file.is_file() and binary_file.stat().st_mtime >= cluster_file.stat().st_mtime:
+        logger.debug(f'Reading binary copy {binary_file} of clusters file')
+        return pyarrow.feather.read_feather(binary_file)
+
+    maracluster_df = parse_cluster_file(cluster_file)
+    if use_binary_copy:
+        # write to a temporary file first, such that an interrupted write never leaves a truncated binary copy
+        tmp_file = binary_file.with_suffix('.feather.tmp')
+        pyarrow.feather.write_feather(maracluster_df, tmp_file)
+        os.replace(tmp_file, binary_file)
     return maracluster_df
 
 
+def parse_cluster_file(cluster_file: Path) -> pd.DataFrame:
+    """
+    Parses a MaRaCluster clusters file, mapping each distinct mzML path to its raw file name only once
+    :param cluster_file: tab-separated file with mzML path, scan number and cluster ID, without header
+    :return: dataframe with categorical 'Raw file' and int32 'scanID' and 'clusterID' columns
+    """
+    table = pyarrow.csv.read_csv(
+        cluster_file,
+        read_options=pyarrow.csv.ReadOptions(column_names=['Raw file', 'scanID', 'clusterID']),
+        parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={'Raw file': pa.dictionary(pa.int32(), pa.string()), 'scanID': pa.int32(),
+                          'clusterID': pa.int32()}))
+
+    raw_file_paths = table.column('Raw file').unify_dictionaries().combine_chunks()
+    path_codes = raw_file_paths.indices.to_numpy(zero_copy_only=False)
+    raw_files = np.array([get_file_name(p) for p in raw_file_paths.dictionary.to_pylist()], dtype=object)
+
+    # different paths can have the same file name, the categories are sorted to keep the sort order of strings
+    categories, raw_file_codes = np.unique(raw_files, return_inverse=True)
+    raw_file_codes = raw_file_codes.astype('int32')[path_codes] if len(path_codes) > 0 else path_codes
+    return pd.DataFrame({
+        'Raw file': pd.Categorical.from_codes(raw_file_codes, categories=categories),
+        'scanID': table.column('scanID').to_numpy(),
+        'clusterID': table.column('clusterID').to_numpy(),
+    })
+
+
 def get_file_name(raw_file):
     """
     Removes full path and file extension from file name in MaRaCluster column
@@ -48,32 +115,352 @@ def get_file_name(raw_file):
     return Path(raw_file).stem
 
 
-def cluster_mzml_files(mzml_files: List[Path], pvals: List[float], maracluster_folder: Path, dat_folder: Path, num_threads: int = 1, num_threads_per_precursor_bin: int = 0):
+def cluster_mzml_files(mzml_files: List[Path], pvals: List[float], maracluster_folder: Path, dat_folder: Path, num_threads: int = 1, num_threads_per_precursor_bin: int = 0, work_queue_folder: Optional[Path] = None, num_local_workers: int = 1, incremental: bool = False):
     """
     Runs maracluster on a list of mzML files
+
+    :param work_queue_folder: if given, the precursor bins are distributed to workers through a queue in this folder,
+                              which has to be on a file system shared with the workers just like maracluster_folder
+    :param num_local_workers: number of workers processing the queue in this process
+    :param incremental: reuse the dat files of mzML files that did not change and the p-values of precursor bins that
+                        did not receive new spectra since the previous run in maracluster_folder. The p-values of the
+                        reused bins are based on the peak counts of the previous run.
     """
     if not maracluster_folder.is_dir():
         maracluster_folder.mkdir(parents=True)
 
+    stale_dat_files = []
+    if incremental:
+        mzml_files = get_incremental_file_order(maracluster_folder, mzml_files)
+        stale_dat_files = remove_stale_dat_files(mzml_files, dat_folder)
+
     batch_file = create_batch_file(maracluster_folder, mzml_files)
     
     if num_threads_per_precursor_bin > 0:
-        from job_pool import JobPool
-        
-        run_maracluster_index(batch_file, maracluster_folder, dat_folder, num_threads)
+        index_key = get_index_key(batch_file, mzml_files)
+        # the spectra of mzML files with a removed dat file only reach the precursor bins through a new index
+        if len(stale_dat_files) == 0 and has_valid_index(maracluster_folder, index_key):
+            logger.info("Found MaRaCluster index of a previous run for the same mzML files, skipping indexing")
+        else:
+            if incremental:
+                # bins with unchanged dat files keep their completion markers
+                remove_marker_files(maracluster_folder, precursor_bins=False)
+            else:
+                remove_marker_files(maracluster_folder)
+            run_maracluster_index(batch_file, maracluster_folder, dat_folder, num_threads)
+            write_marker(maracluster_folder / Path(INDEX_MARKER), index_key)
+
+        if incremental:
+            write_dat_file_fingerprints(mzml_files, dat_folder)
 
         dat_bin_files = read_dat_bin_file_list(maracluster_folder)
-        
-        processingPool = JobPool(
-            processes=max([1, num_threads // num_threads_per_precursor_bin]), timeout=10800, write_progress_to_logger=True
-        )  # 10,8000 seconds = 3 hours
-        for dat_bin_file in dat_bin_files:
-            processingPool.applyAsync(run_maracluster_pvalue_precursor_bin, (maracluster_folder, dat_bin_file, num_threads_per_precursor_bin))
-        processingPool.checkPool(printProgressEvery=1)
+        if work_queue_folder is not None:
+            run_precursor_bins_distributed(maracluster_folder, dat_bin_files, work_queue_folder, num_threads,
+                                           num_threads_per_precursor_bin, num_local_workers)
+        else:
+            run_precursor_bins(maracluster_folder, dat_bin_files, num_threads, num_threads_per_precursor_bin)
 
     run_maracluster_batch(batch_file, pvals, maracluster_folder, dat_folder, num_threads)
 
 
+def get_incremental_file_order(maracluster_folder: Path, mzml_files: List[Path]) -> List[Path]:
+    """
+    Keeps the mzML files of the previous run in their previous order and appends new files, such that the file
+    indices that MaRaCluster assigns to the spectra of the previous files, and thereby their precursor bins, stay
+    the same
+    """
+    batch_file = maracluster_folder / Path('file_list.txt')
+    if not batch_file.is_file():
+        return mzml_files
+
+    with open(batch_file, 'r') as f:
+        previous_files = [Path(line.rstrip()) for line in f if len(line.rstrip()) > 0]
+    current_files = set(mzml_files)
+    ordered_files = [x for x in previous_files if x in current_files]
+    new_files = [x for x in mzml_files if x not in set(ordered_files)]
+    logger.info(f"Reusing the file order of the previous MaRaCluster run for {len(ordered_files)} mzML files, "
+                f"adding {len(new_files)} new mzML files")
+    return ordered_files + new_files
+
+
+def get_dat_file(dat_folder: Path, mzml_file: Path) -> Path:
+    return dat_folder / Path(f'{mzml_file.stem}.dat')
+
+
+def get_dat_file_marker(dat_file: Path) -> Path:
+    return dat_file.with_name(f'{dat_file.name}.json')
+
+
+def remove_stale_dat_files(mzml_files: List[Path], dat_folder: Path) -> List[Path]:
+    """
+    Removes dat files that were not created from the current version of their mzML file, or whose origin is unknown,
+    such that MaRaCluster reads the spectra from the mzML file again instead of reusing the dat file
+    :return: removed dat files
+    """
+    stale_dat_files = []
+    for mzml_file in mzml_files:
+        dat_file = get_dat_file(dat_folder, mzml_file)
+        if not dat_file.is_file():
+            continue
+        marker = read_marker(get_dat_file_marker(dat_file))
+        if marker is None or marker.get('mzml_fingerprint') != fingerprint_file(mzml_file):
+            logger.info(f"Removing {dat_file}, which does not belong to the current version of {mzml_file}")
+            dat_file.unlink()
+            stale_dat_files.append(dat_file)
+    return stale_dat_files
+
+
+def write_dat_file_fingerprints(mzml_files: List[Path], dat_folder: Path):
+    """
+    Records the fingerprint of the mzML file that each dat file was created from
+    """
+    for mzml_file in mzml_files:
+        dat_file = get_dat_file(dat_folder, mzml_file)
+        if dat_file.is_file():
+            write_marker(get_dat_file_marker(dat_file), {'mzml_fingerprint': fingerprint_file(mzml_file)})
+
+
+def run_precursor_bins(maracluster_folder: Path, dat_bin_files: List[str], num_threads: int, num_threads_per_precursor_bin: int):
+    """
+    Computes the p-values of the precursor bins longest first, using at most num_threads threads in total. The
+    running time of a bin is estimated from the size of its dat file, which is extremely skewed around common
+    precursor m/z values, so large bins get more threads and small bins fewer. A bin that takes longer than
+    PRECURSOR_BIN_TIMEOUT seconds is stopped and fails the run.
+    """
+    pending_bin_files = [x for x in dat_bin_files if not is_precursor_bin_done(maracluster_folder, x)]
+    if len(pending_bin_files) < len(dat_bin_files):
+        logger.info(f"Found p-values of {len(dat_bin_files) - len(pending_bin_files)} of {len(dat_bin_files)} "
+                    f"precursor bins from a previous run, skipping these bins")
+
+    jobs = get_precursor_bin_jobs(maracluster_folder, pending_bin_files, num_threads, num_threads_per_precursor_bin)
+    if len(jobs) == 0:
+        return
+
+    total_work = sum(job.duration * job.cost for job in jobs)
+    expected_makespan = estimate_makespan(jobs, max_workers=num_threads, budget=num_threads)
+    logger.info(f"Computing p-values for {len(jobs)} precursor bins with {min(job.cost for job in jobs)}-"
+                f"{max(job.cost for job in jobs)} threads per bin, the expected makespan is "
+                f"{expected_makespan / (total_work / num_threads):.2f} times the ideal makespan")
+
+    start_time = time.time()
+    bin_times = run_scheduled(jobs, max_workers=num_threads, budget=num_threads)
+    makespan = time.time() - start_time
+
+    # estimated work done per thread and second, measured on the finished bins
+    throughput = total_work / max(sum(t * job.cost for t, job in zip(bin_times, jobs)), 1e-9)
+    logger.info(f"Computed p-values for all precursor bins in {makespan:.1f} seconds, the expected makespan based on "
+                f"the measured throughput per thread was {expected_makespan / throughput:.1f} seconds and the ideal "
+                f"makespan was {total_work / num_threads / throughput:.1f} seconds")
+
+
+def run_precursor_bins_distributed(maracluster_folder: Path, dat_bin_files: List[str], work_queue_folder: Path, num_threads: int, num_threads_per_precursor_bin: int, num_local_workers: int = 1, heartbeat_timeout: float = HEARTBEAT_TIMEOUT, poll_interval: float = 5.0):
+    """
+    Computes the p-values of the precursor bins with workers on any number of nodes, which are started with
+    python -m simsi_transfer.maracluster worker --work_queue_folder <work_queue_folder>
+    The bins are queued longest first. Bins of workers that stop sending heartbeats are queued again.
+    """
+    pending_bin_files = [x for x in dat_bin_files if not is_precursor_bin_done(maracluster_folder, x)]
+    if len(pending_bin_files) < len(dat_bin_files):
+        logger.info(f"Found p-values of {len(dat_bin_files) - len(pending_bin_files)} of {len(dat_bin_files)} "
+                    f"precursor bins from a previous run, skipping these bins")
+
+    jobs = get_precursor_bin_jobs(maracluster_folder, pending_bin_files, num_threads, num_threads_per_precursor_bin)
+    if len(jobs) == 0:
+        return
+
+    queue = WorkQueue(work_queue_folder)
+    queue.create()
+    for rank, job in enumerate(sorted(jobs, key=lambda job: job.duration, reverse=True)):
+        folder, dat_bin_file, threads = job.args
+        queue.put(f'{rank:06d}_{dat_bin_file}', {'maracluster_folder': str(folder.absolute()),
+                                                 'dat_bin_file': dat_bin_file, 'num_threads': threads})
+    logger.info(f"Queued {len(jobs)} precursor bins in {work_queue_folder}, start workers with: "
+                f"python -m simsi_transfer.maracluster worker --work_queue_folder {work_queue_folder.absolute()}")
+
+    local_workers = [threading.Thread(target=run_worker, args=(queue, run_precursor_bin_task),
+                                      kwargs={'poll_interval': poll_interval}) for _ in range(num_local_workers)]
+    for worker in local_workers:
+        worker.start()
+
+    try:
+        done = 0
+        while done < len(jobs):
+            time.sleep(poll_interval)
+            for name in queue.requeue_stale(heartbeat_timeout):
+                logger.warning(f"Worker of precursor bin task {name} stopped responding, queueing it again")
+            failed_tasks = queue.get_failed_tasks()
+            if len(failed_tasks) > 0:
+                raise RuntimeError(f"Precursor bin tasks failed: {failed_tasks}")
+            if queue.count(DONE) > done:
+                done = queue.count(DONE)
+                logger.info(f"{done} / {len(jobs)} precursor bins done")
+    finally:
+        queue.close()
+        for worker in local_workers:
+            worker.join()
+
+    not_done = [x for x in pending_bin_files if not is_precursor_bin_done(maracluster_folder, x)]
+    if len(not_done) > 0:
+        raise RuntimeError(f"Workers did not complete the p-values of precursor bins {not_done}")
+
+
+def run_precursor_bin_task(task: dict):
+    run_precursor_bin(Path(task['maracluster_folder']), task['dat_bin_file'], task['num_threads'])
+
+
+def get_precursor_bin_jobs(maracluster_folder: Path, dat_bin_files: List[str], num_threads: int, num_threads_per_precursor_bin: int) -> List[ScheduledJob]:
+    """
+    Bins of average size get num_threads_per_precursor_bin threads, larger and smaller bins get proportionally more
+    or fewer threads, between 1 and num_threads. See estimate_precursor_bin_duration for the running time estimate.
+    """
+    sizes = [max((maracluster_folder / Path(dat_bin_file)).stat().st_size, 1) for dat_bin_file in dat_bin_files]
+    if len(sizes) == 0:
+        return []
+
+    mean_size = sum(sizes) / len(sizes)
+    jobs = []
+    for dat_bin_file, size in zip(dat_bin_files, sizes):
+        threads = min(num_threads, max(1, round(num_threads_per_precursor_bin * size / mean_size)))
+        jobs.append(ScheduledJob(run_precursor_bin, (maracluster_folder, dat_bin_file, threads), threads,
+                                 estimate_precursor_bin_duration(size, threads)))
+    return jobs
+
+
+def estimate_precursor_bin_duration(size: int, num_threads: int) -> float:
+    """
+    Estimates the running time of a precursor bin from the size of its dat file with Amdahl's law. With a linear
+    speedup, the estimates of bins whose number of threads is proportional to their size would all be about the
+    same, such that the largest bins would not be started first.
+    :return: relative running time estimate
+    """
+    return size * ((1 - PRECURSOR_BIN_PARALLEL_FRACTION) + PRECURSOR_BIN_PARALLEL_FRACTION / num_threads)
+
+
+def run_precursor_bin(maracluster_folder: Path, dat_bin_file: str, num_threads: int = 1) -> float:
+    """
+    Computes the p-values of a precursor bin and marks the bin as done, such that a rerun after a failure in a later
+    bin does not compute it again. The p-value tree is written to a file of its own for every attempt and only moved
+    into place once it is complete, such that neither the final MaRaCluster batch run nor a worker that takes over
+    the bin from a worker that stopped responding picks up a partial p-value tree.
+    :return: running time in seconds
+    """
+    start_time = time.time()
+    pvalue_tree_file = get_pvalue_tree_file(maracluster_folder, dat_bin_file)
+    attempt_tree_file = pvalue_tree_file.with_name(f'{pvalue_tree_file.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        run_maracluster_pvalue_precursor_bin(maracluster_folder, dat_bin_file, attempt_tree_file, num_threads)
+
+        if not is_valid_pvalue_tree(attempt_tree_file):
+            raise RuntimeError(f"MaRaCluster did not write a complete p-value tree for precursor bin {dat_bin_file}")
+        pvalue_tree_checksum = checksum_file(attempt_tree_file)
+        os.replace(attempt_tree_file, pvalue_tree_file)
+    finally:
+        if attempt_tree_file.is_file():
+            attempt_tree_file.unlink()
+
+    write_marker(get_precursor_bin_marker(maracluster_folder, dat_bin_file),
+                 {'dat_file': checksum_file(maracluster_folder / Path(dat_bin_file)),
+                  'pvalue_tree': pvalue_tree_checksum})
+    return time.time() - start_time
+
+
+def get_pvalue_tree_file(maracluster_folder: Path, dat_bin_file: str) -> Path:
+    return maracluster_folder / Path(f"{dat_bin_file}.pvalue_tree.tsv")
+
+
+def get_precursor_bin_marker(maracluster_folder: Path, dat_bin_file: str) -> Path:
+    return maracluster_folder / Path(f"{dat_bin_file}.done")
+
+
+def is_valid_pvalue_tree(pvalue_tree_file: Path) -> bool:
+    """
+    Checks that the p-value tree was written completely, i.e. it is not empty and ends with a full line
+    """
+    if not pvalue_tree_file.is_file() or pvalue_tree_file.stat().st_size == 0:
+        return False
+    with open(pvalue_tree_file, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def is_precursor_bin_done(maracluster_folder: Path, dat_bin_file: str) -> bool:
+    """
+    Checks if the p-values of a precursor bin were computed for the current spectra in the bin and were not
+    modified since
+    """
+    marker = read_marker(get_precursor_bin_marker(maracluster_folder, dat_bin_file))
+    pvalue_tree_file = get_pvalue_tree_file(maracluster_folder, dat_bin_file)
+    dat_file = maracluster_folder / Path(dat_bin_file)
+    if marker is None or not pvalue_tree_file.is_file() or not dat_file.is_file():
+        return False
+    if marker.get('dat_file') != checksum_file(dat_file):
+        return False
+    if marker.get('pvalue_tree') != checksum_file(pvalue_tree_file):
+        logger.warning(f"P-value tree of precursor bin {dat_bin_file} was modified or corrupted, computing it again")
+        return False
+    return True
+
+
+def get_index_key(batch_file: Path, mzml_files: List[Path]) -> dict:
+    """
+    Identifies the input of the MaRaCluster index by the list of mzML files and their contents, such that an mzML
+    file that is converted again under the same path, e.g. from a changed raw file, invalidates the index
+    """
+    return {'file_list': checksum_file(batch_file),
+            'mzml_files': {str(mzml_file): fingerprint_file(mzml_file) for mzml_file in mzml_files}}
+
+
+def has_valid_index(maracluster_folder: Path, index_key: dict) -> bool:
+    """
+    Checks if the index of a previous run was created for the same mzML files and all its files still exist
+    :param index_key: description of the current mzML files, see get_index_key
+    """
+    marker = read_marker(maracluster_folder / Path(INDEX_MARKER))
+    if marker != index_key:
+        return False
+    if not (maracluster_folder / "MaRaCluster.dat_file_list.txt").is_file() or \
+            not (maracluster_folder / "MaRaCluster.peak_counts.dat").is_file():
+        return False
+    return all((maracluster_folder / Path(x)).is_file() for x in read_dat_bin_file_list(maracluster_folder))
+
+
+def remove_marker_files(maracluster_folder: Path, precursor_bins: bool = True):
+    """
+    Removes the completion markers of the index and the precursor bins, e.g. before indexing a new list of mzML files
+    """
+    marker_files = [maracluster_folder / Path(INDEX_MARKER)]
+    if precursor_bins:
+        marker_files += maracluster_folder.glob('*.dat.done')
+    for marker_file in marker_files:
+        if marker_file.is_file():
+            marker_file.unlink()
+
+
+def write_marker(marker_file: Path, content: dict):
+    tmp_file = marker_file.with_name(marker_file.name + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_file, marker_file)
+
+
+def read_marker(marker_file: Path) -> Optional[dict]:
+    if not marker_file.is_file():
+        return None
+    try:
+        with open(marker_file) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def checksum_file(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def read_dat_bin_file_list(maracluster_folder: Path):
     with open(maracluster_folder / "MaRaCluster.dat_file_list.txt", "r") as f:
         return [Path(line[:-1]).name for line in f.readlines()]
@@ -83,15 +470,17 @@ def run_maracluster_index(batch_file: Path, maracluster_folder: Path, dat_folder
     run_maracluster(f'index --batch "{batch_file}" --output-folder "{maracluster_folder}" --dat-folder "{dat_folder}"', num_threads=num_threads)
 
 
-def run_maracluster_pvalue_precursor_bin(maracluster_folder: Path, dat_bin_file: str, num_threads: int = 1):
+def run_maracluster_pvalue_precursor_bin(maracluster_folder: Path, dat_bin_file: str, pvalue_tree_file: Path, num_threads: int = 1, timeout: Optional[float] = PRECURSOR_BIN_TIMEOUT):
     """Computes p-values for a dat file corresponding to a precursor m/z range, e.g. 356.dat
 
     Args:
         maracluster_folder (Path): _description_
         dat_bin_file (str): _description_
+        pvalue_tree_file (Path): file the p-value tree is written to
         num_threads (int, optional): _description_. Defaults to 1.
+        timeout (float, optional): seconds after which MaRaCluster is stopped. Defaults to PRECURSOR_BIN_TIMEOUT.
     """    
-    run_maracluster(f'pvalue --output-folder "{maracluster_folder}" --prefix "{dat_bin_file}" --specIn "{maracluster_folder}/{dat_bin_file}" --peakCountsFN "{maracluster_folder}/MaRaCluster.peak_counts.dat" --clusteringTree "{maracluster_folder}/{dat_bin_file}.pvalue_tree.tsv"', num_threads=num_threads)
+    run_maracluster(f'pvalue --output-folder "{maracluster_folder}" --prefix "{dat_bin_file}" --specIn "{maracluster_folder}/{dat_bin_file}" --peakCountsFN "{maracluster_folder}/MaRaCluster.peak_counts.dat" --clusteringTree "{pvalue_tree_file}"', num_threads=num_threads, timeout=timeout)
 
 
 def run_maracluster_batch(batch_file: Path, pvals: List[float], maracluster_folder: Path, dat_folder: Path, num_threads: int = 1):
@@ -102,9 +491,10 @@ def run_maracluster_batch(batch_file: Path, pvals: List[float], maracluster_fold
     run_maracluster(f'batch --batch "{batch_file}" --clusterThresholds {pvals_string} --output-folder "{maracluster_folder}" --dat-folder "{dat_folder}"', num_threads=num_threads)
 
 
-def run_maracluster(maracluster_cmd: str, num_threads: int = 1):
+def run_maracluster(maracluster_cmd: str, num_threads: int = 1, timeout: Optional[float] = None):
     """
     Runs maracluster on a list of mzML files
+    :param timeout: seconds after which maracluster is stopped, None to wait forever
     """
     num_threads_string = f"OMP_NUM_THREADS={num_threads}"
     if "win" in platform:
@@ -116,7 +506,7 @@ def run_maracluster(maracluster_cmd: str, num_threads: int = 1):
         exec_bin = f"{exec_path}\\utils\\maracluster\\win64\\maracluster"
         
     cluster_command = f'{num_threads_string} "{exec_bin}" {maracluster_cmd} 2>&1'
-    process = subprocess.run(cluster_command)
+    process = subprocess.run(cluster_command, timeout=timeout)
 
 
 def create_batch_file(maracluster_folder: Path, mzml_files: List[Path]):
@@ -125,3 +515,47 @@ def create_batch_file(maracluster_folder: Path, mzml_files: List[Path]):
         for mzml_file in mzml_files:
             w.write(str(mzml_file) + "\n")
     return batch_file
+
+
+if __name__ == "__main__":
+    from sys import argv
+    import argparse
+    from .command_line_interface import ArgumentParserWithLogger
+    from . import __version__, __copyright__
+
+    # use the package logger instead of just __main__ when running as a module
+    logger = logging.getLogger(__package__ + ".maracluster")
+
+    desc = f'SIMSI-maracluster-worker version {__version__}\n{__copyright__}'
+    apars = ArgumentParserWithLogger(
+        description=desc, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    apars.add_argument('command', choices=['worker'],
+                       help='''
+                       worker: computes precursor bin p-values queued by a SIMSI-Transfer run with --work_queue_folder.
+                       ''')
+
+    apars.add_argument('--work_queue_folder', type=Path, required=True, metavar="DIR",
+                       help='''Work queue folder on the shared file system.''')
+
+    apars.add_argument('--num_threads', type=int, default=0, metavar='N',
+                       help='''Number of threads per precursor bin. Set to 0 to use the number of threads assigned by the coordinator.''')
+
+    apars.add_argument('--poll_interval', type=float, default=5.0, metavar='S',
+                       help='''Seconds between checks for new tasks.''')
+
+    apars.add_argument('--exit_when_empty', default=False, action='store_true',
+                       help='''Exit as soon as no tasks are pending or running, instead of waiting until the coordinator closes the queue.''')
+
+    args = apars.parse_args(argv[1:])
+
+    logger.info(f'{desc}')
+    logger.info(f'Issued command: {os.path.basename(__file__)} {" ".join(map(str, argv))}')
+
+    def handler(task: dict):
+        if args.num_threads > 0:
+            task['num_threads'] = args.num_threads
+        run_precursor_bin_task(task)
+
+    run_worker(WorkQueue(args.work_queue_folder), handler, poll_interval=args.poll_interval,
+               exit_when_empty=args.exit_when_empty)
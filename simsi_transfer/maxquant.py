@@ -8,6 +8,26 @@ import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# string columns that are loaded as categoricals in memory-lean mode, see utils.unify_categories
+DICTIONARY_ENCODED_COLUMNS = [
+    "Raw file",
+    "Modified sequence",
+    "Sequence",
+    "Proteins",
+    "Gene Names",
+    "Protein Names",
+    "Experiment",
+]
+
+
+def get_column_dtypes(columns, dictionary_encode):
+    if not dictionary_encode:
+        return columns
+    return {
+        c: "category" if c in DICTIONARY_ENCODED_COLUMNS and t == "object" else t
+        for c, t in columns.items()
+    }
+
 
 def get_plex(input_folders):
     columns = pd.read_csv(
@@ -20,12 +40,13 @@ def get_plex(input_folders):
     return plex_number
 
 
-def read_msmsscans_txt(mq_txt_folder, tmt_requantify, plex):
+def read_msmsscans_txt(mq_txt_folder, tmt_requantify, plex, dictionary_encode=False):
     """
     Open msms.txt output file and subselect relevant columns
     :param mq_txt_folder: Processing path containing the 'combined' folder from MQ search
     :param tmt_requantify: Boolean indicating whether TMT reporter intensities need to be corrected later on
     :param plex: Number of TMT channels used in the experiment
+    :param dictionary_encode: Load string columns as categoricals to reduce memory usage
     :return: truncated msmsscans.txt dataframe
     """
     columns = {
@@ -42,6 +63,7 @@ def read_msmsscans_txt(mq_txt_folder, tmt_requantify, plex):
         columns |= {
             f"Reporter intensity corrected {i}": "float32" for i in range(1, plex + 1)
         }
+    columns = get_column_dtypes(columns, dictionary_encode)
     msmsscans = pd.read_csv(
         mq_txt_folder / Path("msmsScans.txt"),
         sep="\t",
@@ -54,10 +76,11 @@ def read_msmsscans_txt(mq_txt_folder, tmt_requantify, plex):
     return msmsscans
 
 
-def read_msms_txt(mq_txt_folder):
+def read_msms_txt(mq_txt_folder, dictionary_encode=False):
     """
     Open msms.txt output file and subselect relevant columns
     :param mq_txt_folder: Processing path containing the 'combined' folder from MQ search
+    :param dictionary_encode: Load string columns as categoricals to reduce memory usage
     :return: truncated msms.txt dataframe
     """
     columns = {
@@ -81,6 +104,7 @@ def read_msms_txt(mq_txt_folder):
         "Delta score": "float32",
         "Reverse": "category",
     }
+    columns = get_column_dtypes(columns, dictionary_encode)
 
     columns_present = pd.read_csv(
         mq_txt_folder / Path("msms.txt"), nrows=0, sep="\t"
@@ -106,10 +130,11 @@ def read_msms_txt(mq_txt_folder):
     return msmstxt
 
 
-def read_evidence_txt(mq_txt_folder):
+def read_evidence_txt(mq_txt_folder, dictionary_encode=False):
     """
     Open msms.txt output file and subselect relevant columns
     :param mq_txt_folder: Processing path containing the 'combined' folder from MQ search
+    :param dictionary_encode: Load string columns as categoricals to reduce memory usage
     :return: truncated evidence.txt dataframe
     """
     columns = {
@@ -130,6 +155,7 @@ def read_evidence_txt(mq_txt_folder):
         "Intensity": "float32",
         "Reverse": "category",
     }
+    columns = get_column_dtypes(columns, dictionary_encode)
 
     columns_present = pd.read_csv(
         mq_txt_folder / Path("evidence.txt"), nrows=0, sep="\t"
@@ -147,10 +173,11 @@ def read_evidence_txt(mq_txt_folder):
     return evidence
 
 
-def read_allpeptides_txt(mq_txt_folder):
+def read_allpeptides_txt(mq_txt_folder, dictionary_encode=False):
     """
     Open msms.txt output file and subselect relevant columns
     :param mq_txt_folder: Processing path containing the 'combined' folder from MQ search
+    :param dictionary_encode: Load string columns as categoricals to reduce memory usage
     :return: truncated evidence.txt dataframe
     """
     columns = {
@@ -164,6 +191,7 @@ def read_allpeptides_txt(mq_txt_folder):
         "Max scan number": "Int32",
         "Intensity": "float32",
     }
+    columns = get_column_dtypes(columns, dictionary_encode)
     allpeptides = pd.read_csv(
         mq_txt_folder / Path("allPeptides.txt"),
         sep="\t",
@@ -176,8 +204,11 @@ def read_allpeptides_txt(mq_txt_folder):
 
 def fill_missing_min_max_scans(allpeptides, msms):
     if allpeptides[['Min scan number', 'Max scan number']].isna().any().any():
-        msms_max_scans = msms.groupby('Raw file')['Precursor full scan number'].max()
-        allpeptides['Max scan number'].fillna(allpeptides['Raw file'].map(msms_max_scans), inplace=True)
+        msms_max_scans = msms.groupby('Raw file', observed=True)['Precursor full scan number'].max()
+        max_scans = allpeptides['Raw file'].map(msms_max_scans)
+        if isinstance(max_scans.dtype, pd.CategoricalDtype):
+            max_scans = max_scans.astype('float64')
+        allpeptides['Max scan number'].fillna(max_scans, inplace=True)
         allpeptides['Min scan number'].fillna(1, inplace=True)
         allpeptides['Max scan number'] = allpeptides['Max scan number'].astype("int32")
         allpeptides['Min scan number'] = allpeptides['Min scan number'].astype("int32")
@@ -1,5 +1,99 @@
+from typing import Iterable
+
+import numpy as np
 import pandas as pd
 
+# Packed join keys: (Raw file, scanID) pairs are stored as a single int64 with the raw file code in the
+# high bits and the scan number in the low 32 bits. (Modified sequence, Raw file, Charge) triples are packed
+# as modified sequence code | raw file code | charge. Codes are assigned once from global dictionaries at
+# load time, such that all merges can be performed as int64 hash joins instead of joins on object columns.
+SCAN_KEY = 'scan_key'
+PRECURSOR_KEY = 'precursor_key'
+KEY_COLUMNS = [SCAN_KEY, PRECURSOR_KEY]
+
+SCAN_BITS = 32
+CHARGE_BITS = 8
+RAW_FILE_BITS = 16
+
+
+def get_raw_file_dictionary(raw_files: Iterable[str]) -> pd.Index:
+    """
+    Creates the global raw file dictionary, the position of a raw file in the index is its code
+    :param raw_files: raw file names without path or extension
+    :return: sorted index of unique raw file names
+    """
+    raw_file_dictionary = pd.Index(sorted(set(raw_files)))
+    if len(raw_file_dictionary) >= 2 ** RAW_FILE_BITS:
+        raise ValueError(f'Cannot create join keys for more than {2 ** RAW_FILE_BITS - 1} raw files.')
+    return raw_file_dictionary
+
+
+def get_modified_sequence_dictionary(evidence_df: pd.DataFrame) -> pd.Index:
+    """
+    Creates the global modified sequence dictionary from the MaxQuant evidence.txt dataframe
+    :param evidence_df: MaxQuant evidence.txt dataframe
+    :return: index of unique modified sequences
+    """
+    return pd.Index(np.asarray(evidence_df['Modified sequence'].dropna().unique()), dtype=object)
+
+
+def get_codes(values: pd.Series, dictionary: pd.Index) -> np.ndarray:
+    """
+    Looks up the codes of values in a dictionary, values missing from the dictionary get code -1
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # only look up each category once
+        category_codes = np.append(dictionary.get_indexer(values.cat.categories), -1)
+        return category_codes[values.cat.codes.to_numpy()].astype('int64')
+    return pd.Categorical(values, categories=dictionary).codes.astype('int64')
+
+
+def add_scan_keys(df: pd.DataFrame, raw_file_dictionary: pd.Index) -> pd.DataFrame:
+    """
+    Adds the packed (Raw file, scanID) join key column
+    :param df: dataframe with 'Raw file' and 'scanID' columns
+    :param raw_file_dictionary: global raw file dictionary, see get_raw_file_dictionary
+    :return: dataframe with additional scan_key column
+    """
+    raw_file_codes = get_codes(df['Raw file'], raw_file_dictionary)
+    if (raw_file_codes < 0).any():
+        unknown_raw_files = df.loc[raw_file_codes < 0, 'Raw file'].unique()
+        raise ValueError(f'Found raw files that are not part of the input: {unknown_raw_files}')
+    df[SCAN_KEY] = (raw_file_codes << SCAN_BITS) | df['scanID'].to_numpy().astype('int64')
+    return df
+
+
+def add_precursor_keys(df: pd.DataFrame, raw_file_dictionary: pd.Index,
+                       modified_sequence_dictionary: pd.Index) -> pd.DataFrame:
+    """
+    Adds the packed (Modified sequence, Raw file, Charge) join key column. Rows with a modified sequence or raw file
+    that is not in the dictionaries get key -1, merge_summary_with_evidence drops these rows from the evidence.txt
+    dataframe, such that they do not match summary rows with key -1.
+    :param df: dataframe with 'Modified sequence', 'Raw file' and 'Charge' columns
+    :param raw_file_dictionary: global raw file dictionary, see get_raw_file_dictionary
+    :param modified_sequence_dictionary: global modified sequence dictionary, see get_modified_sequence_dictionary
+    :return: dataframe with additional precursor_key column
+    """
+    modified_sequence_codes = get_codes(df['Modified sequence'], modified_sequence_dictionary)
+    raw_file_codes = get_codes(df['Raw file'], raw_file_dictionary)
+    # charge 0 does not exist, so missing charge states cannot match
+    charges = pd.to_numeric(df['Charge'], errors='coerce').fillna(0).to_numpy().astype('int64')
+
+    keys = (((modified_sequence_codes << RAW_FILE_BITS) | raw_file_codes) << CHARGE_BITS) | charges
+    keys[(modified_sequence_codes < 0) | (raw_file_codes < 0)] = -1
+    df[PRECURSOR_KEY] = keys
+    return df
+
+
+def merge_on_scan(left: pd.DataFrame, right: pd.DataFrame, **kwargs) -> pd.DataFrame:
+    """
+    Merges two dataframes on (Raw file, scanID), using the packed scan_key column if both dataframes have it
+    """
+    if SCAN_KEY in left.columns and SCAN_KEY in right.columns:
+        right = right[[c for c in right.columns if c not in ['Raw file', 'scanID']]]
+        return pd.merge(left=left, right=right, on=SCAN_KEY, **kwargs)
+    return pd.merge(left=left, right=right, on=['Raw file', 'scanID'], **kwargs)
+
 
 def merge_with_msmstxt(tempfile, msms_df):
     """
@@ -9,7 +103,7 @@ def merge_with_msmstxt(tempfile, msms_df):
     :param msms_df: MaxQuant msms.txt dataframe
     :return: Merged dataframe
     """
-    return pd.merge(left=tempfile, right=msms_df, on=['Raw file', 'scanID'], how='left')
+    return merge_on_scan(tempfile, msms_df, how='left')
 
 
 def merge_with_msmsscanstxt(tempfile, msmsscans_df):
@@ -20,7 +114,7 @@ def merge_with_msmsscanstxt(tempfile, msmsscans_df):
     :param msmsscans_df: MaxQuant msmsscans.txt dataframe
     :return: Merged dataframe
     """
-    return pd.merge(left=tempfile, right=msmsscans_df, on=['Raw file', 'scanID'], how='left')
+    return merge_on_scan(tempfile, msmsscans_df, how='left')
 
 
 def merge_with_summarytxt(tempfile, summary_df):
@@ -43,7 +137,12 @@ def merge_summary_with_evidence(summary: pd.DataFrame, evidence: pd.DataFrame):
     '''
     merge_columns = ['evidence_ID', 'Modified sequence', 'Raw file', 'Charge', 'Leading proteins', 'Type', 'Calibrated retention time',
                      'Calibrated retention time start', 'Calibrated retention time finish', 'Retention time calibration', 'Intensity']
+    if PRECURSOR_KEY in summary.columns and PRECURSOR_KEY in evidence.columns:
+        merge_columns = [c for c in merge_columns if c not in ['Modified sequence', 'Raw file', 'Charge']]
+        # evidence rows with a missing or unknown modified sequence or raw file would match all summary rows with key -1
+        evidence = evidence.loc[evidence[PRECURSOR_KEY] >= 0, merge_columns + [PRECURSOR_KEY]]
+        return pd.merge(left=summary, right=evidence, on=PRECURSOR_KEY, how='left')
     evidence = evidence[merge_columns]
     summary = pd.merge(left=summary, right=evidence, left_on=['Modified sequence', 'Raw file', 'Charge'],
                        right_on=['Modified sequence', 'Raw file', 'Charge'], how='left')
-    return summary
\ No newline at end of file
+    return summary
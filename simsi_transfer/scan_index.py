@@ -0,0 +1,135 @@
+import logging
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from .merging_functions import SCAN_KEY, SCAN_BITS
+
+logger = logging.getLogger(__name__)
+
+SCAN_MASK = (1 << SCAN_BITS) - 1
+
+
+class DenseScanIndex:
+    """
+    Maps packed (Raw file, scanID) keys to int32 values, e.g. row positions in a dataframe.
+
+    Scan numbers within a raw file are dense integers, so the values are stored as one array per raw file that is
+    indexed by scan number. All arrays are concatenated into a single values array, the start of the array of
+    each raw file is stored in offsets. Missing scans have value -1.
+    """
+
+    def __init__(self, offsets: np.ndarray, values: np.ndarray):
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def from_scan_keys(cls, scan_keys: np.ndarray, values: Optional[np.ndarray] = None):
+        """
+        Builds the index from packed scan keys, see merging_functions.add_scan_keys
+        :param scan_keys: unique packed scan keys
+        :param values: values to store for each key, defaults to the position of the key in scan_keys
+        :return: DenseScanIndex
+        """
+        scan_keys = np.asarray(scan_keys, dtype='int64')
+        if values is None:
+            values = np.arange(len(scan_keys), dtype='int32')
+
+        raw_file_codes = scan_keys >> SCAN_BITS
+        scans = scan_keys & SCAN_MASK
+
+        num_raw_files = int(raw_file_codes.max()) + 1 if len(scan_keys) > 0 else 0
+        max_scans = np.full(num_raw_files, -1, dtype='int64')
+        np.maximum.at(max_scans, raw_file_codes, scans)
+
+        offsets = np.zeros(num_raw_files + 1, dtype='int64')
+        np.cumsum(max_scans + 1, out=offsets[1:])
+
+        dense_values = np.full(offsets[-1], -1, dtype='int32')
+        dense_values[offsets[raw_file_codes] + scans] = values
+        return cls(offsets, dense_values)
+
+    def lookup(self, scan_keys: np.ndarray) -> np.ndarray:
+        """
+        Looks up the values of packed scan keys in O(1) per key
+        :param scan_keys: packed scan keys
+        :return: int32 array of values, -1 for keys that are not in the index
+        """
+        scan_keys = np.asarray(scan_keys, dtype='int64')
+        raw_file_codes = scan_keys >> SCAN_BITS
+        scans = scan_keys & SCAN_MASK
+
+        num_raw_files = len(self.offsets) - 1
+        found = (raw_file_codes >= 0) & (raw_file_codes < num_raw_files)
+        found[found] &= scans[found] < np.diff(self.offsets)[raw_file_codes[found]]
+
+        result = np.full(len(scan_keys), -1, dtype='int32')
+        result[found] = self.values[self.offsets[raw_file_codes[found]] + scans[found]]
+        return result
+
+    def to_memmap(self, index_file: Path):
+        """
+        Moves the values array to a memory-mapped file
+        :param index_file: path to the .npy file
+        """
+        np.save(index_file, self.values)
+        self.values = np.load(index_file, mmap_mode='r')
+
+
+class AnnotationIndex(NamedTuple):
+    raw_file_dictionary: pd.Index
+    msmsscans_index: DenseScanIndex
+    msms_index: DenseScanIndex
+
+
+def build_annotation_index(msmsscans_df: pd.DataFrame, msms_df: pd.DataFrame, raw_file_dictionary: pd.Index,
+                           index_folder: Optional[Path] = None) -> Optional[AnnotationIndex]:
+    """
+    Builds the dense scan indices of msmsScans.txt and msms.txt rows for simsi_output.annotate_clusters
+    :param msmsscans_df: MaxQuant msmsScans.txt dataframe with scan_key column
+    :param msms_df: MaxQuant msms.txt dataframe with scan_key column
+    :param raw_file_dictionary: global raw file dictionary, see merging_functions.get_raw_file_dictionary
+    :param index_folder: if set, the indices are stored as memory-mapped files in this folder
+    :return: AnnotationIndex, or None if the dataframes cannot be indexed by scan
+    """
+    if SCAN_KEY not in msmsscans_df.columns or SCAN_KEY not in msms_df.columns:
+        return None
+
+    for name, df in [('msmsScans.txt', msmsscans_df), ('msms.txt', msms_df)]:
+        if df[SCAN_KEY].duplicated().any():
+            logger.info(f'Found multiple rows per scan in {name}, falling back to merge-based cluster annotation')
+            return None
+
+    msmsscans_index = DenseScanIndex.from_scan_keys(msmsscans_df[SCAN_KEY].to_numpy())
+    msms_index = DenseScanIndex.from_scan_keys(msms_df[SCAN_KEY].to_numpy())
+
+    if index_folder is not None:
+        index_folder.mkdir(parents=True, exist_ok=True)
+        msmsscans_index.to_memmap(index_folder / 'msmsScans_index.npy')
+        msms_index.to_memmap(index_folder / 'msms_index.npy')
+
+    return AnnotationIndex(raw_file_dictionary, msmsscans_index, msms_index)
+
+
+def take_rows(df: pd.DataFrame, positions: np.ndarray) -> dict:
+    """
+    Takes rows from each column of a dataframe, positions of -1 result in missing values
+    :param df: input dataframe
+    :param positions: row positions
+    :return: dictionary of column name to array
+    """
+    columns = dict()
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_extension_array_dtype(values.dtype):
+            values = values.array
+        else:
+            values = values.to_numpy()
+        columns[column] = pd.api.extensions.take(values, positions, allow_fill=True)
+    return columns
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
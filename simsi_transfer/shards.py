@@ -0,0 +1,470 @@
+"""
+Splits a SIMSI-Transfer run into shards that can be submitted as separate jobs to a batch scheduler:
+
+    python -m simsi_transfer.shards plan <options of the run>
+    python -m simsi_transfer.shards convert --shard_index I <options of the run>    one shard per raw file
+    python -m simsi_transfer.shards extract --shard_index I <options of the run>    one shard per raw file
+    python -m simsi_transfer.shards cluster <options of the run>
+    python -m simsi_transfer.shards transfer --shard_index I <options of the run>   one shard per stringency
+    python -m simsi_transfer.shards evidence --shard_index I <options of the run>   one shard per raw file
+    python -m simsi_transfer.shards merge <options of the run>
+
+The options of the run are the same as for python -m simsi_transfer and have to be the same for all shards. Every
+shard writes a manifest of its input and output files to <output_folder>/shards/manifests, the merge assembles the
+summaries folder from the outputs of the transfer and evidence shards.
+"""
+import os
+import sys
+import json
+import pickle
+import logging
+import argparse
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import __version__, __copyright__
+from . import command_line_interface as cli
+from . import main as simsi
+from . import maxquant as mq
+from . import simsi_output
+from . import thermo_raw as raw
+from . import maracluster as cluster
+from . import scan_index
+from . import tmt_processing
+from . import evidence
+from .cache import ContentStore
+from .utils import utils
+from .utils.compression import Compression
+from .utils.executor import get_executor, write_pickle
+from .utils.table_writer import SortedChunks
+
+logger = logging.getLogger(__name__)
+
+SHARD_COMMANDS = ['plan', 'convert', 'extract', 'cluster', 'transfer', 'evidence', 'merge']
+
+
+class ShardRun(NamedTuple):
+    args: argparse.Namespace
+    raw_files: List[Path]
+    correction_factor_paths: List[Path]
+    mzml_files: List[Path]
+    mq_txt_folders: List[Path]
+    stringencies: List[int]
+    shard_folder: Path
+
+    @property
+    def pvals(self) -> List[str]:
+        return ['p' + str(i) for i in self.stringencies]
+
+    @property
+    def extracted_folder(self) -> Path:
+        return self.args.cache_folder / Path('extracted')
+
+    @property
+    def cluster_result_folder(self) -> Path:
+        return self.args.output_folder / Path('maracluster_output')
+
+
+class MaxQuantTables(NamedTuple):
+    msmsscans: pd.DataFrame
+    msms: pd.DataFrame
+    evidence: pd.DataFrame
+    allpeptides: pd.DataFrame
+    rawfile_metadata: pd.DataFrame
+    raw_file_dictionary: pd.Index
+    modified_sequence_dictionary: pd.Index
+    plex: int
+    output_columns: Dict[str, List[str]]
+    transfer_columns: Optional[set]
+    msms_columns: Optional[set]
+    evidence_columns: Optional[set]
+
+
+def main(argv):
+    shard_args, args = parse_args(argv)
+    simsi.validate_args(args)
+
+    run = get_shard_run(args)
+    (run.shard_folder / Path('logs')).mkdir(parents=True, exist_ok=True)
+    module_name = ".".join(__name__.split(".")[:-1])
+    file_logger = logging.FileHandler(
+        run.shard_folder / Path('logs') / Path(f'{shard_args.command}_{shard_args.shard_index}.log'))
+    file_logger.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger(module_name).addHandler(file_logger)
+
+    logger.info(f'SIMSI-Transfer version {__version__}')
+    logger.info(f'{__copyright__}')
+    logger.info(f'Issued command: {os.path.basename(__file__)} {" ".join(map(str, argv))}')
+
+    commands = {'plan': run_plan, 'convert': run_convert, 'extract': run_extract, 'cluster': run_cluster,
+                'transfer': run_transfer, 'evidence': run_evidence, 'merge': run_merge}
+    try:
+        commands[shard_args.command](run, shard_args.shard_index, shard_args.num_shards)
+    finally:
+        logging.getLogger(module_name).removeHandler(file_logger)
+        file_logger.close()
+
+
+def parse_args(argv) -> Tuple[argparse.Namespace, argparse.Namespace]:
+    """
+    :return: shard arguments and the options of the run, as parsed by command_line_interface.parse_args
+    """
+    desc = f'SIMSI-Transfer shards version {__version__}\n{__copyright__}'
+    apars = cli.ArgumentParserWithLogger(
+        description=desc, formatter_class=argparse.ArgumentDefaultsHelpFormatter, add_help=False)
+
+    apars.add_argument('command', choices=SHARD_COMMANDS,
+                       help='''
+                       plan: writes the number of shards of each command to <output_folder>/shards/plan.json.
+                       convert, extract, cluster, transfer, evidence: runs one shard of this stage.
+                       merge: assembles the summaries folder from the transfer and evidence shards.
+                       ''')
+
+    apars.add_argument('--shard_index', type=int, default=0, metavar='N',
+                       help='''
+                       Index of the shard to run, starting at 0.
+                       ''')
+
+    apars.add_argument('--num_shards', type=int, default=0, metavar='N',
+                       help='''
+                       Number of shards of the convert, extract and evidence commands, which split the raw files, and
+                       of the transfer command, which splits the stringencies. Set to 0 for one shard per raw file
+                       or stringency. Has to be the same for all shards of a command.
+                       ''')
+
+    shard_args, run_argv = apars.parse_known_args(argv)
+    return shard_args, cli.parse_args(run_argv)
+
+
+def get_shard_run(args: argparse.Namespace) -> ShardRun:
+    meta_input_df = cli.get_input_folders(args)
+    meta_input_df['raw_files'] = meta_input_df['raw_folder'].apply(raw.get_raw_files)
+    raw_files, correction_factor_paths = utils.get_raw_files_and_correction_factor_paths(meta_input_df)
+
+    # every shard has to see the raw files in the same order, independent of the order of the directory listing
+    order = sorted(range(len(raw_files)), key=lambda i: raw_files[i])
+    raw_files = [raw_files[i] for i in order]
+    correction_factor_paths = [correction_factor_paths[i] for i in order]
+
+    return ShardRun(args=args,
+                    raw_files=raw_files,
+                    correction_factor_paths=correction_factor_paths,
+                    mzml_files=raw.get_mzml_files(raw_files, args.cache_folder / Path('mzML')),
+                    mq_txt_folders=utils.convert_to_path_list(meta_input_df['mq_txt_folder']),
+                    stringencies=cli.parse_stringencies(args.stringencies),
+                    shard_folder=args.output_folder / Path('shards'))
+
+
+def get_num_shards(num_items: int, num_shards: int) -> int:
+    return num_items if num_shards == 0 else min(num_shards, num_items)
+
+
+def select_shard(items: List[Any], shard_index: int, num_shards: int) -> List[Tuple[int, Any]]:
+    """
+    Distributes the items round-robin over the shards
+    :return: items of the shard with their indices in the list of all items
+    """
+    num_shards = get_num_shards(len(items), num_shards)
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'Shard index {shard_index} is out of range, there are {num_shards} shards')
+    return [(i, item) for i, item in enumerate(items) if i % num_shards == shard_index]
+
+
+def get_manifest_file(run: ShardRun, command: str, shard_index: int) -> Path:
+    return run.shard_folder / Path('manifests') / Path(f'{command}_{shard_index:05d}.json')
+
+
+def write_manifest(run: ShardRun, command: str, shard_index: int, inputs: List[Path], outputs: List[Path],
+                   **content):
+    """
+    Records the input and output files of a finished shard
+    """
+    manifest_file = get_manifest_file(run, command, shard_index)
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = manifest_file.with_suffix('.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'command': command, 'shard_index': shard_index, 'inputs': list(map(str, inputs)),
+                   'outputs': list(map(str, outputs)), **content}, f, indent=2)
+    os.replace(tmp_file, manifest_file)
+    logger.info(f'Finished {command} shard {shard_index}, wrote manifest {manifest_file}')
+
+
+def read_manifests(run: ShardRun, command: str) -> List[dict]:
+    manifests = []
+    for manifest_file in sorted((run.shard_folder / Path('manifests')).glob(f'{command}_*.json')):
+        with open(manifest_file) as f:
+            manifests.append(json.load(f))
+    return manifests
+
+
+def check_inputs(files: List[Path], command: str, previous_command: str):
+    missing = [f for f in files if not f.is_file()]
+    if len(missing) > 0:
+        raise FileNotFoundError(f'Missing {len(missing)} input files of the {command} shard, run the '
+                                f'{previous_command} shards first: {list(map(str, missing[:5]))}')
+
+
+def run_plan(run: ShardRun, shard_index: int, num_shards: int):
+    num_raw_file_shards = get_num_shards(len(run.raw_files), num_shards)
+    plan = {'convert': num_raw_file_shards,
+            'extract': num_raw_file_shards if run.args.tmt_requantify else 0,
+            'cluster': 1,
+            'transfer': get_num_shards(len(run.stringencies), num_shards),
+            'evidence': 0 if run.args.skip_evidence else num_raw_file_shards,
+            'merge': 1}
+
+    run.shard_folder.mkdir(parents=True, exist_ok=True)
+    with open(run.shard_folder / Path('plan.json'), 'w') as f:
+        json.dump({'num_shards': num_shards, 'shards': plan}, f, indent=2)
+
+    for command, count in plan.items():
+        if count > 0:
+            logger.info(f'{command}: {count} shard(s), --shard_index 0 to {count - 1}')
+
+
+def run_convert(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    raw_files = [raw_file for _, raw_file in select_shard(run.raw_files, shard_index, num_shards)]
+
+    content_store = None
+    if args.content_store:
+        content_store = ContentStore(args.cache_folder, partial(simsi.get_derived_cache_files,
+                                                                dat_files_folder=args.cache_folder / Path('dat_files'),
+                                                                extracted_folder=run.extracted_folder))
+
+    logger.info(f'Converting {len(raw_files)} .raw files')
+    mzml_files = raw.convert_raw_mzml_batch(raw_files, args.cache_folder / Path('mzML'), args.num_threads,
+                                            content_store=content_store, batch_conversion=args.batch_conversion,
+                                            memory_aware=args.memory_aware_conversion,
+                                            memory_budget=int(args.conversion_memory_limit * 1e9) or None)
+    if content_store is not None:
+        content_store.release()
+    write_manifest(run, 'convert', shard_index, raw_files, mzml_files)
+
+
+def run_extract(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    selected = select_shard(list(zip(run.mzml_files, run.correction_factor_paths)), shard_index, num_shards)
+    mzml_files = [mzml_file for _, (mzml_file, _) in selected]
+    correction_factor_paths = [path for _, (_, path) in selected]
+    check_inputs(mzml_files, 'extract', 'convert')
+
+    logger.info(f'Extracting correct reporter ion intensities from {len(mzml_files)} .mzML files')
+    tmt_processing.extract_tmt_reporters(mzml_files=mzml_files, output_path=run.extracted_folder,
+                                         correction_factor_paths=correction_factor_paths,
+                                         plex=mq.get_plex(run.mq_txt_folders),
+                                         extraction_level=cli.parse_tmt_ms_level(args.tmt_ms_level),
+                                         num_threads=args.num_threads)
+    extracted_files = [Path(tmt_processing.get_extracted_tmt_file_name(run.extracted_folder, mzml_file))
+                       for mzml_file in mzml_files]
+    write_manifest(run, 'extract', shard_index, mzml_files, extracted_files)
+
+
+def run_cluster(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    check_inputs(run.mzml_files, 'cluster', 'convert')
+
+    cluster_files = [run.cluster_result_folder / Path(f'MaRaCluster.clusters_{pval}.tsv') for pval in run.pvals]
+    if needs_clustering(run, cluster_files):
+        logger.info(f'Clustering .mzML files')
+        cluster.cluster_mzml_files(run.mzml_files, run.stringencies, run.cluster_result_folder,
+                                   args.cache_folder / Path('dat_files'), args.num_threads,
+                                   args.num_threads_per_precursor_bin, args.work_queue_folder,
+                                   args.num_local_queue_workers, args.incremental_clustering)
+    else:
+        logger.info("Found previous MaRaCluster run, skipping clustering")
+    write_manifest(run, 'cluster', shard_index, run.mzml_files, cluster_files)
+
+
+def needs_clustering(run: ShardRun, cluster_files: List[Path]) -> bool:
+    """
+    Clusters again if the mzML files changed or an mzML file was converted again after the previous clustering
+    """
+    if not cluster.has_previous_run(run.cluster_result_folder, run.mzml_files, run.stringencies):
+        return True
+    clustered_time = min(f.stat().st_mtime for f in cluster_files)
+    return any(mzml_file.stat().st_mtime > clustered_time for mzml_file in run.mzml_files)
+
+
+def load_maxquant_tables(run: ShardRun, requantify: bool) -> MaxQuantTables:
+    """
+    Reads the MaxQuant tables like a SIMSI-Transfer run
+    :param requantify: replace the reporter ion intensities by the ones of the extract shards if --tmt_requantify
+                       is set
+    """
+    args = run.args
+    plex = mq.get_plex(run.mq_txt_folders)
+    raw_filenames_input = {raw_file.stem for raw_file in run.raw_files}
+
+    msmsscans_mq, raw_file_dictionary = simsi.read_msmsscans(args, run.mq_txt_folders, plex, raw_filenames_input)
+    if args.tmt_requantify and requantify:
+        check_inputs([Path(tmt_processing.get_extracted_tmt_file_name(run.extracted_folder, mzml_file))
+                      for mzml_file in run.mzml_files], 'transfer', 'extract')
+        msmsscans_mq = simsi.add_corrected_tmt(msmsscans_mq, run.mzml_files, run.extracted_folder, plex,
+                                               raw_file_dictionary)
+
+    msms_mq, evidence_mq, allpeptides_mq, rawfile_metadata, modified_sequence_dictionary = \
+        simsi.read_maxquant_tables(args, run.mq_txt_folders, msmsscans_mq, raw_file_dictionary)
+
+    output_columns = dict()
+    transfer_columns = msms_columns = evidence_columns = None
+    if args.output_columns:
+        output_columns = simsi_output.read_output_columns(args.output_columns)
+        msmsscans_mq, msms_mq, transfer_columns, msms_columns, evidence_columns = simsi.get_required_columns(
+            args, output_columns, plex, msmsscans_mq, msms_mq)
+
+    return MaxQuantTables(msmsscans_mq, msms_mq, evidence_mq, allpeptides_mq, rawfile_metadata, raw_file_dictionary,
+                          modified_sequence_dictionary, plex, output_columns, transfer_columns, msms_columns,
+                          evidence_columns)
+
+
+def get_compression(args: argparse.Namespace) -> Compression:
+    return Compression(args.compression, args.compression_level,
+                       args.compression_threads if args.compression_threads > 0 else args.num_threads)
+
+
+def get_transfer_folder(run: ShardRun) -> Path:
+    return run.shard_folder / Path('transfer')
+
+
+def get_msms_file(run: ShardRun, pval: str) -> Path:
+    return get_transfer_folder(run) / Path(f'{pval}_msms.pkl')
+
+
+def get_evidence_chunk_file(run: ShardRun, pval: str, chunk_index: int) -> Path:
+    return run.shard_folder / Path('evidence') / Path(pval) / Path(f'evidence_chunk_{chunk_index}.pkl')
+
+
+def run_transfer(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    pvals = [pval for _, pval in select_shard(run.pvals, shard_index, num_shards)]
+    cluster_files = [run.cluster_result_folder / Path(f'MaRaCluster.clusters_{pval}.tsv') for pval in pvals]
+    check_inputs(cluster_files, 'transfer', 'cluster')
+
+    tables = load_maxquant_tables(run, requantify=True)
+    annotation_index = scan_index.build_annotation_index(tables.msmsscans, tables.msms, tables.raw_file_dictionary)
+    compression = get_compression(args)
+
+    written_files = []
+
+    def export(function, *export_args):
+        written_files.extend(function(*export_args))
+
+    for pval in pvals:
+        logger.info('')
+        msms_simsi = simsi.transfer_stringency(args, pval, run.cluster_result_folder, tables.msmsscans, tables.msms,
+                                               tables.rawfile_metadata, tables.raw_file_dictionary, annotation_index,
+                                               export, get_transfer_folder(run), compression, tables.output_columns,
+                                               tables.transfer_columns, tables.msms_columns)
+        if msms_simsi is not None and not args.skip_evidence:
+            # the input of the evidence shards
+            write_pickle(get_msms_file(run, pval), msms_simsi)
+            written_files.append(get_msms_file(run, pval))
+
+    write_manifest(run, 'transfer', shard_index, cluster_files, written_files, pvals=pvals)
+
+
+def run_evidence(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    raw_file_names = {raw_file.stem for _, raw_file in select_shard(run.raw_files, shard_index, num_shards)}
+    msms_files = [get_msms_file(run, pval) for pval in run.pvals]
+    check_inputs(msms_files, 'evidence', 'transfer')
+
+    tables = load_maxquant_tables(run, requantify=False)
+
+    chunks = dict()
+    outputs = []
+    for pval, msms_file in zip(run.pvals, msms_files):
+        logger.info(f'Starting SIMSI-Transfer evidence.txt building for {pval}.')
+        with open(msms_file, 'rb') as f:
+            msms_simsi = pickle.load(f)
+        msms_simsi = simsi.get_evidence_input(msms_simsi, tables.raw_file_dictionary,
+                                              tables.modified_sequence_dictionary, tables.evidence_columns)
+
+        # chunks are numbered over all raw files, such that the merge can put the chunks of all shards in order
+        jobs, chunk_indices = [], []
+        num_chunks = 0
+        for chunk_index, (raw_file, job_args) in enumerate(
+                evidence.get_evidence_groups(msms_simsi, tables.evidence, tables.allpeptides, tables.plex)):
+            num_chunks += 1
+            if raw_file in raw_file_names:
+                jobs.append((*job_args, get_evidence_chunk_file(run, pval, chunk_index)))
+                chunk_indices.append(chunk_index)
+
+        get_evidence_chunk_file(run, pval, 0).parent.mkdir(parents=True, exist_ok=True)
+        results = get_executor(None, args.num_threads, len(jobs)).map(evidence.build_evidence_chunk, jobs)
+        for chunk_index, result in zip(chunk_indices, results):
+            chunk_file = get_evidence_chunk_file(run, pval, chunk_index)
+            write_pickle(chunk_file.with_suffix('.meta'), result)
+            outputs.append(chunk_file)
+        chunks[pval] = {'num_chunks': num_chunks, 'chunk_indices': chunk_indices}
+
+    write_manifest(run, 'evidence', shard_index, msms_files, outputs, chunks=chunks)
+
+
+def run_merge(run: ShardRun, shard_index: int, num_shards: int):
+    args = run.args
+    transfer_manifests = read_manifests(run, 'transfer')
+    missing_pvals = set(run.pvals) - {pval for manifest in transfer_manifests for pval in manifest['pvals']}
+    if len(missing_pvals) > 0:
+        raise FileNotFoundError(f'Missing transfer shards for {sorted(missing_pvals)}, run the transfer shards first')
+
+    outputs = []
+    transfer_summaries = get_transfer_folder(run) / Path('summaries')
+    for manifest in transfer_manifests:
+        for output_file in map(Path, manifest['outputs']):
+            if output_file.suffix == '.pkl':
+                continue
+            summaries_file = args.output_folder / Path('summaries') / output_file.relative_to(transfer_summaries)
+            if output_file.is_file():
+                summaries_file.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(output_file, summaries_file)
+            elif not summaries_file.is_file():
+                raise FileNotFoundError(f'Missing output file {output_file} of transfer shard '
+                                        f'{manifest["shard_index"]}')
+            outputs.append(summaries_file)
+
+    if not args.skip_evidence:
+        output_columns = simsi_output.read_output_columns(args.output_columns) if args.output_columns else dict()
+        evidence_manifests = read_manifests(run, 'evidence')
+        compression = get_compression(args)
+        for pval in run.pvals:
+            evidence_chunks = get_evidence_chunks(run, pval, evidence_manifests)
+            outputs += simsi_output.export_simsi_evidence_chunks(evidence_chunks, args.output_folder, pval,
+                                                                 args.output_format, compression,
+                                                                 output_columns.get('evidence'))
+
+    write_manifest(run, 'merge', shard_index, [], outputs)
+
+
+def get_evidence_chunks(run: ShardRun, pval: str, evidence_manifests: List[dict]) -> SortedChunks:
+    """
+    Collects the evidence chunks of all evidence shards in raw file order. With --streaming_evidence, the evidence
+    IDs are made unique across raw files like in a SIMSI-Transfer run, otherwise they start at 0 for every raw file.
+    """
+    shard_chunks = [manifest['chunks'][pval] for manifest in evidence_manifests if pval in manifest['chunks']]
+    num_chunks = max([chunks['num_chunks'] for chunks in shard_chunks], default=0)
+    chunk_indices = {i for chunks in shard_chunks for i in chunks['chunk_indices']}
+    if len(shard_chunks) == 0 or chunk_indices != set(range(num_chunks)):
+        raise FileNotFoundError(f'Missing evidence chunks for {pval}, run all evidence shards first')
+
+    chunk_files = [get_evidence_chunk_file(run, pval, i) for i in range(num_chunks)]
+    results = []
+    for chunk_file in chunk_files:
+        with open(chunk_file.with_suffix('.meta'), 'rb') as f:
+            results.append(pickle.load(f))
+
+    templates = [template for template, _ in results]
+    template = pd.concat(templates, ignore_index=True) if templates else pd.DataFrame()
+    if not run.args.streaming_evidence:
+        return SortedChunks(chunk_files, template)
+    id_offsets = np.cumsum([0] + [num_ids for _, num_ids in results[:-1]]).tolist()
+    return SortedChunks(chunk_files, template, "id", id_offsets)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,45 +1,271 @@
 import os
+import json
 import logging
+import queue
+import threading
 from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
 
 import pandas as pd
 
-from simsi_transfer.merging_functions import merge_with_msmsscanstxt, merge_with_summarytxt, merge_with_msmstxt
+from simsi_transfer.merging_functions import merge_with_msmsscanstxt, merge_with_summarytxt, merge_with_msmstxt, KEY_COLUMNS, SCAN_KEY, SCAN_BITS
+from simsi_transfer.scan_index import AnnotationIndex, take_rows
+from simsi_transfer.utils import table_writer
+from simsi_transfer.utils.compression import Compression
 
 logger = logging.getLogger(__name__)
 
 
-def export_annotated_clusters(annotated_clusters, mainpath, pval):
+OUTPUT_FORMATS = ['tsv', 'parquet', 'both']
+
+# names of the output tables that can be listed in an --output_columns spec
+OUTPUT_TABLES = ['annotated_clusters', 'msmsScans', 'msms', 'evidence']
+
+# columns of the SIMSI-Transfer msms.txt dataframe that are read by count_clustering_parameters
+STATISTICS_COLUMNS = ['clusterID', 'identification', 'Modified sequence', 'mod_ambiguous', 'raw_ambiguous']
+
+# maximum number of output tables waiting for a writer thread, limits the memory held by pending exports
+MAX_PENDING_EXPORTS = 2
+
+
+class ExportQueue:
+    """
+    Writes output tables in background threads, such that the computation of the next table can continue while the
+    previous one is being written. At most max_pending tables wait for a writer, further submits block until a
+    writer is available. With num_writers=0, tables are written synchronously by submit.
+    """
+
+    def __init__(self, num_writers: int = 1, max_pending: int = MAX_PENDING_EXPORTS):
+        self.num_writers = num_writers
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.written_files = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.writers = [threading.Thread(target=self._write_loop, name=f'export_writer_{i}', daemon=True)
+                        for i in range(num_writers)]
+        for writer in self.writers:
+            writer.start()
+
+    def submit(self, export_function: Callable[..., List[Path]], df, *args, **kwargs):
+        """
+        Schedules an export function, e.g. export_msms, for writing df.
+        :param export_function: function that writes df and returns the paths of the written files
+        :param df: dataframe or sorted chunks to write, must not be modified in-place afterwards
+        """
+        if self.num_writers == 0:
+            self.written_files.extend(export_function(df, *args, **kwargs))
+            return
+        if isinstance(df, pd.DataFrame):
+            # a shallow copy protects the pending export from columns being added to or removed from df later on
+            df = df.copy(deep=False)
+        self.queue.put((export_function, df, args, kwargs))
+
+    def _write_loop(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            export_function, df, args, kwargs = task
+            try:
+                written_files = export_function(df, *args, **kwargs)
+                with self.lock:
+                    self.written_files.extend(written_files)
+            except Exception as e:
+                logger.error(f'Failed to write output table: {e}')
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                del task, df
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Waits until all pending tables are written and checks that every output file exists and is not empty.
+        """
+        for _ in self.writers:
+            self.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+        if self.errors:
+            raise self.errors[0]
+        check_output_files(self.written_files)
+
+
+def check_output_files(paths: List[Path]):
+    for path in paths:
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            raise RuntimeError(f'Output file {path} was not written correctly.')
+
+
+def export_annotated_clusters(annotated_clusters, mainpath, pval, output_format='tsv',
+                              compression: Compression = None, output_columns: List[str] = None):
     logger.info(f'Writing {pval}_annotated_clusters.txt.')
-    export_csv(annotated_clusters, 'annotated_clusters', mainpath, pval)
+    return export_csv(annotated_clusters, 'annotated_clusters', mainpath, pval, output_format=output_format,
+                      compression=compression, output_columns=output_columns)
 
 
-def export_msmsscans(msmsscans_simsi, mainpath, pval):
+def export_msmsscans(msmsscans_simsi, mainpath, pval, output_format='tsv', compression: Compression = None,
+                     output_columns: List[str] = None):
     logger.info(f'Writing {pval}_msmsScans.txt for {pval}.')
-    export_csv(msmsscans_simsi, 'msmsScans', mainpath, pval, sort_columns=['Raw file', 'scanID'])
+    return export_csv(msmsscans_simsi, 'msmsScans', mainpath, pval, sort_columns=['Raw file', 'scanID'],
+                      output_format=output_format, compression=compression, output_columns=output_columns)
 
 
-def export_msms(msms_simsi, mainpath, pval):
+def export_msms(msms_simsi, mainpath, pval, output_format='tsv', compression: Compression = None,
+                output_columns: List[str] = None):
     logger.info(f'Writing {pval}_msms.txt for {pval}.')
-    export_csv(msms_simsi, 'msms', mainpath, pval, sort_columns=['Sequence', 'Modified sequence'])
+    return export_csv(msms_simsi, 'msms', mainpath, pval, sort_columns=['Sequence', 'Modified sequence'],
+                      output_format=output_format, compression=compression, output_columns=output_columns)
 
 
-def export_simsi_evidence_file(evidence_file, mainpath, pval):
+def export_simsi_evidence_file(evidence_file, mainpath, pval, output_format='tsv', compression: Compression = None,
+                               output_columns: List[str] = None):
     logger.info(f'Writing {pval}_evidence.txt for {pval}.')
-    export_csv(evidence_file, 'evidence', mainpath, pval, sort_columns=['Sequence', 'Modified sequence'])
+    return export_csv(evidence_file, 'evidence', mainpath, pval, sort_columns=['Sequence', 'Modified sequence'],
+                      output_format=output_format, compression=compression, output_columns=output_columns)
+
+
+def export_simsi_evidence_chunks(evidence_chunks: table_writer.SortedChunks, mainpath, pval, output_format='tsv',
+                                 compression: Compression = None, output_columns: List[str] = None):
+    logger.info(f'Merging evidence chunks into {pval}_evidence.txt for {pval}.')
+    return export_sorted_chunks(evidence_chunks, 'evidence', mainpath, pval,
+                                sort_columns=['Sequence', 'Modified sequence'], output_format=output_format,
+                                compression=compression, output_columns=output_columns)
+
+
+def export_sorted_chunks(chunks: table_writer.SortedChunks, filename: str, mainpath, pval, sort_columns,
+                         output_format='tsv', compression: Compression = None, output_columns: List[str] = None):
+    """
+    Writes a SIMSI-Transfer output table that is stored as pre-sorted chunk files, see export_csv
+    :param chunks: chunk files sorted by sort_columns
+    :return: paths of the written files
+    """
+    pval_path = get_output_folder(mainpath, pval, output_format)
+    columns = get_output_columns(chunks.template, filename, output_columns)
+    written_files = []
+    if output_format in ['tsv', 'both']:
+        path = pval_path / Path(f'{pval}_{filename}.txt{get_extension(compression)}')
+        table_writer.write_tsv_batches(table_writer.merge_sorted_chunks(chunks, sort_columns), path, columns,
+                                       na_rep='NaN', compression=compression)
+        written_files.append(path)
+    if output_format in ['parquet', 'both']:
+        path = pval_path / Path(f'{pval}_{filename}.parquet')
+        table_writer.write_parquet_batches(table_writer.merge_sorted_chunks(chunks, sort_columns), path,
+                                           chunks.template, sort_columns=sort_columns, columns=columns)
+        written_files.append(path)
+    return written_files
+
+
+def get_output_columns(df: pd.DataFrame, filename: str, output_columns: Optional[List[str]]) -> List[str]:
+    if output_columns is None:
+        # the packed join keys are internal to SIMSI-Transfer and are not part of the MaxQuant output format
+        return [c for c in df.columns if c not in KEY_COLUMNS]
+
+    missing_columns = [c for c in output_columns if c not in df.columns]
+    if missing_columns:
+        logger.warning(f'Columns {missing_columns} requested for the {filename} output are not available, skipping them')
+    return [c for c in output_columns if c in df.columns]
+
+
+def read_output_columns(spec_file: Path) -> Dict[str, List[str]]:
+    """
+    Reads the columns to write for each output table from a YAML or JSON file, e.g.
+
+    msmsScans: [Raw file, scanID, Modified sequence, identification]
+    evidence: [Sequence, Modified sequence, Raw file, Charge, Intensity]
+
+    Output tables that are not listed are written with all columns.
+    :param spec_file: path to a .yaml, .yml or .json file
+    :return: dictionary of output table name to list of columns
+    """
+    with open(spec_file) as f:
+        if Path(spec_file).suffix in ['.yaml', '.yml']:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('Reading a YAML output column spec requires pyyaml, install it with '
+                                  '"pip install pyyaml" or use a JSON file instead')
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
 
+    if not isinstance(spec, dict):
+        raise ValueError(f'Expected a mapping of output table to columns in {spec_file}')
+    for table, columns in spec.items():
+        if table not in OUTPUT_TABLES:
+            raise ValueError(f'Unknown output table {table} in {spec_file}. Expected one of {OUTPUT_TABLES}.')
+        if not isinstance(columns, list):
+            raise ValueError(f'Expected a list of columns for output table {table} in {spec_file}')
+    return {table: list(map(str, columns)) for table, columns in spec.items()}
+
+
+def get_required_columns(*column_lists: Optional[List[str]]) -> Optional[Set[str]]:
+    """
+    Union of the columns that are needed by later stages, None if any stage needs all columns
+    """
+    if any(columns is None for columns in column_lists):
+        return None
+    return set(KEY_COLUMNS).union(*column_lists)
+
+
+def drop_unused_columns(df: pd.DataFrame, required_columns: Optional[Set[str]]) -> pd.DataFrame:
+    """
+    Drops the columns that are not needed by later stages, see get_required_columns
+    """
+    if required_columns is None:
+        return df
+    unused_columns = [c for c in df.columns if c not in required_columns]
+    if unused_columns:
+        logger.debug(f'Dropping unused columns {unused_columns}')
+        df = df.drop(columns=unused_columns)
+    return df
+
+
+def get_extension(compression: Compression) -> str:
+    return compression.extension if compression is not None else ''
+
+
+def get_output_folder(mainpath, pval, output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format {output_format}. Expected one of {OUTPUT_FORMATS}.")
 
-def export_csv(df: pd.DataFrame, filename: str, mainpath, pval, sort_columns=None):
     sumpath = mainpath / Path('summaries')
     if not os.path.exists(sumpath):
         os.makedirs(sumpath)
     pval_path = sumpath / Path(pval)
     if not os.path.exists(pval_path):
         os.makedirs(pval_path)
-    if sort_columns:
-        df.sort_values(by=sort_columns)
-    path = pval_path / Path(f'{pval}_{filename}.txt')
-    df.to_csv(path, sep='\t', index=False, na_rep='NaN')
+    return pval_path
+
+
+def export_csv(df: pd.DataFrame, filename: str, mainpath, pval, sort_columns=None, output_format='tsv',
+               compression: Compression = None, output_columns: List[str] = None):
+    """
+    Writes a SIMSI-Transfer output table to summaries/<pval>/<pval>_<filename>.txt and/or .parquet
+    :param df: output dataframe
+    :param filename: name of the output table, e.g. msmsScans
+    :param mainpath: SIMSI-Transfer output folder
+    :param pval: stringency of the clustering, e.g. p10
+    :param sort_columns: columns to sort the rows by before writing
+    :param output_format: 'tsv', 'parquet' or 'both'
+    :param compression: compression of the .txt files, parquet files are always compressed internally
+    :param output_columns: columns to write in this order, defaults to all columns
+    :return: paths of the written files
+    """
+    pval_path = get_output_folder(mainpath, pval, output_format)
+    columns = get_output_columns(df, filename, output_columns)
+    written_files = []
+    if output_format in ['tsv', 'both']:
+        path = pval_path / Path(f'{pval}_{filename}.txt{get_extension(compression)}')
+        table_writer.write_tsv(df, path, sort_columns=sort_columns, columns=columns, na_rep='NaN',
+                               compression=compression)
+        written_files.append(path)
+    if output_format in ['parquet', 'both']:
+        path = pval_path / Path(f'{pval}_{filename}.parquet')
+        table_writer.write_parquet(df, path, sort_columns=sort_columns, columns=columns)
+        written_files.append(path)
+    return written_files
 
 
 def count_clustering_parameters(summary, rawtrans=False):
@@ -92,21 +318,66 @@ def remove_unidentified_scans(summary):
     return summary
 
 
-def annotate_clusters(msmsscansdf, msmsdf, rawfile_metadata, cluster_results):
+def annotate_clusters(msmsscansdf, msmsdf, rawfile_metadata, cluster_results, annotation_index: AnnotationIndex = None):
     """
     Merges msmsscans.txt, msms.txt, and MaRaCluster clusters to generate summary file
     :param msmsscansdf:
     :param msmsdf:
     :param rawfile_metadata:
     :param clusterfile:
+    :param annotation_index: dense scan indices of msmsscansdf and msmsdf, see scan_index.build_annotation_index.
+    If None, the dataframes are merged instead.
     :return:
     """
     logger.info(f'Annotating clusters with search engine results.')
+    if annotation_index is not None and can_annotate_dense(msmsscansdf, msmsdf, rawfile_metadata, cluster_results):
+        return annotate_clusters_dense(msmsscansdf, msmsdf, rawfile_metadata, cluster_results, annotation_index)
     summary = merge_with_msmsscanstxt(cluster_results, msmsscansdf)
     summary = merge_with_summarytxt(summary, rawfile_metadata)
     summary = merge_with_msmstxt(summary, msmsdf)
     return summary
 
 
+def get_annotation_columns(msmsscansdf, msmsdf, rawfile_metadata):
+    scan_columns = ['Raw file', 'scanID', SCAN_KEY]
+    return ([c for c in msmsscansdf.columns if c not in scan_columns],
+            [c for c in rawfile_metadata.columns if c != 'Raw file'],
+            [c for c in msmsdf.columns if c not in scan_columns])
+
+
+def can_annotate_dense(msmsscansdf, msmsdf, rawfile_metadata, cluster_results):
+    """
+    The dense annotation gives the same result as the merges if there are no overlapping columns, which the merges
+    would suffix, and if every raw file has a single metadata row.
+    """
+    if SCAN_KEY not in cluster_results.columns or rawfile_metadata['Raw file'].duplicated().any():
+        return False
+    column_lists = [cluster_results.columns.tolist(), *get_annotation_columns(msmsscansdf, msmsdf, rawfile_metadata)]
+    all_columns = [c for columns in column_lists for c in columns]
+    return len(all_columns) == len(set(all_columns))
+
+
+def annotate_clusters_dense(msmsscansdf, msmsdf, rawfile_metadata, cluster_results, annotation_index: AnnotationIndex):
+    """
+    Annotates clusters by looking up the msmsscans.txt and msms.txt rows of each clustered scan in dense scan indices,
+    such that the columns can be placed with a single take per column instead of successive merges
+    """
+    msmsscans_columns, metadata_columns, msms_columns = get_annotation_columns(msmsscansdf, msmsdf, rawfile_metadata)
+    scan_keys = cluster_results[SCAN_KEY].to_numpy()
+
+    msmsscans_positions = annotation_index.msmsscans_index.lookup(scan_keys)
+    msms_positions = annotation_index.msms_index.lookup(scan_keys)
+
+    metadata_positions_by_raw_file = pd.Index(rawfile_metadata['Raw file']).get_indexer(
+        annotation_index.raw_file_dictionary)
+    metadata_positions = metadata_positions_by_raw_file[scan_keys >> SCAN_BITS]
+
+    columns = {column: cluster_results[column].array for column in cluster_results.columns}
+    columns |= take_rows(msmsscansdf[msmsscans_columns], msmsscans_positions)
+    columns |= take_rows(rawfile_metadata[metadata_columns], metadata_positions)
+    columns |= take_rows(msmsdf[msms_columns], msms_positions)
+    return pd.DataFrame(columns)
+
+
 if __name__ == '__main__':
     raise NotImplementedError('Do not run this script.')
@@ -1,14 +1,23 @@
 import os
+import shutil
+import tempfile
 from sys import platform
-from typing import Optional, List
+from typing import Optional, List, Dict, Callable
 from pathlib import Path
 import logging
 
 from .utils import subprocess_with_logger as subprocess
+from .utils.scheduler import ScheduledJob, run_memory_aware
+from .utils.executor import ExecutorBackend, get_executor
+from .cache import ContentStore, MZML, fingerprint_file, link_file
 
 # hacky way to get the package logger instead of just __main__ when running as a module
 logger = logging.getLogger(__package__ + "." + __file__)
 
+# rough memory usage of a ThermoRawFileParser process, a fixed runtime overhead plus a multiple of the raw file size
+CONVERSION_MEMORY_OVERHEAD = 1024 ** 3
+CONVERSION_MEMORY_PER_RAW_BYTE = 1.0
+
 
 def convert_raw_mzml(input_path: Path, output_path: Optional[Path] = None, gzip: bool = False, ms_level: str = "2-") -> Path:
     """
@@ -25,6 +34,60 @@ def convert_raw_mzml(input_path: Path, output_path: Optional[Path] = None, gzip:
         logger.debug(f"Found converted file at {output_path}, skipping conversion")
         return output_path
     
+    exec_command = f"{get_converter_command(gzip, ms_level)} -i \"{input_path}\" -b \"{output_path}.tmp\""
+    logger.debug(f"Converting thermo rawfile to mzml with the command: '{exec_command}'")
+    subprocess.run(exec_command)
+    
+    # only rename the file now, so that we don't have a partially converted file if something fails
+    os.rename(f"{output_path}.tmp", output_path)
+    
+    return output_path
+
+
+def convert_raw_mzml_directory(input_paths: List[Path], output_paths: List[Path], gzip: bool = False, ms_level: str = "2-") -> List[Path]:
+    """
+    Converts multiple ThermoRaw files to mzML with a single ThermoRawFileParser process, which saves the startup time
+    of the .NET runtime for every file. The raw files are linked into a temporary input directory and every converted
+    file is only renamed to its output path once the whole directory was converted.
+
+    :param input_paths: File paths of the Thermo Rawfiles
+    :param output_paths: File paths of the mzML files, in the same order as input_paths
+    :param ms_level: MS levels to keep, "2-" means MS2 and above (e.g. MS2 and MS3)
+    """
+    pending = [(i, o) for i, o in zip(input_paths, output_paths) if not o.is_file()]
+    if len(pending) == 0:
+        logger.debug(f"Found converted files for all {len(input_paths)} raw files, skipping conversion")
+        return output_paths
+
+    tmp_folder = Path(tempfile.mkdtemp(dir=pending[0][1].parent, prefix='.conversion_'))
+    try:
+        input_folder = tmp_folder / Path('raw')
+        converted_folder = tmp_folder / Path('mzML')
+        input_folder.mkdir()
+        converted_folder.mkdir()
+        for input_path, output_path in pending:
+            link_file(input_path, input_folder / output_path.with_suffix('.raw').name)
+
+        exec_command = f"{get_converter_command(gzip, ms_level)} -d \"{input_folder}\" -o \"{converted_folder}\""
+        logger.debug(f"Converting {len(pending)} thermo rawfiles to mzml with the command: '{exec_command}'")
+        subprocess.run(exec_command)
+
+        converted_suffix = ".mzML.gz" if gzip else ".mzML"
+        converted_files = [converted_folder / (output_path.stem + converted_suffix) for _, output_path in pending]
+        missing_files = [str(f.name) for f in converted_files if not f.is_file()]
+        if len(missing_files) > 0:
+            raise RuntimeError(f"ThermoRawFileParser did not convert {', '.join(missing_files)}")
+
+        # only rename the files now, so that we don't have partially converted files if something fails
+        for converted_file, (_, output_path) in zip(converted_files, pending):
+            os.replace(converted_file, output_path)
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    return output_paths
+
+
+def get_converter_command(gzip: bool = False, ms_level: str = "2-") -> str:
     if gzip:
         gzip = "-g"
     else:
@@ -36,42 +99,134 @@ def convert_raw_mzml(input_path: Path, output_path: Optional[Path] = None, gzip:
         mono = ""
     
     exec_path = Path(__file__).parent.absolute() # get path of parent directory of current file
-    exec_command = f"{mono} {exec_path}/utils/ThermoRawFileParser/ThermoRawFileParser.exe {gzip} --msLevel \"{ms_level}\" -i \"{input_path}\" -b \"{output_path}.tmp\""
-    logger.debug(f"Converting thermo rawfile to mzml with the command: '{exec_command}'")
-    subprocess.run(exec_command)
-    
-    # only rename the file now, so that we don't have a partially converted file if something fails
-    os.rename(f"{output_path}.tmp", output_path)
-    
-    return output_path
+    return f"{mono} {exec_path}/utils/ThermoRawFileParser/ThermoRawFileParser.exe {gzip} --msLevel \"{ms_level}\""
+
 
+def convert_raw_mzml_batch(raw_files: List[Path], output_folder: Optional[Path] = None, num_threads: int = 1, gzip: bool = False, ms_level: str = "2-", content_store: Optional[ContentStore] = None, batch_conversion: bool = False, memory_aware: bool = False, memory_budget: Optional[int] = None, on_converted: Optional[Callable[[List[Path]], None]] = None, executor_backend: Optional[ExecutorBackend] = None) -> List[Path]:
+    """
+    Converts ThermoRaw files to mzML, mzML files in raw_files are used as is.
 
-def convert_raw_mzml_batch(raw_files: List[Path], output_folder: Optional[Path] = None, num_threads: int = 1, gzip: bool = False, ms_level: str = "2-") -> List[Path]:
+    :param content_store: if given, converted files are stored by the fingerprint of their raw file and linked into
+                          output_folder, such that raw files are only converted again if their content changed
+    :param batch_conversion: convert the raw files with one ThermoRawFileParser process per thread instead of one
+                             process per raw file
+    :param memory_aware: limit the number of concurrent conversions by their estimated memory usage instead of
+                         always running num_threads conversions at once
+    :param memory_budget: maximum estimated memory in bytes of the concurrent conversions if memory_aware is set,
+                          defaults to most of the currently available memory
+    :param on_converted: called in the main process with the mzML files of each finished conversion job, e.g. to
+                         start downstream processing before all raw files are converted
+    :param executor_backend: runs the conversion jobs, defaults to a new process pool of num_threads processes
+    """
     if not output_folder.is_dir():
         output_folder.mkdir(parents=True)
     
-    if num_threads > 1:
-        from job_pool import JobPool
-        processingPool = JobPool(processes=num_threads, write_progress_to_logger=True, total_jobs=len([x for x in raw_files if x.suffix.lower() == ".raw"]))
-    
+    pending_files = [x for x in raw_files if x.suffix.lower() == ".raw"]
+    fingerprints = dict()
+    if content_store is not None and len(pending_files) > 0:
+        pending_files = [x for x in pending_files if not link_from_store(x, output_folder, content_store, fingerprints)]
+        logger.info(f"Found {len(fingerprints) - len(pending_files)} of {len(fingerprints)} raw files in the content store")
+
+    if batch_conversion:
+        groups = split_conversion_groups(pending_files, num_threads)
+    else:
+        groups = [[raw_file] for raw_file in pending_files]
+
+    jobs = [(group, [output_folder / raw_file.with_suffix('.mzML').name for raw_file in group], batch_conversion,
+             content_store, [fingerprints.get(raw_file) for raw_file in group]) for group in groups]
+    if on_converted is None:
+        on_converted = lambda mzml_files: None
+
+    # mzML files that do not need a conversion job are available right away
+    ready_files = [x for x in raw_files if x.suffix.lower() == ".mzml"]
+    ready_files += [output_folder / x.with_suffix('.mzML').name for x in fingerprints.keys() if x not in pending_files]
+    if len(ready_files) > 0:
+        on_converted(ready_files)
+
+    if memory_aware:
+        run_memory_aware([ScheduledJob(convert_raw_mzml_group, args, estimate_conversion_memory(args[0]),
+                                       sum(x.stat().st_size for x in args[0])) for args in jobs],
+                         num_threads, memory_budget, callback=on_converted)
+    elif len(jobs) > 0:
+        get_executor(executor_backend, num_threads, len(jobs)).map(convert_raw_mzml_group, jobs, callback=on_converted)
+
+    return get_mzml_files(raw_files, output_folder)
+
+
+def get_mzml_files(raw_files: List[Path], output_folder: Path) -> List[Path]:
+    """
+    Returns the mzML file in output_folder for each ThermoRaw file and mzML files in raw_files as is
+    """
     mzml_files = []
     for raw_file in raw_files:
         if raw_file.suffix.lower() == ".raw":
-            input_path = raw_file
-            output_path = output_folder / raw_file.with_suffix('.mzML').name
-            
-            if num_threads > 1:
-                processingPool.applyAsync(convert_raw_mzml, (input_path, output_path))
-            else:
-                mzml_file = convert_raw_mzml(input_path, output_path)
-                mzml_files.append(mzml_file)
+            mzml_files.append(output_folder / raw_file.with_suffix('.mzML').name)
         elif raw_file.suffix.lower() == ".mzml":
             mzml_files.append(raw_file)
-    
-    if len(mzml_files) == 0 and num_threads > 1:
-        mzml_files = processingPool.checkPool()
         
     return mzml_files
+
+
+def link_from_store(raw_file: Path, output_folder: Path, content_store: ContentStore, fingerprints: Dict[Path, str]) -> bool:
+    """
+    Links the stored conversion of raw_file into output_folder. mzML files converted before the content store was
+    used are adopted into the store if they are newer than their raw file and removed otherwise.
+
+    :return: True if no conversion is needed
+    """
+    fingerprint = fingerprint_file(raw_file)
+    fingerprints[raw_file] = fingerprint
+    output_path = output_folder / raw_file.with_suffix('.mzML').name
+    if content_store.link(MZML, fingerprint, output_path):
+        return True
+
+    if output_path.is_file() and not output_path.is_symlink() and output_path.stat().st_nlink == 1 \
+            and output_path.stat().st_mtime >= raw_file.stat().st_mtime:
+        logger.debug(f"Adding previously converted file {output_path} to the content store")
+        content_store.add(MZML, fingerprint, output_path)
+        return True
+
+    content_store.remove_stale(output_path)
+    return False
+
+
+def split_conversion_groups(raw_files: List[Path], num_groups: int) -> List[List[Path]]:
+    """
+    Distributes the raw files over at most num_groups groups of about equal total file size, largest files first.
+    Raw files with the same name are put in different groups, as they cannot share an input directory.
+    """
+    groups = [[] for _ in range(max(1, min(num_groups, len(raw_files))))]
+    group_sizes = [0] * len(groups)
+    for raw_file in sorted(raw_files, key=lambda x: x.stat().st_size, reverse=True):
+        free_groups = [i for i, group in enumerate(groups) if raw_file.name not in {x.name for x in group}]
+        if len(free_groups) == 0:
+            groups.append([])
+            group_sizes.append(0)
+            free_groups = [len(groups) - 1]
+        i = min(free_groups, key=lambda i: group_sizes[i])
+        groups[i].append(raw_file)
+        group_sizes[i] += raw_file.stat().st_size
+    return [group for group in groups if len(group) > 0]
+
+
+def estimate_conversion_memory(raw_files: List[Path]) -> int:
+    """
+    Estimates the peak memory usage of a ThermoRawFileParser process that converts the raw files one after another
+    """
+    return int(CONVERSION_MEMORY_OVERHEAD + CONVERSION_MEMORY_PER_RAW_BYTE * max(x.stat().st_size for x in raw_files))
+
+
+def convert_raw_mzml_group(raw_files: List[Path], output_paths: List[Path], batch_conversion: bool = False, content_store: Optional[ContentStore] = None, fingerprints: Optional[List[str]] = None) -> List[Path]:
+    if batch_conversion:
+        convert_raw_mzml_directory(raw_files, output_paths)
+    else:
+        for input_path, output_path in zip(raw_files, output_paths):
+            convert_raw_mzml(input_path, output_path)
+
+    if content_store is not None:
+        for fingerprint, output_path in zip(fingerprints, output_paths):
+            content_store.add(MZML, fingerprint, output_path)
+    return output_paths
     
 
 def get_raw_files(raw_folder: str) -> List[Path]:
@@ -1,6 +1,6 @@
 import sys
 import re
-from typing import List
+from typing import Dict, List, Optional
 from pathlib import Path
 import logging
 
@@ -9,6 +9,9 @@ import numpy as np
 from pyteomics import mzml
 
 from .utils import utils
+from .utils.cpu_budget import limit_worker_threads
+from .utils.executor import ExecutorBackend, get_executor
+from .merging_functions import merge_on_scan
 
 logger = logging.getLogger(__name__)
 
@@ -103,6 +106,7 @@ def extract_tmt_reporters(
     plex: int,
     extraction_level: int,
     num_threads: int = 1,
+    executor_backend: Optional[ExecutorBackend] = None,
 ):
     """
     Takes about 1.5 minute for a 700MB file with 40k MS2 scans
@@ -110,20 +114,54 @@ def extract_tmt_reporters(
     if not output_path.is_dir():
         output_path.mkdir(parents=True)
 
-    if num_threads > 1:
-        from job_pool import JobPool
+    jobs = [
+        (mzml_file, output_path, correction_factor_path, extraction_level, plex)
+        for mzml_file, correction_factor_path in zip(mzml_files, correction_factor_paths)
+    ]
+    get_executor(executor_backend, num_threads, len(jobs)).map(extract_and_correct_reporters, jobs)
 
-        processing_pool = JobPool(processes=num_threads, write_progress_to_logger=True, total_jobs=len(mzml_files))
 
-    for mzml_file, correction_factor_path in zip(mzml_files, correction_factor_paths):
-        args = (mzml_file, output_path, correction_factor_path, extraction_level, plex)
-        if num_threads > 1:
-            processing_pool.applyAsync(extract_and_correct_reporters, args)
-        else:
-            extract_and_correct_reporters(*args)
+class ReporterExtractionQueue:
+    """
+    Extracts the reporter ions of mzML files in a process pool as soon as they are submitted, such that the
+    extraction can start while other raw files are still being converted.
+    """
 
-    if num_threads > 1:
-        processing_pool.checkPool()
+    def __init__(
+        self,
+        output_path: Path,
+        correction_factor_paths: Dict[str, Path],
+        plex: int,
+        extraction_level: int,
+        num_threads: int = 1,
+        total_jobs: Optional[int] = None,
+        executor_backend: Optional[ExecutorBackend] = None,
+    ):
+        """
+        :param correction_factor_paths: reporter ion correction file for each raw file name without extension
+        :param total_jobs: number of mzML files that will be submitted, only used for the progress bar
+        :param executor_backend: runs the extraction jobs, defaults to a new process pool of num_threads processes
+        """
+        if not output_path.is_dir():
+            output_path.mkdir(parents=True)
+
+        self.output_path = output_path
+        self.correction_factor_paths = correction_factor_paths
+        self.plex = plex
+        self.extraction_level = extraction_level
+        self.executor = get_executor(executor_backend, num_threads, total_jobs, in_background=True)
+
+    def submit(self, mzml_files: List[Path]):
+        for mzml_file in mzml_files:
+            args = (mzml_file, self.output_path, self.correction_factor_paths[mzml_file.stem], self.extraction_level,
+                    self.plex)
+            self.executor.submit(extract_and_correct_reporters, args)
+
+    def close(self):
+        """
+        Waits until the reporter ions of all submitted mzML files are extracted
+        """
+        self.executor.wait()
 
 
 def extract_and_correct_reporters(
@@ -197,18 +235,20 @@ def extract_and_correct_reporters(
 
     # TMT correction
     logger.info("Extraction done, correcting TMT reporters for " + mzml_file.name)
-    fileframe[tmt_corrected_columns] = pd.DataFrame(
-        fileframe[tmt_raw_columns]
-        .apply(
-            lambda tmt: np.linalg.lstsq(correction_normalized, tmt, rcond=None)[
-                0
-            ].round(2),
-            axis=1,
+    # each extraction process gets one thread of the CPU budget, so numpy must not start a BLAS thread per core
+    with limit_worker_threads(1):
+        fileframe[tmt_corrected_columns] = pd.DataFrame(
+            fileframe[tmt_raw_columns]
+            .apply(
+                lambda tmt: np.linalg.lstsq(correction_normalized, tmt, rcond=None)[
+                    0
+                ].round(2),
+                axis=1,
+            )
+            .tolist(),
+            columns=tmt_corrected_columns,
+            index=fileframe[tmt_corrected_columns].index,
         )
-        .tolist(),
-        columns=tmt_corrected_columns,
-        index=fileframe[tmt_corrected_columns].index,
-    )
     # PANDAS WHERE! This retains the checked value if the condition is met, and replaces it where it is not met!
     fileframe[tmt_corrected_columns] = fileframe[tmt_corrected_columns].where(
         fileframe[tmt_corrected_columns] > 10, 0
@@ -268,10 +308,9 @@ def assemble_corrected_tmt_table(
 
 def merge_with_corrected_tmt(msmsscans_df: pd.DataFrame, corrected_tmt: pd.DataFrame):
     logger.info("Merging corrected reporter ion tables into msmsScans.txt")
-    return pd.merge(
-        left=msmsscans_df,
-        right=corrected_tmt,
-        on=["Raw file", "scanID"],
+    return merge_on_scan(
+        msmsscans_df,
+        corrected_tmt,
         how="left",
         validate="one_to_one",
     )
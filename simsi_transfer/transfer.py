@@ -15,6 +15,11 @@ logger = logging.getLogger(__name__)
 PHOSPHO_REGEX = re.compile(r'([STY])\(Phospho \(STY\)\)')
 PROBABILITY_REGEX = re.compile(r'\((\d(?:\.?\d+)?)\)')
 
+# columns of the annotated clusters that are read by flag_ambiguous_clusters and transfer
+REQUIRED_COLUMNS = ['clusterID', 'identification', 'Sequence', 'Modifications', 'Modified sequence',
+                    'Phospho (STY) Probabilities', 'Proteins', 'Gene Names', 'Protein Names', 'Charge', 'm/z', 'Mass',
+                    'Missed cleavages', 'Length', 'PEP', 'Reverse']
+
 
 def transfer(summary_df, max_pep=False, mask=False, ambiguity_decision='majority', overwrite=False):
     """
@@ -62,9 +67,10 @@ def transfer(summary_df, max_pep=False, mask=False, ambiguity_decision='majority
                      'Modifications': utils.get_unique_else_nan,
                      'Modified sequence': mod_seq_func,
                      'Phospho (STY) Probabilities': calculate_average_probabilities,
-                     'Proteins': utils.csv_list_unique,
-                     'Gene Names': utils.csv_list_unique,
-                     'Protein Names': utils.csv_list_unique,
+                     # placeholders, these are aggregated with utils.csv_list_unique_grouped below
+                     'Proteins': 'first',
+                     'Gene Names': 'first',
+                     'Protein Names': 'first',
                      'Charge': utils.get_unique_else_nan,
                      'm/z': 'mean',
                      'Mass': 'mean',
@@ -85,8 +91,12 @@ def transfer(summary_df, max_pep=False, mask=False, ambiguity_decision='majority
         cluster_info_df = summary_df.loc[identified_scans & pep_filtered, clustercolumns].drop_duplicates(
             filtercolumns).groupby('clusterID', as_index=False).agg(agg_funcs)
     else:
-        cluster_info_df = summary_df[identified_scans & pep_filtered].groupby('clusterID', as_index=False).agg(
-            agg_funcs)
+        filtered_df = summary_df[identified_scans & pep_filtered]
+        cluster_info_df = filtered_df.groupby('clusterID', as_index=False).agg(agg_funcs)
+        for col in ['Proteins', 'Gene Names', 'Protein Names']:
+            cluster_info_df[col] = utils.csv_list_unique_grouped(filtered_df[col], filtered_df['clusterID']).reindex(
+                cluster_info_df['clusterID']).to_numpy()
+        del filtered_df
     # Mark all clusters with a unique identification as transferred ('t').
     # Identifications by MQ will overwrite this column as direct identification ('d') a few lines below.
     cluster_info_df[identification_column] = np.where(cluster_info_df['Modified sequence'].notna(), 't', None)
@@ -105,9 +115,15 @@ def transfer(summary_df, max_pep=False, mask=False, ambiguity_decision='majority
         # Like 'Merge, and if you find two columns with the same name always use the value that is not NaN!'
         # Then we could do this directly in the merge and wouldn't have to go over the df again here
         # Try pd.DataFrame.combine(). For this the dfs would need to be in the same shape though.
-        summary_df = summary_df.astype({col: 'object' for col in replacement_dict.keys()})
+        # Dictionary-encoded columns stay categorical, the transferred values are added to their dictionaries
+        categorical_columns = [col for col in replacement_dict.keys()
+                               if isinstance(summary_df[col].dtype, pd.CategoricalDtype) and ambiguity_decision != 'keep_all']
+        summary_df = summary_df.astype({col: 'object' for col in replacement_dict.keys() if col not in categorical_columns})
+        is_transferred = summary_df[identification_column] == 't'
         for col in replacement_dict.keys():
-            summary_df.loc[summary_df[identification_column] == 't', col] = summary_df.loc[summary_df[identification_column] == 't', 'grouped_' + col]
+            if col in categorical_columns:
+                summary_df[col] = utils.add_categories(summary_df[col], summary_df.loc[is_transferred, 'grouped_' + col])
+            summary_df.loc[is_transferred, col] = summary_df.loc[is_transferred, 'grouped_' + col]
 
     # The 'grouped_...' columns have made themselves redundant
     summary_df.drop(columns=replacement_dict.values(), inplace=True)
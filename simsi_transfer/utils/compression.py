@@ -0,0 +1,112 @@
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_METHODS = ['none', 'gzip', 'zstd']
+COMPRESSION_EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# uncompressed size of the independently compressed blocks, larger blocks give slightly better compression ratios
+COMPRESSION_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class Compression(NamedTuple):
+    method: str = 'none'
+    level: Optional[int] = None
+    threads: int = 1
+
+    @property
+    def extension(self) -> str:
+        return COMPRESSION_EXTENSIONS[self.method]
+
+
+class ParallelCompressedFile:
+    """
+    Binary file-like object that compresses the written data in blocks using a thread pool, such that compression
+    runs in parallel and overlaps with producing the data.
+
+    Each block is compressed independently as a gzip member or zstd frame. Concatenated members/frames are valid
+    .gz/.zst files, which can be read by standard tools like gunzip, zstd or pandas.read_csv.
+    """
+
+    def __init__(self, path: Union[Path, str], compression: Compression,
+                 block_size: int = COMPRESSION_BLOCK_SIZE):
+        if compression.method not in DEFAULT_COMPRESSION_LEVELS:
+            raise ValueError(f"Invalid compression method {compression.method}. "
+                             f"Expected one of {list(DEFAULT_COMPRESSION_LEVELS.keys())}.")
+
+        self.method = compression.method
+        self.level = compression.level
+        if self.level is None:
+            self.level = DEFAULT_COMPRESSION_LEVELS[compression.method]
+        self.block_size = block_size
+        self.max_pending_blocks = 2 * max(compression.threads, 1)
+
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=max(compression.threads, 1))
+        self.pending_blocks = collections.deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit_block(self, block: bytes):
+        self.pending_blocks.append(self.executor.submit(compress_block, block, self.method, self.level))
+        # bounds the memory used by blocks that are waiting for compression or writing
+        while len(self.pending_blocks) > self.max_pending_blocks:
+            self.file.write(self.pending_blocks.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self.buffer) > 0:
+                self._submit_block(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending_blocks:
+                self.file.write(self.pending_blocks.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compress_block(block: bytes, method: str, level: int) -> bytes:
+    # arrow codecs are not thread-safe, so every block gets its own codec
+    return pa.Codec(method, compression_level=level).compress(block, asbytes=True)
+
+
+def open_output(path: Union[Path, str], compression: Optional[Compression] = None):
+    """
+    Opens a file for binary writing, compressed if a compression method is given
+    :param path: path of the output file, including the compression extension
+    :param compression: compression method, level and number of threads
+    :return: binary file-like object
+    """
+    if compression is None or compression.method == 'none':
+        return open(path, 'wb')
+    return ParallelCompressedFile(path, compression)
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
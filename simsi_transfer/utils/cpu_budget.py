@@ -0,0 +1,88 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CpuBudget:
+    """
+    Hands out thread quotas to the stages of a run from a fixed number of threads, such that stages that run at the
+    same time, e.g. the clustering and the reporter ion extraction, together use about as many threads as requested
+    with --num_threads instead of --num_threads each.
+
+    A stage always gets at least one thread, such that no stage waits for another one to finish. The main thread,
+    which reads the MaxQuant tables while the other stages run, is not counted.
+    """
+
+    def __init__(self, num_threads: int):
+        self.num_threads = max(1, num_threads)
+        self.quotas: Dict[str, int] = dict()
+        self.lock = threading.Lock()
+
+    def available(self) -> int:
+        with self.lock:
+            return self.num_threads - sum(self.quotas.values())
+
+    def acquire(self, stage: str, num_threads: Optional[int] = None) -> int:
+        """
+        Reserves threads for a stage until it is released
+        :param num_threads: number of threads the stage asks for, defaults to all threads
+        :return: number of threads granted to the stage, at most the remaining threads of the budget, but at least 1
+        """
+        if num_threads is None:
+            num_threads = self.num_threads
+        with self.lock:
+            if stage in self.quotas:
+                raise ValueError(f'Stage {stage} already holds {self.quotas[stage]} threads')
+            available = self.num_threads - sum(self.quotas.values())
+            self.quotas[stage] = max(1, min(num_threads, available))
+            logger.info(f'Assigned {self.quotas[stage]} of {self.num_threads} threads to {stage}')
+            return self.quotas[stage]
+
+    def release(self, stage: str):
+        with self.lock:
+            self.quotas.pop(stage, None)
+
+    def run(self, stage: str, function: Callable, *args, **kwargs):
+        """
+        Runs a function and releases the threads of the stage afterwards, e.g. for stages that run in the background
+        """
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.release(stage)
+
+    @contextmanager
+    def quota(self, stage: str, num_threads: Optional[int] = None):
+        """
+        Reserves threads for the duration of a with block and yields the number of granted threads
+        """
+        granted = self.acquire(stage, num_threads)
+        try:
+            yield granted
+        finally:
+            self.release(stage)
+
+
+@contextmanager
+def limit_worker_threads(num_threads: int = 1):
+    """
+    Limits the BLAS and OpenMP thread pools of the current process, e.g. of numpy's np.linalg.lstsq, within a with
+    block. Worker processes that each get one thread of the budget would otherwise start a BLAS thread per core.
+
+    Requires threadpoolctl, which is a dependency of job-pool, without it the thread pools are not limited.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        yield
+        return
+
+    with threadpool_limits(limits=num_threads):
+        yield
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
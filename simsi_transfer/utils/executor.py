@@ -0,0 +1,320 @@
+import os
+import time
+import uuid
+import pickle
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, List, Optional
+
+from .work_queue import WorkQueue, run_worker, HEARTBEAT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+SERIAL = 'serial'
+THREAD = 'thread'
+PROCESS = 'process'
+WARM = 'warm'
+SHARED_FS = 'shared_fs'
+EXECUTOR_BACKENDS = [SERIAL, THREAD, PROCESS, WARM, SHARED_FS]
+
+
+class Executor:
+    """
+    Runs the jobs of one stage, e.g. the conversion of the raw files or the evidence building per raw file. Jobs are
+    submitted like with JobPool.applyAsync, wait() returns their results in the order of submission and releases
+    the workers of the stage, after which no more jobs can be submitted.
+    """
+
+    def submit(self, function: Callable, args: tuple, callback: Optional[Callable] = None):
+        """
+        :param callback: called with the result of the job as soon as it finishes
+        """
+        raise NotImplementedError()
+
+    def wait(self) -> list:
+        raise NotImplementedError()
+
+    def map(self, function: Callable, jobs: List[tuple], callback: Optional[Callable] = None) -> list:
+        for args in jobs:
+            self.submit(function, args, callback)
+        return self.wait()
+
+
+class SerialExecutor(Executor):
+    """
+    Runs each job in the calling thread as soon as it is submitted
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def submit(self, function: Callable, args: tuple, callback: Optional[Callable] = None):
+        result = function(*args)
+        if callback is not None:
+            callback(result)
+        self.results.append(result)
+
+    def wait(self) -> list:
+        return self.results
+
+
+class JobPoolExecutor(Executor):
+    """
+    Runs the jobs in a new JobPool of worker processes, which logs the progress and terminates the workers on errors
+    """
+
+    def __init__(self, num_workers: int, total_jobs: Optional[int] = None):
+        from job_pool import JobPool
+
+        self.pool = JobPool(processes=num_workers, write_progress_to_logger=True, total_jobs=total_jobs)
+
+    def submit(self, function: Callable, args: tuple, callback: Optional[Callable] = None):
+        if callback is not None:
+            self.pool.applyAsync(function, args, callback=callback)
+        else:
+            self.pool.applyAsync(function, args)
+
+    def wait(self) -> list:
+        return self.pool.checkPool()
+
+
+class FuturesExecutor(Executor):
+    """
+    Runs the jobs in a concurrent.futures pool with at most num_workers jobs of this stage running at the same time,
+    such that a persistent pool can be shared by stages that got different numbers of threads
+    """
+
+    def __init__(self, pool, num_workers: int, shutdown_pool: bool = False):
+        """
+        :param shutdown_pool: stop the pool in wait(), for pools that only serve this stage
+        """
+        self.pool = pool
+        self.num_workers = max(1, num_workers)
+        self.shutdown_pool = shutdown_pool
+        self.futures: List[Future] = []
+        self.waiting = deque()
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def submit(self, function: Callable, args: tuple, callback: Optional[Callable] = None):
+        future = Future()
+        self.futures.append(future)
+        with self.lock:
+            self.waiting.append((function, args, callback, future))
+        self._start_waiting_jobs()
+
+    def _start_waiting_jobs(self):
+        while True:
+            with self.lock:
+                if self.running >= self.num_workers or len(self.waiting) == 0:
+                    return
+                function, args, callback, future = self.waiting.popleft()
+                self.running += 1
+            # outside of the lock, the callback runs right away if the job is already done
+            pool_future = self.pool.submit(function, *args)
+            pool_future.add_done_callback(lambda f, c=callback, r=future: self._job_done(f, c, r))
+
+    def _job_done(self, pool_future: Future, callback: Optional[Callable], future: Future):
+        with self.lock:
+            self.running -= 1
+        try:
+            result = pool_future.result()
+            if callback is not None:
+                callback(result)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        self._start_waiting_jobs()
+
+    def wait(self) -> list:
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            with self.lock:
+                self.waiting.clear()
+            if self.shutdown_pool:
+                self.pool.shutdown(cancel_futures=True)
+
+
+class SharedFsExecutor(Executor):
+    """
+    Runs the jobs with workers on any number of nodes through a WorkQueue on a shared file system. The jobs and their
+    results are pickled to files next to the queue, such that the functions have to be importable by the workers,
+    which are started with
+    python -m simsi_transfer.utils.executor worker --work_queue_folder <queue folder>
+    """
+
+    def __init__(self, queue: WorkQueue, heartbeat_timeout: float = HEARTBEAT_TIMEOUT, poll_interval: float = 1.0):
+        self.queue = queue
+        self.heartbeat_timeout = heartbeat_timeout
+        self.poll_interval = poll_interval
+        self.stage_id = uuid.uuid4().hex[:8]
+        self.jobs = []
+
+    def submit(self, function: Callable, args: tuple, callback: Optional[Callable] = None):
+        name = f'{self.stage_id}_{len(self.jobs):06d}'
+        job_file = self.queue.queue_folder / Path('jobs') / Path(f'{name}.pkl')
+        result_file = self.queue.queue_folder / Path('results') / Path(f'{name}.pkl')
+        write_pickle(job_file, (function, args))
+        self.jobs.append((name, result_file, callback))
+        self.queue.put(name, {'job_file': str(job_file.absolute()), 'result_file': str(result_file.absolute())})
+
+    def wait(self) -> list:
+        results = dict()
+        while len(results) < len(self.jobs):
+            for name, result_file, callback in self.jobs:
+                if name not in results and result_file.is_file():
+                    with open(result_file, 'rb') as f:
+                        results[name] = pickle.load(f)
+                    result_file.unlink()
+                    if callback is not None:
+                        callback(results[name])
+            if len(results) == len(self.jobs):
+                break
+
+            for name in self.queue.requeue_stale(self.heartbeat_timeout):
+                logger.warning(f"Worker of task {name} stopped responding, queueing it again")
+            stage_names = {name for name, _, _ in self.jobs}
+            failed_tasks = [(name, error) for name, error in self.queue.get_failed_tasks() if name in stage_names]
+            if len(failed_tasks) > 0:
+                raise RuntimeError(f"Tasks failed: {failed_tasks}")
+            time.sleep(self.poll_interval)
+        return [results[name] for name, _, _ in self.jobs]
+
+
+class ExecutorBackend:
+    """
+    Creates the executors of all stages of a run from one configuration, such that the stages can be run serially,
+    in threads, in a new process pool per stage, in one persistent process pool or by workers on other nodes.
+    """
+
+    def __init__(self, name: str = PROCESS, max_workers: int = 1, work_queue_folder: Optional[Path] = None,
+                 num_local_workers: int = 1):
+        """
+        :param name: one of EXECUTOR_BACKENDS
+        :param max_workers: number of processes of the persistent pool of the 'warm' backend
+        :param work_queue_folder: queue folder on a shared file system for the 'shared_fs' backend
+        :param num_local_workers: number of threads of this process that also run jobs of the 'shared_fs' backend
+        """
+        if name not in EXECUTOR_BACKENDS:
+            raise ValueError(f"Unknown executor backend {name}, expected one of {EXECUTOR_BACKENDS}")
+        if name == SHARED_FS and work_queue_folder is None:
+            raise ValueError("The shared_fs executor backend needs a work queue folder")
+
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.pool = None
+        self.queue = None
+        self.local_workers = []
+        if name == SHARED_FS:
+            self.queue = WorkQueue(work_queue_folder)
+            self.queue.create()
+            for folder in ['jobs', 'results']:
+                (work_queue_folder / Path(folder)).mkdir()
+            logger.info(f"Start workers with: python -m simsi_transfer.utils.executor worker "
+                        f"--work_queue_folder {work_queue_folder.absolute()}")
+            self.local_workers = [threading.Thread(target=run_worker, args=(self.queue, run_task),
+                                                   kwargs={'poll_interval': 1.0}, daemon=True)
+                                  for _ in range(num_local_workers)]
+            for worker in self.local_workers:
+                worker.start()
+
+    def get_executor(self, num_workers: int = 1, total_jobs: Optional[int] = None,
+                     in_background: bool = False) -> Executor:
+        """
+        :param num_workers: number of jobs of the stage that may run at the same time, jobs of stages with a single
+                            worker run in the calling thread, except with the 'shared_fs' backend
+        :param total_jobs: number of jobs that will be submitted, only used for the progress bar
+        :param in_background: run the jobs outside of the calling thread even with a single worker, such that
+                              submit() returns right away, unless the backend is 'serial'
+        """
+        if self.name == SHARED_FS:
+            return SharedFsExecutor(self.queue)
+        if self.name == SERIAL or (num_workers <= 1 and not in_background):
+            return SerialExecutor()
+        if self.name == THREAD:
+            return FuturesExecutor(ThreadPoolExecutor(max_workers=num_workers), num_workers, shutdown_pool=True)
+        if self.name == WARM:
+            if self.pool is None:
+                logger.info(f"Starting a persistent pool of {self.max_workers} worker processes")
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return FuturesExecutor(self.pool, min(num_workers, self.max_workers))
+        return JobPoolExecutor(num_workers, total_jobs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.queue is not None:
+            self.queue.close()
+            for worker in self.local_workers:
+                worker.join()
+            self.local_workers = []
+
+
+def get_executor(backend: Optional[ExecutorBackend], num_workers: int, total_jobs: Optional[int] = None,
+                 in_background: bool = False) -> Executor:
+    """
+    Returns an executor of the backend, or of the default backend with a new process pool per stage
+    """
+    if backend is None:
+        backend = ExecutorBackend()
+    return backend.get_executor(num_workers, total_jobs, in_background)
+
+
+def run_task(task: dict):
+    """
+    Runs a pickled job of a SharedFsExecutor and pickles its result
+    """
+    with open(task['job_file'], 'rb') as f:
+        function, args = pickle.load(f)
+    result = function(*args)
+    write_pickle(Path(task['result_file']), result)
+    os.remove(task['job_file'])
+
+
+def write_pickle(path: Path, content: Any):
+    tmp_file = path.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, path)
+
+
+if __name__ == "__main__":
+    from sys import argv
+    import argparse
+    from ..command_line_interface import ArgumentParserWithLogger
+    from .. import __version__, __copyright__
+
+    # use the package logger instead of just __main__ when running as a module
+    logger = logging.getLogger(__package__ + ".executor")
+
+    desc = f'SIMSI-executor-worker version {__version__}\n{__copyright__}'
+    apars = ArgumentParserWithLogger(
+        description=desc, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    apars.add_argument('command', choices=['worker'],
+                       help='''
+                       worker: runs jobs queued by a SIMSI-Transfer run with --executor shared_fs.
+                       ''')
+
+    apars.add_argument('--work_queue_folder', type=Path, required=True, metavar="DIR",
+                       help='''Work queue folder on the shared file system.''')
+
+    apars.add_argument('--poll_interval', type=float, default=5.0, metavar='S',
+                       help='''Seconds between checks for new tasks.''')
+
+    apars.add_argument('--exit_when_empty', default=False, action='store_true',
+                       help='''Exit as soon as no tasks are pending or running, instead of waiting until the coordinator closes the queue.''')
+
+    args = apars.parse_args(argv[1:])
+
+    logger.info(f'{desc}')
+    logger.info(f'Issued command: {os.path.basename(__file__)} {" ".join(map(str, argv))}')
+
+    run_worker(WorkQueue(args.work_queue_folder), run_task, poll_interval=args.poll_interval,
+               exit_when_empty=args.exit_when_empty)
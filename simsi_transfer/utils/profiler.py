@@ -0,0 +1,301 @@
+"""
+Records the wall time, CPU time, peak memory and table sizes of the stages of a run, which are written to
+SIMSI.profile.json by main.main.
+
+Stages are nested, e.g. the stage 'assign_missing_precursors' within the stage 'evidence' within the stage 'p10' is
+recorded as 'p10/evidence/assign_missing_precursors'. Stages that run more than once with the same name, e.g. the
+evidence building steps of each raw file, are summed up. The CPU time and peak RSS are those of the process running
+the stage, such that stages that run at the same time in different threads are counted in each other's CPU time and
+peak RSS. The peak RSS of a stage is the highest resident set size sampled while the stage runs, by a background
+thread every RSS_SAMPLE_INTERVAL seconds and at the start and end of the stage, so allocations that are freed again
+within a sampling interval can be missed. The CPU time of child processes, e.g. of ThermoRawFileParser and MaRaCluster,
+is counted once the child processes have finished, their memory is not counted.
+"""
+import os
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+_records: Dict[str, dict] = dict()
+_lock = threading.Lock()
+# stack of the names of the running stages and the records of profiled() jobs of the current thread
+_local = threading.local()
+_settings = {'dataframe_memory': False}
+
+RSS_SAMPLE_INTERVAL = 0.1
+# profiles of the running stages of all threads, whose peak RSS is updated by the sampler thread
+_sampled_profiles = set()
+_sampler = {'condition': threading.Condition(), 'thread': None}
+
+
+class StageProfile:
+    """
+    Measurements of a running stage, output() sets the table the stage produced
+    """
+
+    def __init__(self, df: Optional[pd.DataFrame] = None):
+        self.rows_in = get_rows(df)
+        self.memory_in = get_memory(df)
+        self.rows_out = None
+        self.memory_out = None
+        self.peak_rss = None
+
+    def output(self, df: Optional[pd.DataFrame]):
+        self.rows_out = get_rows(df)
+        self.memory_out = get_memory(df)
+
+    def sample_rss(self, rss: Optional[int]):
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss) if self.peak_rss is not None else rss
+
+
+def set_dataframe_memory(enabled: bool):
+    """
+    :param enabled: also record the memory of the input and output tables of the stages, which takes a pass over all
+                    strings of the tables
+    """
+    _settings['dataframe_memory'] = enabled
+
+
+@contextmanager
+def stage(name: str, df: Optional[pd.DataFrame] = None):
+    """
+    Profiles the code within a with block
+    :param df: input table of the stage
+    :return: StageProfile to record the output table of the stage
+    """
+    stack = _get_stack()
+    full_name = '/'.join(stack + [name])
+    profile = StageProfile(df)
+    _start_rss_sampling(profile)
+    start_wall, start_cpu, start_children_cpu = time.perf_counter(), time.process_time(), get_children_cpu_time()
+    stack.append(name)
+    try:
+        yield profile
+    finally:
+        stack.pop()
+        _stop_rss_sampling(profile)
+        children_cpu_time = get_children_cpu_time()
+        _add_record(full_name, {
+            'calls': 1,
+            'wall_time': time.perf_counter() - start_wall,
+            'cpu_time': time.process_time() - start_cpu,
+            'children_cpu_time': children_cpu_time - start_children_cpu if children_cpu_time is not None else None,
+            'peak_rss': profile.peak_rss,
+            'rows_in': profile.rows_in,
+            'rows_out': profile.rows_out,
+            'memory_in': profile.memory_in,
+            'memory_out': profile.memory_out,
+        })
+
+
+def call(name: str, function: Callable, *args, **kwargs):
+    """
+    Profiles a function call, with the first argument as input table and the result as output table if they are
+    dataframes
+    """
+    with stage(name, args[0] if len(args) > 0 and isinstance(args[0], pd.DataFrame) else None) as profile:
+        result = function(*args, **kwargs)
+        if isinstance(result, pd.DataFrame):
+            profile.output(result)
+    return result
+
+
+def profiled(function: Callable) -> Callable:
+    """
+    Wraps a job that runs in a worker, e.g. with Executor.map, such that it returns its stages together with its
+    result. The stages are added to the stages of the calling thread by collect().
+    """
+    return partial(_run_profiled, function, _settings['dataframe_memory'])
+
+
+def _run_profiled(function: Callable, dataframe_memory: bool, *args) -> Tuple[Any, Dict[str, dict]]:
+    previous_stack, previous_records = _get_stack(), getattr(_local, 'records', None)
+    previous_dataframe_memory = _settings['dataframe_memory']
+    _local.stack, _local.records = [], dict()
+    _settings['dataframe_memory'] = dataframe_memory
+    try:
+        result = function(*args)
+        return result, _local.records
+    finally:
+        _local.stack, _local.records = previous_stack, previous_records
+        _settings['dataframe_memory'] = previous_dataframe_memory
+
+
+def collect(outputs: List[Tuple[Any, Dict[str, dict]]]) -> list:
+    """
+    Adds the stages of profiled() jobs as sub-stages of the current stage
+    :return: results of the jobs
+    """
+    prefix = '/'.join(_get_stack())
+    for _, records in outputs:
+        for name, record in records.items():
+            _add_record(f'{prefix}/{name}' if prefix else name, record)
+    return [result for result, _ in outputs]
+
+
+def get_profile() -> Dict[str, dict]:
+    with _lock:
+        return {name: dict(record) for name, record in _records.items()}
+
+
+def reset():
+    with _lock:
+        _records.clear()
+
+
+def write_profile(path: Path, **content):
+    """
+    Writes the recorded stages to a json file
+    :param content: additional entries, e.g. the statistics of each stringency
+    """
+    profile = {'stages': get_profile(), **content}
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2, default=_to_json)
+    logger.info(f'Wrote profile of {len(profile["stages"])} stages to {path}')
+
+
+def log_profile(level: int = logging.INFO):
+    """
+    Logs the wall time and peak RSS of the top-level stages
+    """
+    for name, record in get_profile().items():
+        if '/' in name:
+            continue
+        peak_rss = utils.human_readable_size(record['peak_rss']) if record['peak_rss'] is not None else 'unknown'
+        logger.log(level, f'{name}: {record["wall_time"]:.1f} seconds, peak RSS {peak_rss}')
+
+
+def _to_json(value):
+    # numpy integers and floats, e.g. in the statistics of count_clustering_parameters
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _get_stack() -> List[str]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _add_record(name: str, record: dict):
+    records = getattr(_local, 'records', None)
+    if records is None:
+        with _lock:
+            _merge_record(_records, name, record)
+    else:
+        _merge_record(records, name, record)
+
+
+def _merge_record(records: Dict[str, dict], name: str, record: dict):
+    if name not in records:
+        records[name] = dict(record)
+        return
+    total = records[name]
+    for key, value in record.items():
+        if value is None:
+            continue
+        if total[key] is None:
+            total[key] = value
+        elif key == 'peak_rss':
+            total[key] = max(total[key], value)
+        else:
+            total[key] += value
+
+
+def _start_rss_sampling(profile: StageProfile):
+    profile.sample_rss(get_current_rss())
+    if profile.peak_rss is None:
+        return
+    with _sampler['condition']:
+        _sampled_profiles.add(profile)
+        if _sampler['thread'] is None:
+            _sampler['thread'] = threading.Thread(target=_sample_rss, name='profiler-rss-sampler', daemon=True)
+            _sampler['thread'].start()
+
+
+def _stop_rss_sampling(profile: StageProfile):
+    if profile.peak_rss is None:
+        return
+    with _sampler['condition']:
+        _sampled_profiles.discard(profile)
+        if not _sampled_profiles:
+            _sampler['condition'].notify()
+    profile.sample_rss(get_current_rss())
+
+
+def _sample_rss():
+    # runs as long as any stage is running, a new sampler thread is started by the next stage
+    with _sampler['condition']:
+        while _sampled_profiles:
+            _sampler['condition'].wait(RSS_SAMPLE_INTERVAL)
+            rss = get_current_rss()
+            for profile in _sampled_profiles:
+                profile.sample_rss(rss)
+        _sampler['thread'] = None
+
+
+def _reset_rss_sampler():
+    # the sampler thread does not exist in a forked child process, e.g. a process pool worker
+    _sampled_profiles.clear()
+    _sampler['condition'] = threading.Condition()
+    _sampler['thread'] = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_rss_sampler)
+
+
+def get_rows(df: Optional[pd.DataFrame]) -> Optional[int]:
+    return len(df.index) if df is not None else None
+
+
+def get_memory(df: Optional[pd.DataFrame]) -> Optional[int]:
+    if df is None or not _settings['dataframe_memory']:
+        return None
+    return utils.get_dataframe_memory(df)
+
+
+def get_current_rss() -> Optional[int]:
+    """
+    :return: current resident set size of this process in bytes, None if it cannot be determined
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def get_children_cpu_time() -> Optional[float]:
+    """
+    :return: CPU time of the finished child processes of this process, None if the resource module is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
@@ -0,0 +1,206 @@
+import heapq
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# fraction of the available memory that jobs may use if no memory budget is given
+DEFAULT_MEMORY_FRACTION = 0.8
+
+# seconds between checks of the available memory while jobs wait for admission
+MEMORY_POLL_INTERVAL = 5.0
+
+
+class ScheduledJob(NamedTuple):
+    function: Callable
+    args: tuple
+    # amount of the limited resource that the job occupies while running, e.g. bytes of memory or threads
+    cost: int
+    # relative estimate of the running time, jobs with longer estimated running times are started first
+    duration: float
+
+
+def get_available_memory() -> Optional[int]:
+    """
+    Returns the memory in bytes that can be used without swapping, or None if it cannot be determined
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available
+
+
+def run_memory_aware(jobs: List[ScheduledJob], max_workers: int, memory_budget: Optional[int] = None,
+                     poll_interval: float = MEMORY_POLL_INTERVAL, callback: Optional[Callable] = None) -> list:
+    """
+    Runs jobs with their memory estimates as cost, such that the summed memory estimates of the running jobs stay
+    within the memory budget and below the currently available memory. Smaller jobs fill up the remaining budget, so
+    many small jobs run in parallel while huge jobs run with fewer other jobs.
+
+    :param jobs: functions with their arguments, memory estimates in bytes and running time estimates
+    :param max_workers: maximum number of jobs running at the same time
+    :param memory_budget: maximum summed memory estimate of the running jobs in bytes, defaults to a fraction of the
+                          currently available memory
+    :param poll_interval: seconds between checks of the available memory while jobs are waiting
+    :param callback: called with the result of each job as soon as it finishes
+    :return: results of the jobs in the order of the input list
+    """
+    if memory_budget is None:
+        available_memory = get_available_memory()
+        if available_memory is not None:
+            memory_budget = int(available_memory * DEFAULT_MEMORY_FRACTION)
+    if memory_budget is not None:
+        logger.info(f'Running {len(jobs)} jobs with a memory budget of {memory_budget / 1e9:.1f} GB')
+
+    return run_scheduled(jobs, max_workers, memory_budget, get_available_memory, poll_interval, callback)
+
+
+def run_scheduled(jobs: List[ScheduledJob], max_workers: int, budget: Optional[int] = None,
+                  get_available: Optional[Callable[[], Optional[int]]] = None, poll_interval: float = 1.0,
+                  callback: Optional[Callable] = None) -> list:
+    """
+    Runs jobs in a thread pool, longest first, such that the summed cost of the running jobs stays within the
+    budget. If the longest pending job does not fit, shorter jobs that fit are started instead. A job that exceeds
+    the budget on its own is run once no other job is running.
+
+    The jobs are expected to do their work in subprocesses, e.g. ThermoRawFileParser or MaRaCluster, such that
+    threads suffice.
+    :param jobs: functions with their arguments, costs and running time estimates
+    :param max_workers: maximum number of jobs running at the same time
+    :param budget: maximum summed cost of the running jobs, None for no limit
+    :param get_available: returns the currently available amount of the resource, jobs are only started if their
+                          cost is below it
+    :param poll_interval: seconds between checks of get_available while jobs are waiting
+    :param callback: called with the result of each job as soon as it finishes
+    :return: results of the jobs in the order of the input list
+    """
+    results = [None] * len(jobs)
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i].duration, reverse=True)
+    running = dict()
+    reserved = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max_workers:
+                available = get_available() if get_available is not None and len(running) > 0 else None
+                i = next_admissible_job(jobs, pending, reserved, budget, len(running) == 0, available)
+                if i is None:
+                    break
+                pending.remove(i)
+                logger.debug(f'Starting job {i} with cost {jobs[i].cost}')
+                running[executor.submit(jobs[i].function, *jobs[i].args)] = i
+                reserved += jobs[i].cost
+
+            finished, _ = wait(running.keys(), timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                reserved -= jobs[i].cost
+                results[i] = future.result()
+                if callback is not None:
+                    callback(results[i])
+            if len(finished) > 0:
+                logger.info(f'{len(jobs) - len(pending) - len(running)} / {len(jobs)} jobs done')
+    return results
+
+
+def next_admissible_job(jobs: List[ScheduledJob], pending: List[int], reserved: int, budget: Optional[int],
+                        idle: bool, available: Optional[int] = None) -> Optional[int]:
+    """
+    Returns the longest pending job that fits in the budget and the available amount of the resource, or the longest
+    pending job if no job is running, such that every job eventually runs
+    :param pending: indices of the pending jobs, sorted by decreasing running time estimate
+    """
+    if idle or budget is None:
+        return pending[0]
+
+    for i in pending:
+        if reserved + jobs[i].cost <= budget and (available is None or jobs[i].cost <= available):
+            return i
+    return None
+
+
+def estimate_makespan(jobs: List[ScheduledJob], max_workers: int, budget: Optional[int] = None) -> float:
+    """
+    Simulates run_scheduled with the running time estimates of the jobs as their actual running times
+    :return: time until all jobs are done, in the unit of the running time estimates
+    """
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i].duration, reverse=True)
+    running = []
+    reserved = 0
+    now = 0.0
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < max_workers:
+            i = next_admissible_job(jobs, pending, reserved, budget, len(running) == 0)
+            if i is None:
+                break
+            pending.remove(i)
+            heapq.heappush(running, (now + jobs[i].duration, i))
+            reserved += jobs[i].cost
+
+        now, i = heapq.heappop(running)
+        reserved -= jobs[i].cost
+    return now
+
+
+class BackgroundStages:
+    """
+    Runs pipeline stages in background threads while the main thread continues with stages that do not depend on
+    them, e.g. MaRaCluster clustering while the MaxQuant tables are read. The background stages are expected to do
+    their work in subprocesses, such that they do not compete with the main thread for the GIL.
+
+    Without background threads, stages run right away when they are submitted, in the order of the submissions.
+    """
+
+    def __init__(self, num_threads: int = 1):
+        """
+        :param num_threads: maximum number of stages running in the background, 0 to run stages when they are
+                            submitted
+        """
+        self.executor = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 0 else None
+        self.stages: Dict[str, Future] = dict()
+
+    def submit(self, name: str, function: Callable, *args, **kwargs) -> Future:
+        if self.executor is not None:
+            logger.info(f'Starting {name} in the background')
+            future = self.executor.submit(function, *args, **kwargs)
+        else:
+            future = Future()
+            future.set_result(function(*args, **kwargs))
+        self.stages[name] = future
+        return future
+
+    def wait(self, name: str) -> Any:
+        """
+        Waits until the stage is done and returns its result, exceptions of the stage are raised here
+        """
+        future = self.stages.pop(name)
+        if not future.done():
+            logger.info(f'Waiting for {name} to finish')
+            start = time.time()
+            result = future.result()
+            logger.info(f'Waited {time.time() - start:.0f} seconds for {name}')
+            return result
+        return future.result()
+
+    def close(self):
+        """
+        Waits until all stages are done and stops the background threads
+        """
+        for name in list(self.stages.keys()):
+            self.wait(name)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
@@ -1,5 +1,9 @@
+import os
+import signal
 import logging
+import threading
 import subprocess
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
@@ -9,18 +13,44 @@ def run_simple(cmd):
     process = subprocess.run(cmd.split(), shell=True, check=True)
 
 
-def run(cmd):
+def run(cmd, timeout: Optional[float] = None):
+    """
+    :param timeout: seconds after which the command is killed and a TimeoutError is raised, None to wait forever
+    """
     logger.debug(f"Running subprocess with command: {cmd}")
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-    with process.stdout:
-        log_subprocess_output(process.stdout)
-    process.wait()
+    # in a session of its own, the command can be killed together with the processes started by the shell
+    new_session = timeout is not None and os.name == 'posix'
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, start_new_session=new_session)
+    timer, timed_out = None, threading.Event()
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill, args=(process, new_session, timed_out))
+        timer.start()
+    try:
+        with process.stdout:
+            log_subprocess_output(process.stdout)
+        process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if timed_out.is_set():
+        raise TimeoutError(f"Subprocess did not finish within {timeout} seconds\nCommand: {cmd}")
     if process.returncode != 0:
         raise RuntimeError(
             f"Issues encountered while running subprocess with command\nReturn code: {process.returncode}\nCommand: {cmd}"
         )
 
 
+def kill(process: subprocess.Popen, process_group: bool, killed: threading.Event):
+    killed.set()
+    if process_group:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        process.kill()
+
+
 def log_subprocess_output(pipe):
     for line in iter(pipe.readline, b""):  # b'\n'-separated lines
         logger.debug(line.decode("utf-8").rstrip())
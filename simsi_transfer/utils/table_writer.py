@@ -0,0 +1,376 @@
+import bisect
+import logging
+import pickle
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Union, BinaryIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv
+import pyarrow.parquet as pq
+
+from .compression import Compression, open_output
+
+logger = logging.getLogger(__name__)
+
+# number of rows that are formatted at once, limits the memory used for the formatted strings
+CHUNK_SIZE = 1_000_000
+
+# pandas and pyarrow format floats in this range identically, except for a missing ".0" for integral values
+PLAIN_FLOAT_MIN = 1e-4
+PLAIN_FLOAT_MAX = 1e10
+
+# number of rows per parquet row group, smaller row groups allow for finer-grained predicate pushdown
+ROW_GROUP_SIZE = 100_000
+
+# number of rows per batch in sorted chunk files, limits the memory used when merging many chunks
+CHUNK_BATCH_SIZE = 50_000
+
+# values containing one of these characters would be quoted by pandas
+SPECIAL_CHARACTERS_REGEX = '[\t"\n\r]'
+
+
+def write_tsv(df: pd.DataFrame, output: Union[Path, str, BinaryIO], sort_columns: Optional[List[str]] = None,
+              columns: Optional[List[str]] = None, na_rep: str = 'NaN', include_header: bool = True,
+              chunk_size: int = CHUNK_SIZE, compression: Optional[Compression] = None):
+    """
+    Writes a dataframe as tab-separated file with the same layout as DataFrame.to_csv(sep='\\t', index=False),
+    using vectorized pyarrow formatting instead of row-wise Python formatting.
+
+    :param df: dataframe to write
+    :param output: path or binary file-like object to write to
+    :param sort_columns: columns to sort the rows by before writing
+    :param columns: subset and order of the columns to write, defaults to all columns
+    :param na_rep: string representation of missing values
+    :param include_header: write the column names as first line
+    :param chunk_size: number of rows to format at once
+    :param compression: compresses the output file if output is a path, see compression.ParallelCompressedFile
+    """
+    if columns is None:
+        columns = df.columns.tolist()
+
+    order = None
+    if sort_columns:
+        order = get_sort_order(df, sort_columns)
+
+    if isinstance(output, (str, Path)):
+        with open_output(output, compression) as f:
+            _write_tsv_chunks(df, f, columns, order, na_rep, include_header, chunk_size)
+    else:
+        _write_tsv_chunks(df, output, columns, order, na_rep, include_header, chunk_size)
+
+
+def write_tsv_batches(batches: Iterable[pd.DataFrame], output: Union[Path, str], columns: List[str],
+                      na_rep: str = 'NaN', chunk_size: int = CHUNK_SIZE, compression: Optional[Compression] = None):
+    """
+    Writes consecutive dataframes as one tab-separated file, see write_tsv
+    :param batches: dataframes with the same columns
+    :param output: path to write to
+    :param columns: subset and order of the columns to write
+    :param na_rep: string representation of missing values
+    :param chunk_size: number of rows to format at once
+    :param compression: compresses the output file, see compression.ParallelCompressedFile
+    """
+    with open_output(output, compression) as f:
+        f.write(('\t'.join(map(str, columns)) + '\n').encode('utf-8'))
+        for batch in batches:
+            _write_tsv_chunks(batch, f, columns, None, na_rep, False, chunk_size)
+
+
+def _write_tsv_chunks(df: pd.DataFrame, sink: BinaryIO, columns: List[str], order: Optional[np.ndarray],
+                      na_rep: str, include_header: bool, chunk_size: int):
+    if include_header:
+        sink.write(('\t'.join(map(str, columns)) + '\n').encode('utf-8'))
+
+    write_options = pyarrow.csv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none')
+    for start in range(0, len(df.index), chunk_size):
+        if order is None:
+            chunk = df[columns].iloc[start:start + chunk_size]
+        else:
+            chunk = df[columns].take(order[start:start + chunk_size])
+
+        table = format_table(chunk, na_rep)
+        if needs_quoting(table):
+            # fall back to pandas, which quotes values with special characters
+            sink.write(chunk.to_csv(sep='\t', index=False, header=False, na_rep=na_rep,
+                                    lineterminator='\n').encode('utf-8'))
+            continue
+        pyarrow.csv.write_csv(table, sink, write_options=write_options)
+
+
+def write_parquet(df: pd.DataFrame, output: Union[Path, str, BinaryIO], sort_columns: Optional[List[str]] = None,
+                  columns: Optional[List[str]] = None, row_group_size: int = ROW_GROUP_SIZE):
+    """
+    Writes a dataframe as parquet file with typed columns and dictionary-encoded strings. If sort_columns are given,
+    the rows are sorted before being split into row groups and the sort order is stored in the file metadata, such
+    that readers can skip row groups based on their min/max statistics.
+
+    :param df: dataframe to write
+    :param output: path or binary file-like object to write to
+    :param sort_columns: columns to sort the rows by before writing
+    :param columns: subset and order of the columns to write, defaults to all columns
+    :param row_group_size: maximum number of rows per row group
+    """
+    if columns is None:
+        columns = df.columns.tolist()
+
+    table = pa.table([to_arrow_array(df[c]) for c in columns], names=[str(c) for c in columns])
+    sorting_columns = None
+    if sort_columns:
+        table = table.take(get_sort_order(df, sort_columns))
+        sorting_columns = [pq.SortingColumn(columns.index(c), nulls_first=False) for c in sort_columns if c in columns]
+
+    pq.write_table(table, output, row_group_size=row_group_size, use_dictionary=True,
+                   sorting_columns=sorting_columns, compression='zstd')
+
+
+def write_parquet_batches(batches: Iterable[pd.DataFrame], output: Union[Path, str], template: pd.DataFrame,
+                          sort_columns: Optional[List[str]] = None, columns: Optional[List[str]] = None,
+                          row_group_size: int = ROW_GROUP_SIZE):
+    """
+    Writes consecutive dataframes as one parquet file, see write_parquet
+    :param batches: dataframes with the same columns and dtypes as template, already sorted by sort_columns
+    :param output: path to write to
+    :param template: (empty) dataframe with the columns and dtypes of the batches
+    :param sort_columns: columns the batches are sorted by, stored in the file metadata
+    :param columns: subset and order of the columns to write, defaults to all columns
+    :param row_group_size: minimum number of rows per row group, except for the last one
+    """
+    if columns is None:
+        columns = template.columns.tolist()
+
+    schema = _to_arrow_table(template, columns).schema
+    sorting_columns = None
+    if sort_columns:
+        sorting_columns = [pq.SortingColumn(columns.index(c), nulls_first=False) for c in sort_columns if c in columns]
+
+    with pq.ParquetWriter(output, schema, use_dictionary=True, sorting_columns=sorting_columns,
+                          compression='zstd') as writer:
+        pending_tables, pending_rows = [], 0
+        for batch in batches:
+            pending_tables.append(_to_arrow_table(batch, columns).cast(schema))
+            pending_rows += len(batch.index)
+            if pending_rows >= row_group_size:
+                writer.write_table(pa.concat_tables(pending_tables), row_group_size=row_group_size)
+                pending_tables, pending_rows = [], 0
+        if pending_tables:
+            writer.write_table(pa.concat_tables(pending_tables), row_group_size=row_group_size)
+
+
+def _to_arrow_table(df: pd.DataFrame, columns: List[str]) -> pa.Table:
+    return pa.table([to_arrow_array(df[c]) for c in columns], names=[str(c) for c in columns])
+
+
+def to_arrow_array(x: pd.Series) -> pa.Array:
+    """Converts a column to its arrow type, columns with mixed types are stored as strings."""
+    try:
+        array = pa.array(x, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(x.astype(str).where(x.notna()), type=pa.string(), from_pandas=True)
+    if pa.types.is_null(array.type) and x.dtype == object:
+        # all-missing string columns, keeps the type consistent with batches that do contain strings
+        array = array.cast(pa.string())
+    return array
+
+
+class SortedChunks(NamedTuple):
+    """
+    Chunk files of pre-sorted dataframes that together form one table, see merge_sorted_chunks. If offset_column is
+    set, the offset of each chunk is added to this column, e.g. to make IDs that start at 0 in each chunk unique.
+    """
+    files: List[Path]
+    template: pd.DataFrame
+    offset_column: Optional[str] = None
+    offsets: Optional[List[int]] = None
+
+
+def write_sorted_chunk(df: pd.DataFrame, chunk_file: Path, batch_size: int = CHUNK_BATCH_SIZE):
+    """
+    Stores a sorted dataframe as a sequence of pickled row batches, such that it can be read back one batch at a time
+    :param df: dataframe, sorted by the sort columns later passed to merge_sorted_chunks
+    :param chunk_file: path to write to
+    :param batch_size: number of rows per batch
+    """
+    with open(chunk_file, 'wb') as f:
+        for start in range(0, len(df.index), batch_size):
+            pickle.dump(df.iloc[start:start + batch_size], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_chunk_batches(chunk_file: Path) -> Iterator[pd.DataFrame]:
+    with open(chunk_file, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def merge_sorted_chunks(chunks: SortedChunks, sort_columns: List[str]) -> Iterator[pd.DataFrame]:
+    """
+    Merges pre-sorted chunk files into batches of the sorted table, holding at most two batches per chunk in
+    memory.
+
+    The result is identical to a stable sort of the concatenated chunks, i.e. rows with equal sort keys are ordered
+    by chunk and then by their order within the chunk. Missing values are sorted last.
+    :param chunks: chunk files in concatenation order, written by write_sorted_chunk
+    :param sort_columns: columns the chunks are sorted by
+    :return: iterator over dataframes with the dtypes of chunks.template
+    """
+    readers = [_peekable(read_chunk_batches(f)) for f in chunks.files]
+    batches = [None] * len(readers)
+    keys = [None] * len(readers)
+
+    def load_next_batch(i):
+        batches[i], keys[i] = None, None
+        for batch in readers[i]:
+            if len(batch.index) > 0:
+                batch = batch.astype(chunks.template.dtypes.to_dict())
+                if chunks.offset_column is not None:
+                    batch[chunks.offset_column] += chunks.offsets[i]
+                batches[i] = batch
+                keys[i] = _get_merge_keys(batch, sort_columns)
+                return
+
+    for i in range(len(readers)):
+        load_next_batch(i)
+
+    while any(batch is not None for batch in batches):
+        # rows up to the smallest last key of all batches that continue in the next batch of their chunk are final
+        unfinished_chunks = [i for i, batch in enumerate(batches) if batch is not None and readers[i].has_next()]
+        frontier, frontier_chunk = None, len(readers)
+        if unfinished_chunks:
+            frontier = min(keys[i][-1] for i in unfinished_chunks)
+            frontier_chunk = min(i for i in unfinished_chunks if keys[i][-1] == frontier)
+
+        merged = []
+        for i, batch in enumerate(batches):
+            if batch is None:
+                continue
+            if frontier is None:
+                n = len(batch.index)
+            elif i <= frontier_chunk:
+                # rows equal to the frontier of lower chunks precede those of the frontier chunk
+                n = bisect.bisect_right(keys[i], frontier)
+            else:
+                n = bisect.bisect_left(keys[i], frontier)
+            if n == 0:
+                continue
+            merged.append(batch.iloc[:n])
+            if n == len(batch.index):
+                load_next_batch(i)
+            else:
+                batches[i], keys[i] = batch.iloc[n:], keys[i][n:]
+
+        merged = pd.concat(merged, ignore_index=True)
+        yield merged.take(get_sort_order(merged, sort_columns))
+
+
+def _get_merge_keys(df: pd.DataFrame, sort_columns: List[str]) -> List[tuple]:
+    """Sort keys as comparable tuples, missing values are sorted last."""
+    key_columns = []
+    for c in sort_columns:
+        values = df[c].astype(object).to_numpy()
+        missing = pd.isna(values)
+        key_columns.append([(True, None) if m else (False, v) for v, m in zip(values, missing)])
+    return list(zip(*key_columns))
+
+
+class _peekable:
+    def __init__(self, iterator: Iterator):
+        self.iterator = iterator
+        self.next_items = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_items:
+            return self.next_items.pop()
+        return next(self.iterator)
+
+    def has_next(self) -> bool:
+        if not self.next_items:
+            try:
+                self.next_items.append(next(self.iterator))
+            except StopIteration:
+                return False
+        return True
+
+
+def get_sort_order(df: pd.DataFrame, sort_columns: List[str]) -> np.ndarray:
+    """
+    Computes the row order of df.sort_values(by=sort_columns) with a (multithreaded) stable pyarrow sort.
+    Missing values are sorted last, categoricals are sorted by the order of their categories like in pandas.
+    """
+    sort_table = pa.table({c: to_sort_key(df[c]) for c in sort_columns})
+    return pc.sort_indices(
+        sort_table, sort_keys=[(c, 'ascending') for c in sort_columns], null_placement='at_end'
+    ).to_numpy()
+
+
+def to_sort_key(x: pd.Series) -> pa.Array:
+    if isinstance(x.dtype, pd.CategoricalDtype):
+        codes = x.cat.codes.to_numpy()
+        return pa.array(codes, mask=codes < 0)
+    return to_arrow_array(x)
+
+
+def format_table(df: pd.DataFrame, na_rep: str = 'NaN') -> pa.Table:
+    """Formats every column as strings in the same way as DataFrame.to_csv."""
+    return pa.table([format_column(df.iloc[:, i], na_rep) for i in range(len(df.columns))],
+                    names=[str(c) for c in df.columns])
+
+
+def format_column(x: pd.Series, na_rep: str = 'NaN') -> pa.Array:
+    dtype = x.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        categories = format_column(pd.Series(x.cat.categories), na_rep)
+        codes = x.cat.codes.to_numpy()
+        return pc.fill_null(categories.take(pa.array(codes, mask=codes < 0)), na_rep)
+
+    if pd.api.types.is_bool_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+        return pa.array(np.where(x.to_numpy(), 'True', 'False'))
+
+    if pd.api.types.is_integer_dtype(dtype):
+        return pc.fill_null(pc.cast(pa.array(x, from_pandas=True), pa.string()), na_rep)
+
+    if pd.api.types.is_float_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+        return format_floats(x.to_numpy(), na_rep)
+
+    if pd.api.types.infer_dtype(x, skipna=True) in ['string', 'empty']:
+        return pc.fill_null(pa.array(x, type=pa.string(), from_pandas=True), na_rep)
+
+    return pa.array(x.astype(str).where(x.notna(), na_rep).to_numpy(dtype=object), type=pa.string())
+
+
+def format_floats(values: np.ndarray, na_rep: str = 'NaN') -> pa.Array:
+    """
+    Formats floats like pandas, i.e. with the shortest repr of the float32/float64 value. pyarrow uses the same
+    shortest representation, but drops the ".0" of integral values and switches to scientific notation at
+    different exponents, so values outside of the plain range are formatted by pandas.
+    """
+    missing = np.isnan(values)
+    strings = pc.cast(pa.array(values, mask=missing), pa.string())
+    strings = pc.replace_substring_regex(strings, pattern=r'^(-?\d+)$', replacement=r'\1.0')
+
+    abs_values = np.abs(values.astype('float64'))
+    with np.errstate(invalid='ignore'):
+        plain = (abs_values == 0) | ((abs_values >= PLAIN_FLOAT_MIN) & (abs_values < PLAIN_FLOAT_MAX))
+    other = ~plain & ~missing
+    if other.any():
+        formatted = pd.Series(values[other]).to_csv(index=False, header=False, lineterminator='\n').splitlines()
+        strings = pc.replace_with_mask(strings, pa.array(other), pa.array(formatted, type=pa.string()))
+    return pc.fill_null(strings, na_rep)
+
+
+def needs_quoting(table: pa.Table) -> bool:
+    for column in table.columns:
+        if pc.any(pc.match_substring_regex(column, SPECIAL_CHARACTERS_REGEX)).as_py():
+            return True
+    return False
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
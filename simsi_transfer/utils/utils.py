@@ -1,4 +1,4 @@
-from typing import List, Callable, Any, Union
+from typing import List, Callable, Any, Union, Tuple
 from pathlib import Path
 import logging
 
@@ -28,6 +28,75 @@ def csv_unique(s: str) -> str:
     return ";".join(sorted(set([x for x in s.split(";") if len(x) > 0])))
 
 
+def intern_csv_lists(strings: List[str], drop_empty_items: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Splits semicolon-separated lists once into interned item IDs, stored CSR-style: the items of strings[i] are
+    item_ids[offsets[i]:offsets[i+1]]. The vocabulary is sorted, so sorting item IDs sorts the items lexically.
+    :param strings: unique semicolon-separated lists
+    :param drop_empty_items: remove empty items, e.g. due to trailing semicolons
+    :return: offsets, item_ids and vocabulary
+    """
+    split_strings = [s.split(";") for s in strings]
+    if drop_empty_items:
+        split_strings = [[x for x in items if len(x) > 0] for items in split_strings]
+
+    offsets = np.zeros(len(split_strings) + 1, dtype='int64')
+    np.cumsum([len(items) for items in split_strings], out=offsets[1:])
+
+    items = np.array([x for items in split_strings for x in items], dtype=object)
+    if len(items) == 0:
+        return offsets, np.zeros(0, dtype='int64'), items
+    vocabulary, item_ids = np.unique(items, return_inverse=True)
+    return offsets, item_ids.astype('int64'), vocabulary
+
+
+def _union_csv_lists_grouped(values: pd.Series, groups: pd.Series, keep_single_value: bool,
+                             drop_empty_items: bool) -> pd.Series:
+    """
+    Computes the sorted union of the items in semicolon-separated lists per group. Each distinct list is split only
+    once; union, deduplication and sorting are done on integer item IDs and strings are only joined per group.
+    """
+    group_codes, group_labels = pd.factorize(groups, sort=True)
+    string_codes, strings = pd.factorize(values)
+    strings = np.asarray(strings, dtype=object)
+
+    # unique (group, list) pairs, sorted by group
+    valid = (group_codes >= 0) & (string_codes >= 0)
+    pairs = np.unique((group_codes[valid].astype('int64') << 32) | string_codes[valid])
+    pair_groups, pair_strings = pairs >> 32, pairs & 0xFFFFFFFF
+
+    offsets, item_ids, vocabulary = intern_csv_lists(strings, drop_empty_items)
+
+    # expand each (group, list) pair into (group, item) pairs
+    lengths = np.diff(offsets)[pair_strings]
+    item_positions = np.repeat(offsets[pair_strings] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    group_items = np.unique((np.repeat(pair_groups, lengths) << 32) | item_ids[item_positions])
+
+    group_offsets = np.searchsorted(group_items >> 32, np.arange(len(group_labels) + 1))
+    items = vocabulary[group_items & 0xFFFFFFFF].tolist()
+    result = [";".join(items[start:end]) for start, end in zip(group_offsets[:-1], group_offsets[1:])]
+
+    if keep_single_value:
+        # groups with a single distinct list keep this list as is, groups without lists get NaN
+        num_lists = np.bincount(pair_groups, minlength=len(group_labels))
+        first_list = np.zeros(len(group_labels), dtype='int64')
+        first_list[pair_groups[::-1]] = pair_strings[::-1]
+        result = np.where(num_lists == 1, strings[first_list] if len(strings) > 0 else None, np.array(result, dtype=object))
+        result[num_lists == 0] = np.nan
+
+    return pd.Series(result, index=group_labels, dtype=object)
+
+
+def csv_list_unique_grouped(values: pd.Series, groups: pd.Series) -> pd.Series:
+    """Applies csv_list_unique to values grouped by groups, returns a series indexed by the sorted group labels."""
+    return _union_csv_lists_grouped(values, groups, keep_single_value=True, drop_empty_items=False)
+
+
+def csv_unique_grouped(values: pd.Series, groups: pd.Series) -> pd.Series:
+    """Applies csv_unique to the concatenated values per group, returns a series indexed by the sorted group labels."""
+    return _union_csv_lists_grouped(values, groups, keep_single_value=False, drop_empty_items=True)
+
+
 def list_all(x: pd.Series):
     return x.tolist()
 
@@ -93,13 +162,43 @@ def human_readable_size(size, decimal_places=2):
     return f"{size:.{decimal_places}f} {unit}"
 
 
+def get_dataframe_memory(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
 def get_dataframe_size(df: pd.DataFrame):
-    return human_readable_size(df.memory_usage(deep=True).sum())
+    return human_readable_size(get_dataframe_memory(df))
+
+
+def unify_categories(dfs: List[pd.DataFrame]) -> List[pd.DataFrame]:
+    """
+    Gives categorical columns with the same name a shared, lexically sorted dictionary across all dataframes, such
+    that they stay categorical when concatenating or merging and sort the same way as the original strings.
+    """
+    categorical_columns = {c for df in dfs for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    for column in categorical_columns:
+        categories = set()
+        for df in dfs:
+            if column in df.columns:
+                categories.update(pd.unique(df[column].dropna()))
+        dtype = pd.CategoricalDtype(sorted(categories))
+        for df in dfs:
+            if column in df.columns:
+                df[column] = df[column].astype(dtype)
+    return dfs
+
+
+def add_categories(x: pd.Series, values: pd.Series) -> pd.Series:
+    """Adds the values missing from the dictionary of a categorical series, keeping the categories sorted."""
+    new_categories = set(pd.unique(values.dropna())).difference(x.cat.categories)
+    if len(new_categories) == 0:
+        return x
+    return x.cat.set_categories(sorted(new_categories.union(x.cat.categories)))
 
 
 def process_and_concat(input_folders: List[Any], reading_function: Callable, **kwargs) -> pd.DataFrame:
     tqdm_out = TqdmToLogger(logger, level=logging.INFO)
     return pd.concat(
-        [reading_function(f, **kwargs) for f in tqdm(input_folders, file=tqdm_out, mininterval=10)],
+        unify_categories([reading_function(f, **kwargs) for f in tqdm(input_folders, file=tqdm_out, mininterval=10)]),
         axis=0,
     )
\ No newline at end of file
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds between updates of the modification time of a claimed task by the worker that runs it
+HEARTBEAT_INTERVAL = 30.0
+
+# claimed tasks without a heartbeat for this many seconds are put back in the queue
+HEARTBEAT_TIMEOUT = 300.0
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+CLOSED_MARKER = 'closed'
+
+
+class WorkQueue:
+    """
+    Task queue in a folder on a shared file system, such that workers on different nodes can process the tasks
+    without any other communication. Every task is a JSON file that moves from pending/ to claimed/ and on to done/
+    or failed/. Moving a file is an atomic rename on POSIX file systems, including NFS, so exactly one worker
+    succeeds in claiming a task. Workers update the modification time of their claimed tasks as a heartbeat.
+
+    A claimed task is stored as claimed/<name>.<token>.json with a new token for every claim, such that a worker
+    whose task was requeued, e.g. because its node froze for longer than the heartbeat timeout, cannot complete or
+    fail the claim of the worker that took over the task.
+    """
+
+    def __init__(self, queue_folder: Path):
+        self.queue_folder = queue_folder
+
+    def create(self):
+        """
+        Creates an empty queue, removing the tasks of a previous queue in the same folder
+        """
+        if self.queue_folder.is_dir():
+            shutil.rmtree(self.queue_folder)
+        for state in [PENDING, CLAIMED, DONE, FAILED]:
+            (self.queue_folder / Path(state)).mkdir(parents=True)
+
+    def put(self, name: str, task: dict):
+        """
+        Adds a task, workers claim pending tasks in the order of their names
+        """
+        tmp_file = self.queue_folder / Path(f'{name}.json.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(task, f)
+        os.replace(tmp_file, self.get_task_file(PENDING, name))
+
+    def claim(self) -> Optional[Tuple[str, dict, str]]:
+        """
+        :return: name, content and claim token of the claimed task, or None if no task is pending
+        """
+        for task_file in sorted((self.queue_folder / Path(PENDING)).glob('*.json')):
+            token = uuid.uuid4().hex
+            claimed_file = self.get_claimed_file(task_file.stem, token)
+            try:
+                os.rename(task_file, claimed_file)
+            except FileNotFoundError:
+                # claimed by another worker in the meantime
+                continue
+            os.utime(claimed_file)
+            with open(claimed_file) as f:
+                return task_file.stem, json.load(f), token
+        return None
+
+    def heartbeat(self, name: str, token: str):
+        try:
+            os.utime(self.get_claimed_file(name, token))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, name: str, token: str):
+        self._move(name, token, self.get_task_file(DONE, name))
+
+    def fail(self, name: str, token: str, error: str):
+        failed_file = self.queue_folder / Path(FAILED) / Path(f'{name}.{token}.json')
+        error_file = failed_file.with_suffix('.error')
+        error_file.write_text(error)
+        if not self._move(name, token, failed_file):
+            error_file.unlink()
+
+    def requeue_stale(self, timeout: float = HEARTBEAT_TIMEOUT) -> List[str]:
+        """
+        Puts claimed tasks back in the queue if their worker stopped sending heartbeats, e.g. because its node died
+        :return: names of the requeued tasks
+        """
+        requeued = []
+        now = time.time()
+        for claimed_file in (self.queue_folder / Path(CLAIMED)).glob('*.json'):
+            name = get_task_name(claimed_file)
+            try:
+                if now - claimed_file.stat().st_mtime > timeout:
+                    os.rename(claimed_file, self.get_task_file(PENDING, name))
+                    requeued.append(name)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def count(self, state: str) -> int:
+        return len(list((self.queue_folder / Path(state)).glob('*.json')))
+
+    def get_failed_tasks(self) -> List[Tuple[str, str]]:
+        """
+        :return: names and error messages of the failed tasks
+        """
+        failed = []
+        for task_file in sorted((self.queue_folder / Path(FAILED)).glob('*.json')):
+            error_file = task_file.with_suffix('.error')
+            failed.append((get_task_name(task_file), error_file.read_text() if error_file.is_file() else ''))
+        return failed
+
+    def close(self):
+        """
+        Tells the workers to exit once they finished their current task
+        """
+        (self.queue_folder / Path(CLOSED_MARKER)).touch()
+
+    def is_closed(self) -> bool:
+        return (self.queue_folder / Path(CLOSED_MARKER)).is_file()
+
+    def get_task_file(self, state: str, name: str) -> Path:
+        return self.queue_folder / Path(state) / Path(f'{name}.json')
+
+    def get_claimed_file(self, name: str, token: str) -> Path:
+        return self.queue_folder / Path(CLAIMED) / Path(f'{name}.{token}.json')
+
+    def _move(self, name: str, token: str, to_file: Path) -> bool:
+        """
+        Moves the claimed task out of claimed/ if the claim with this token still exists
+        :return: whether the task was moved
+        """
+        try:
+            os.rename(self.get_claimed_file(name, token), to_file)
+            return True
+        except FileNotFoundError:
+            # the task was requeued in the meantime and is now handled by another worker
+            logger.warning(f'Task {name} was taken over by another worker')
+            return False
+
+
+def get_task_name(task_file: Path) -> str:
+    """
+    :return: name of a claimed or failed task, i.e. the file name without the claim token
+    """
+    return task_file.stem.rsplit('.', 1)[0]
+
+
+def run_worker(queue: WorkQueue, handler: Callable[[dict], None], poll_interval: float = 5.0,
+               exit_when_empty: bool = False, heartbeat_interval: float = HEARTBEAT_INTERVAL):
+    """
+    Claims and runs tasks until the queue is closed
+    :param handler: function that processes the content of a task
+    :param exit_when_empty: also exit if no tasks are pending or claimed
+    """
+    worker_name = f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+    logger.info(f'Worker {worker_name} waiting for tasks in {queue.queue_folder}')
+    while not queue.is_closed():
+        claimed = queue.claim()
+        if claimed is None:
+            if exit_when_empty and queue.count(PENDING) == 0 and queue.count(CLAIMED) == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        name, task, token = claimed
+        logger.info(f'Worker {worker_name} running task {name}')
+        stop_heartbeat = threading.Event()
+        heartbeat_thread = threading.Thread(target=send_heartbeats, args=(queue, name, token, stop_heartbeat,
+                                                                          heartbeat_interval), daemon=True)
+        heartbeat_thread.start()
+        try:
+            handler(task)
+        except Exception as e:
+            logger.error(f'Task {name} failed: {e}')
+            queue.fail(name, token, f'{worker_name}: {e!r}')
+        else:
+            queue.complete(name, token)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+    logger.info(f'Worker {worker_name} exiting')
+
+
+def send_heartbeats(queue: WorkQueue, name: str, token: str, stop: threading.Event, heartbeat_interval: float):
+    while not stop.wait(heartbeat_interval):
+        queue.heartbeat(name, token)
+
+
+if __name__ == '__main__':
+    raise NotImplementedError('Do not run this script.')
@@ -0,0 +1,178 @@
+import os
+import time
+import socket
+
+import simsi_transfer.cache as cache
+import simsi_transfer.thermo_raw as raw
+from simsi_transfer.cache import ContentStore, MZML, fingerprint_file
+
+
+def get_derived_files(mzml_file):
+    return [mzml_file.with_suffix('.dat')]
+
+
+def fake_convert_raw_mzml(input_path, output_path=None, gzip=False, ms_level="2-"):
+    output_path.write_bytes(b'mzML of ' + input_path.read_bytes())
+    return output_path
+
+
+def set_last_used(path, timestamp):
+    os.utime(path, (timestamp, timestamp))
+
+
+def test_fingerprint_file(tmp_path):
+    a = tmp_path / 'a.raw'
+    a.write_bytes(b'x' * 5000)
+    b = tmp_path / 'b.raw'
+    b.write_bytes(b'x' * 5000)
+    assert fingerprint_file(a, sample_size=100) == fingerprint_file(b, sample_size=100)
+
+    b.write_bytes(b'x' * 4999 + b'y')
+    assert fingerprint_file(a, sample_size=100) != fingerprint_file(b, sample_size=100)
+
+    b.write_bytes(b'x' * 5001)
+    assert fingerprint_file(a, sample_size=100) != fingerprint_file(b, sample_size=100)
+
+
+def test_convert_with_content_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw, 'convert_raw_mzml', fake_convert_raw_mzml)
+    mzml_folder = tmp_path / 'cache' / 'mzML'
+    (tmp_path / 'project1').mkdir()
+    (tmp_path / 'project2').mkdir()
+    raw_file = tmp_path / 'project1' / 'run1.raw'
+    raw_file.write_bytes(b'spectra')
+
+    store = ContentStore(tmp_path / 'cache', get_derived_files)
+    mzml_files = raw.convert_raw_mzml_batch([raw_file], mzml_folder, content_store=store)
+    assert mzml_files == [mzml_folder / 'run1.mzML']
+    dat_file = mzml_folder / 'run1.dat'
+    dat_file.write_bytes(b'dat')
+    assert mzml_files[0].read_bytes() == b'mzML of spectra'
+    stored_file = store.get_store_path(MZML, fingerprint_file(raw_file), '.mzML')
+    assert os.path.samefile(stored_file, mzml_files[0])
+
+    # a renamed copy of the raw file is not converted again
+    monkeypatch.setattr(raw, 'convert_raw_mzml', None)
+    renamed_file = tmp_path / 'project2' / 'renamed.raw'
+    renamed_file.write_bytes(b'spectra')
+    mzml_files = raw.convert_raw_mzml_batch([renamed_file], mzml_folder, content_store=store)
+    assert os.path.samefile(stored_file, mzml_files[0])
+    assert store.changed_files == []
+    assert dat_file.is_file()
+
+    # a changed raw file with the same name replaces the stale mzML file
+    monkeypatch.setattr(raw, 'convert_raw_mzml', fake_convert_raw_mzml)
+    raw_file.write_bytes(b'other spectra')
+    mzml_files = raw.convert_raw_mzml_batch([raw_file], mzml_folder, content_store=store)
+    assert mzml_files[0].read_bytes() == b'mzML of other spectra'
+    assert store.changed_files == [mzml_folder / 'run1.mzML']
+    assert not dat_file.is_file()
+    assert stored_file.read_bytes() == b'mzML of spectra'
+
+
+def test_convert_adopts_previous_conversion(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw, 'convert_raw_mzml', None)
+    raw_file = tmp_path / 'run1.raw'
+    raw_file.write_bytes(b'spectra')
+    set_last_used(raw_file, time.time() - 100)
+    mzml_folder = tmp_path / 'cache' / 'mzML'
+    mzml_folder.mkdir(parents=True)
+    (mzml_folder / 'run1.mzML').write_bytes(b'old conversion')
+
+    store = ContentStore(tmp_path / 'cache')
+    raw.convert_raw_mzml_batch([raw_file], mzml_folder, content_store=store)
+    stored_file = store.get_store_path(MZML, fingerprint_file(raw_file), '.mzML')
+    assert stored_file.read_bytes() == b'old conversion'
+    assert os.path.samefile(stored_file, mzml_folder / 'run1.mzML')
+
+
+def test_evict(tmp_path):
+    cache_folder = tmp_path / 'cache'
+    store = ContentStore(cache_folder)
+    dat_folder = cache_folder / 'dat_files'
+    dat_folder.mkdir(parents=True)
+    mzml_folder = cache_folder / 'mzML'
+
+    for i in range(3):
+        mzml_file = mzml_folder / f'run{i}.mzML'
+        mzml_file.parent.mkdir(exist_ok=True)
+        mzml_file.write_bytes(b'm' * 100)
+        store.add(MZML, f'{i:032x}', mzml_file)
+        set_last_used(store.get_store_path(MZML, f'{i:032x}', '.mzML'), store.start_time - 1000 + i)
+        (dat_folder / f'run{i}.dat').write_bytes(b'd' * 50)
+        set_last_used(dat_folder / f'run{i}.dat', store.start_time - 2000 + i)
+    used_file = dat_folder / 'run0.dat'
+
+    # hardlinked mzML files count once, the oldest files go first
+    store.evict(250, [mzml_folder, dat_folder], used_files=[used_file])
+    assert not (mzml_folder / 'run0.mzML').exists()
+    assert not store.get_store_path(MZML, f'{0:032x}', '.mzML').exists()
+    assert used_file.exists()
+    assert not (dat_folder / 'run1.dat').exists()
+    assert not (dat_folder / 'run2.dat').exists()
+    assert (mzml_folder / 'run1.mzML').exists()
+    assert (mzml_folder / 'run2.mzML').exists()
+
+    # files of the current run are kept even if the cache stays above the limit
+    (dat_folder / 'new.dat').write_bytes(b'n' * 500)
+    store.evict(0, [mzml_folder, dat_folder], used_files=[used_file])
+    assert (dat_folder / 'new.dat').exists()
+    assert used_file.exists()
+    assert sorted(p.name for p in mzml_folder.iterdir()) == []
+
+
+def test_evict_keeps_files_leased_by_concurrent_run(tmp_path):
+    cache_folder = tmp_path / 'cache'
+    mzml_folder = cache_folder / 'mzML'
+    mzml_folder.mkdir(parents=True)
+    previous_run = ContentStore(cache_folder)
+    for i in range(2):
+        mzml_file = mzml_folder / f'run{i}.mzML'
+        mzml_file.write_bytes(b'm' * 100)
+        previous_run.add(MZML, f'{i:032x}', mzml_file)
+        set_last_used(mzml_file, previous_run.start_time - 1000)
+    previous_run.release()
+
+    # a concurrent run uses run0, without updating its access time
+    other_run = ContentStore(cache_folder)
+    # the dat file of run0 does not exist yet when it is leased
+    dat_file = cache_folder / 'dat_files' / 'run0.dat'
+    other_run.lease([mzml_folder / 'run0.mzML', dat_file])
+    dat_file.parent.mkdir()
+    dat_file.write_bytes(b'd' * 100)
+    set_last_used(dat_file, previous_run.start_time - 1000)
+
+    # a later run that shares the cache starts and evicts everything it does not use itself
+    store = ContentStore(cache_folder)
+    store.start_time = previous_run.start_time + 10
+    store.evict(0, [mzml_folder, dat_file.parent])
+    assert (mzml_folder / 'run0.mzML').exists()
+    assert other_run.get_store_path(MZML, f'{0:032x}', '.mzML').exists()
+    assert dat_file.exists()
+    assert not (mzml_folder / 'run1.mzML').exists()
+
+    other_run.release()
+    store.evict(0, [mzml_folder, dat_file.parent])
+    assert not (mzml_folder / 'run0.mzML').exists()
+    assert not dat_file.exists()
+
+
+def test_stale_leases(tmp_path, monkeypatch):
+    store = ContentStore(tmp_path / 'cache')
+    store.lease([tmp_path / 'own.mzML'])
+    ContentStore(tmp_path / 'cache').lease([tmp_path / 'a.mzML'])
+    assert store.get_leased_files() == [tmp_path / 'a.mzML']
+
+    # a lease of a process on this host that is no longer running
+    dead_lease = store.lease_folder / f'{socket.gethostname()}_{2 ** 22 + 1}_abcd.lease'
+    dead_lease.write_text(f'{tmp_path / "b.mzML"}\n')
+    monkeypatch.setattr(cache, 'is_process_running', lambda pid: pid == os.getpid())
+    # a lease of another host expires after LEASE_TIMEOUT without new entries
+    old_lease = store.lease_folder / 'other_host_1_abcd.lease'
+    old_lease.write_text(f'{tmp_path / "c.mzML"}\n')
+    set_last_used(old_lease, time.time() - cache.LEASE_TIMEOUT - 1)
+    new_lease = store.lease_folder / 'other_host_2_abcd.lease'
+    new_lease.write_text(f'{tmp_path / "d.mzML"}\n')
+
+    assert sorted(store.get_leased_files()) == [tmp_path / 'a.mzML', tmp_path / 'd.mzML']
+    assert not dead_lease.exists() and not old_lease.exists()
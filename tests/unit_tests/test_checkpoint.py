@@ -0,0 +1,106 @@
+import pandas as pd
+import pytest
+
+from simsi_transfer.checkpoint import StageCheckpoints
+
+
+def write_output(path, df):
+    df.to_csv(path, sep='\t', index=False)
+    return [path]
+
+
+def test_checkpoint_resumes_complete_stage(tmp_path):
+    input_file = tmp_path / 'msms.txt'
+    input_file.write_text('id\n1\n')
+    df = pd.DataFrame({'id': [1, 2]})
+    calls = []
+
+    def stage(value):
+        calls.append(value)
+        return df
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    key = checkpoints.get_key({'maximum_pep': 100}, [input_file])
+    pd.testing.assert_frame_equal(checkpoints.run('transfer_p10', key, stage, 1), df)
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    assert checkpoints.is_complete('transfer_p10', key)
+    pd.testing.assert_frame_equal(checkpoints.run('transfer_p10', key, stage, 2), df)
+    assert checkpoints.run('transfer_p10', key, stage, 3, needed=False) is None
+    assert calls == [1]
+
+
+def test_checkpoint_invalidated_by_changed_inputs(tmp_path):
+    input_file = tmp_path / 'msms.txt'
+    input_file.write_text('id\n1\n')
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    key = checkpoints.get_key({'maximum_pep': 100}, [input_file])
+    checkpoints.run('transfer_p10', key, lambda: 'result')
+
+    assert checkpoints.get_key({'maximum_pep': 100}, [input_file]) == key
+    assert checkpoints.get_key({'maximum_pep': 50}, [input_file]) != key
+    downstream_key = checkpoints.get_key({}, [], [key])
+
+    input_file.write_text('id\n2\n')
+    changed_key = checkpoints.get_key({'maximum_pep': 100}, [input_file])
+    assert changed_key != key
+    assert checkpoints.get_key({}, [], [changed_key]) != downstream_key
+    assert not StageCheckpoints(tmp_path / 'checkpoints').is_complete('transfer_p10', changed_key)
+
+
+def test_checkpoint_invalidated_by_changed_byte_in_large_input(tmp_path):
+    input_file = tmp_path / 'sample.mzML'
+    content = bytearray(b'a' * (4 * 1024 * 1024))
+    input_file.write_bytes(content)
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    key = checkpoints.get_key({}, [input_file])
+
+    # outside of the start, middle and end blocks sampled by the content store fingerprint
+    content[len(content) // 4] = ord('b')
+    input_file.write_bytes(content)
+    assert checkpoints.get_key({}, [input_file]) != key
+
+
+def test_checkpoint_tracks_exports(tmp_path):
+    output_file = tmp_path / 'p10_msms.txt'
+    pending = []
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    key = checkpoints.get_key({})
+    checkpoints.start('transfer_p10', key)
+    export = checkpoints.export('transfer_p10', lambda function, *args: pending.append((function, args)))
+    export(write_output, output_file, pd.DataFrame({'id': [1]}))
+    checkpoints.finish('transfer_p10')
+
+    # the stage is not complete until its output tables are written
+    assert not StageCheckpoints(tmp_path / 'checkpoints').is_complete('transfer_p10', key)
+    function, args = pending.pop()
+    function(*args)
+    assert StageCheckpoints(tmp_path / 'checkpoints').is_complete('transfer_p10', key)
+
+    output_file.unlink()
+    assert not StageCheckpoints(tmp_path / 'checkpoints').is_complete('transfer_p10', key)
+
+
+def test_checkpoint_failed_stage_is_not_complete(tmp_path):
+    def fail():
+        raise ValueError('evidence building failed')
+
+    checkpoints = StageCheckpoints(tmp_path / 'checkpoints')
+    key = checkpoints.get_key({})
+    checkpoints.run('evidence_p10', key, lambda: 'result')
+    with pytest.raises(ValueError, match='evidence building failed'):
+        checkpoints.run('evidence_p10', checkpoints.get_key({'maximum_pep': 50}), fail)
+    assert not StageCheckpoints(tmp_path / 'checkpoints').is_complete('evidence_p10', key)
+
+
+def test_checkpoint_disabled(tmp_path):
+    checkpoints = StageCheckpoints(None)
+    key = checkpoints.get_key({'maximum_pep': 100}, [tmp_path / 'missing.txt'])
+    assert key is None
+    assert checkpoints.run('transfer_p10', key, lambda: 'result') == 'result'
+    assert not checkpoints.is_complete('transfer_p10', key)
+    export = print
+    assert checkpoints.export('transfer_p10', export) is export
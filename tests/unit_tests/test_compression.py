@@ -0,0 +1,30 @@
+import gzip
+
+import pytest
+import pyarrow as pa
+
+from simsi_transfer.utils.compression import Compression, ParallelCompressedFile, open_output
+
+
+@pytest.mark.parametrize('method', ['gzip', 'zstd'])
+def test_parallel_compressed_file(tmp_path, method):
+    data = b''.join(f'line\t{i}\n'.encode() for i in range(10000))
+    path = tmp_path / f'out.txt{Compression(method).extension}'
+    with ParallelCompressedFile(path, Compression(method, level=1, threads=3), block_size=1000) as f:
+        f.write(data[:12345])
+        f.write(data[12345:])
+
+    if method == 'gzip':
+        assert gzip.decompress(path.read_bytes()) == data
+    assert pa.input_stream(str(path), compression=method).read() == data
+
+
+def test_open_output_uncompressed(tmp_path):
+    with open_output(tmp_path / 'out.txt', Compression('none')) as f:
+        f.write(b'abc')
+    assert (tmp_path / 'out.txt').read_bytes() == b'abc'
+
+
+def test_invalid_compression_method(tmp_path):
+    with pytest.raises(ValueError):
+        ParallelCompressedFile(tmp_path / 'out.txt', Compression('bz2'))
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from simsi_transfer.utils.cpu_budget import CpuBudget, limit_worker_threads
+
+
+def test_cpu_budget_shares_threads():
+    budget = CpuBudget(8)
+    assert budget.acquire('reporter ion extraction', 3) == 3
+    assert budget.acquire('clustering') == 5
+    assert budget.available() == 0
+
+    budget.release('reporter ion extraction')
+    with budget.quota('evidence building') as num_threads:
+        assert num_threads == 3
+    assert budget.available() == 3
+
+
+def test_cpu_budget_at_least_one_thread():
+    budget = CpuBudget(2)
+    assert budget.acquire('conversion') == 2
+    assert budget.acquire('clustering') == 1
+    assert budget.acquire('reporter ion extraction', 0) == 1
+
+
+def test_cpu_budget_duplicate_stage():
+    budget = CpuBudget(4)
+    budget.acquire('clustering', 1)
+    with pytest.raises(ValueError, match='clustering'):
+        budget.acquire('clustering', 1)
+
+
+def test_cpu_budget_run_releases_on_error():
+    def fail():
+        raise ValueError('clustering failed')
+
+    budget = CpuBudget(4)
+    budget.acquire('clustering')
+    with pytest.raises(ValueError, match='clustering failed'):
+        budget.run('clustering', fail)
+    assert budget.available() == 4
+
+
+def test_limit_worker_threads():
+    threadpoolctl = pytest.importorskip('threadpoolctl')
+    with limit_worker_threads(1):
+        np.linalg.lstsq(np.eye(3), np.ones(3), rcond=None)
+        assert all(pool['num_threads'] == 1 for pool in threadpoolctl.threadpool_info())
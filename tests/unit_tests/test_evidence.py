@@ -103,3 +103,27 @@ class TestCalculateEvidenceColumns:
         assert calculated_evidence.loc[2, "Reverse"] == "+"
         assert calculated_evidence.loc[2, "Transferred spectra count"] == 1
         
+
+
+def test_build_evidence_streamed_one_group_at_a_time(tmp_path, monkeypatch):
+    """
+    The jobs are submitted while iterating over the raw files, such that a serial run builds the evidence of a raw
+    file before the next raw file is grouped
+    """
+    events = []
+
+    def get_evidence_groups(summary, evidence, allpeptides, plex):
+        for raw_file in ["a", "b"]:
+            events.append(f"group {raw_file}")
+            yield raw_file, (pd.DataFrame({"Raw file": [raw_file]}), evidence, allpeptides, plex)
+
+    def build_evidence_chunk(summary, evidence, allpeptides, plex, chunk_file):
+        events.append(f"build {summary['Raw file'].iloc[0]}")
+        return pd.DataFrame({"id": pd.Series([], dtype="int64")}), 1
+
+    monkeypatch.setattr(ev, "get_evidence_groups", get_evidence_groups)
+    monkeypatch.setattr(ev, "build_evidence_chunk", build_evidence_chunk)
+    chunks = ev.build_evidence_streamed(pd.DataFrame({"Raw file": ["a", "b"]}), pd.DataFrame(), pd.DataFrame(), 11,
+                                        1, tmp_path)
+    assert events == ["group a", "build a", "group b", "build b"]
+    assert chunks.offsets == [0, 1]
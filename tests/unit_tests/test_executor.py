@@ -0,0 +1,71 @@
+import operator
+import threading
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from simsi_transfer.utils.executor import ExecutorBackend, FuturesExecutor, SerialExecutor, EXECUTOR_BACKENDS
+
+
+def make_backend(name, tmp_path):
+    return ExecutorBackend(name, max_workers=2, work_queue_folder=tmp_path / 'queue')
+
+
+@pytest.mark.parametrize('name', EXECUTOR_BACKENDS)
+def test_executor_backends(name, tmp_path):
+    backend = make_backend(name, tmp_path)
+    try:
+        for _ in range(2):
+            # stages reuse the backend
+            finished = []
+            executor = backend.get_executor(num_workers=2, total_jobs=5)
+            results = executor.map(operator.add, [(i, 10) for i in range(5)], callback=finished.append)
+            assert results == [10, 11, 12, 13, 14]
+            assert sorted(finished) == results
+    finally:
+        backend.close()
+
+
+# JobPool terminates its workers on errors, which is tested in job-pool itself
+@pytest.mark.parametrize('name', ['serial', 'thread', 'warm', 'shared_fs'])
+def test_executor_backends_error(name, tmp_path):
+    backend = make_backend(name, tmp_path)
+    try:
+        with pytest.raises(Exception, match='division by zero'):
+            backend.get_executor(num_workers=2).map(operator.truediv, [(1, 1), (1, 0)])
+    finally:
+        backend.close()
+
+
+def test_single_worker_runs_in_calling_thread(tmp_path):
+    backend = ExecutorBackend('process')
+    assert isinstance(backend.get_executor(num_workers=1), SerialExecutor)
+    assert not isinstance(backend.get_executor(num_workers=1, in_background=True), SerialExecutor)
+
+
+def test_futures_executor_limits_running_jobs():
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def job(i):
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+        threading.Event().wait(0.01)
+        with lock:
+            running.remove(i)
+        return i
+
+    pool = ThreadPoolExecutor(max_workers=8)
+    executor = FuturesExecutor(pool, num_workers=2)
+    assert executor.map(job, [(i,) for i in range(10)]) == list(range(10))
+    assert max(max_running) == 2
+    pool.shutdown()
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match='Unknown executor backend'):
+        ExecutorBackend('cluster')
+    with pytest.raises(ValueError, match='work queue folder'):
+        ExecutorBackend('shared_fs')
@@ -1,6 +1,293 @@
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
 import simsi_transfer.maracluster as cluster
 
 
 def test_get_file_name():
     assert cluster.get_file_name('/this/is/a/file.mzML') == 'file'
 
+
+
+def test_read_cluster_results(tmp_path):
+    (tmp_path / 'MaRaCluster.clusters_p10.tsv').write_text(
+        '/data/b.mzML\t12\t0\n/data/a.mzML\t3\t0\n\n/other/b.mzML\t7\t1\n')
+
+    result = cluster.read_cluster_results(tmp_path, 'p10')
+    assert result['Raw file'].tolist() == ['b', 'a', 'b']
+    assert result['Raw file'].cat.categories.tolist() == ['a', 'b']
+    assert result['scanID'].tolist() == [12, 3, 7]
+    assert result['clusterID'].tolist() == [0, 0, 1]
+    assert result['scanID'].dtype == 'int32' and result['clusterID'].dtype == 'int32'
+    assert (tmp_path / 'MaRaCluster.clusters_p10.feather').is_file()
+
+    # the binary copy is used as long as it is newer than the clusters file
+    (tmp_path / 'MaRaCluster.clusters_p10.tsv').write_text('/data/c.mzML\t1\t0\n')
+    os.utime(tmp_path / 'MaRaCluster.clusters_p10.tsv', (0, 0))
+    assert cluster.read_cluster_results(tmp_path, 'p10')['Raw file'].tolist() == ['b', 'a', 'b']
+
+    os.utime(tmp_path / 'MaRaCluster.clusters_p10.tsv')
+    assert cluster.read_cluster_results(tmp_path, 'p10')['Raw file'].tolist() == ['c']
+
+
+def test_get_precursor_bin_jobs(tmp_path):
+    for name, size in [('1.dat', 100), ('2.dat', 10), ('3.dat', 10), ('4.dat', 1000)]:
+        (tmp_path / name).write_bytes(b'x' * size)
+
+    jobs = cluster.get_precursor_bin_jobs(tmp_path, ['1.dat', '2.dat', '3.dat', '4.dat'], 8, 2)
+    assert [job.cost for job in jobs] == [1, 1, 1, 7]
+    assert jobs[3].args == (tmp_path, '4.dat', 7)
+    assert jobs[3].duration == pytest.approx(1000 * (0.1 + 0.9 / 7))
+
+    # bins whose threads grow with their size are still ordered by size, with size / threads 4.dat would be
+    # estimated to finish before 1.dat
+    jobs = cluster.get_precursor_bin_jobs(tmp_path, ['1.dat', '2.dat', '4.dat'], 64, 8)
+    assert [job.cost for job in jobs] == [2, 1, 22]
+    assert jobs[2].duration > jobs[0].duration > jobs[1].duration
+
+
+def test_run_maracluster_pvalue_precursor_bin_timeout(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(cluster, 'run_maracluster', lambda cmd, num_threads=1, timeout=None: commands.append(timeout))
+    cluster.run_maracluster_pvalue_precursor_bin(tmp_path, '1.dat', tmp_path / '1.dat.pvalue_tree.tsv')
+    assert commands == [cluster.PRECURSOR_BIN_TIMEOUT]
+
+
+def fake_pvalue_precursor_bin(started):
+    def run(folder, dat_bin_file, pvalue_tree_file, num_threads):
+        started.append((dat_bin_file, num_threads))
+        pvalue_tree_file.write_text(f'tree of {dat_bin_file}\n')
+    return run
+
+
+def test_run_precursor_bins(tmp_path, monkeypatch):
+    for name, size in [('1.dat', 100), ('2.dat', 10), ('3.dat', 1000)]:
+        (tmp_path / name).write_bytes(b'x' * size)
+    started = []
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', fake_pvalue_precursor_bin(started))
+
+    cluster.run_precursor_bins(tmp_path, ['1.dat', '2.dat', '3.dat'], 4, 1)
+    assert started[0] == ('3.dat', 3)
+    assert sorted(started) == [('1.dat', 1), ('2.dat', 1), ('3.dat', 3)]
+
+
+def test_run_precursor_bins_resume(tmp_path, monkeypatch):
+    dat_bin_files = ['1.dat', '2.dat', '3.dat']
+    for name in dat_bin_files:
+        (tmp_path / name).write_bytes(b'x' * 10)
+    started = []
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', fake_pvalue_precursor_bin(started))
+    cluster.run_precursor_bins(tmp_path, dat_bin_files, 1, 1)
+
+    # a rerun only computes bins with missing, incomplete or modified p-value trees
+    started.clear()
+    (tmp_path / '1.dat.done').unlink()
+    cluster.get_pvalue_tree_file(tmp_path, '2.dat').write_text('tree of 2.dat\npartial')
+    cluster.run_precursor_bins(tmp_path, dat_bin_files, 1, 1)
+    assert sorted(started) == [('1.dat', 1), ('2.dat', 1)]
+
+    started.clear()
+    cluster.run_precursor_bins(tmp_path, dat_bin_files, 1, 1)
+    assert started == []
+
+
+def test_run_precursor_bin_incomplete_tree(tmp_path, monkeypatch):
+    (tmp_path / '1.dat').write_bytes(b'x')
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin',
+                        lambda folder, dat_bin_file, pvalue_tree_file, num_threads: pvalue_tree_file.write_text('a'))
+    with pytest.raises(RuntimeError):
+        cluster.run_precursor_bin(tmp_path, '1.dat')
+    assert not cluster.is_precursor_bin_done(tmp_path, '1.dat')
+    # neither a partial p-value tree nor the file of the attempt is left behind
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['1.dat']
+
+
+def test_run_precursor_bin_concurrent_attempts(tmp_path, monkeypatch):
+    """
+    A worker that stopped responding and a worker that took over its bin compute the same bin at the same time
+    """
+    (tmp_path / '1.dat').write_bytes(b'x')
+    first_attempt_started, second_attempt_done = threading.Event(), threading.Event()
+
+    def pvalue(folder, dat_bin_file, pvalue_tree_file, num_threads):
+        if not first_attempt_started.is_set():
+            first_attempt_started.set()
+            pvalue_tree_file.write_text('partial tree of the first attempt')
+            second_attempt_done.wait(timeout=5)
+            pvalue_tree_file.write_text('tree of the first attempt\n')
+        else:
+            pvalue_tree_file.write_text('tree of the second attempt\n')
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', pvalue)
+
+    first_attempt = threading.Thread(target=cluster.run_precursor_bin, args=(tmp_path, '1.dat'))
+    first_attempt.start()
+    assert first_attempt_started.wait(timeout=5)
+    cluster.run_precursor_bin(tmp_path, '1.dat')
+    assert cluster.is_precursor_bin_done(tmp_path, '1.dat')
+    second_attempt_done.set()
+    first_attempt.join()
+
+    assert cluster.get_pvalue_tree_file(tmp_path, '1.dat').read_text() == 'tree of the first attempt\n'
+    assert cluster.is_precursor_bin_done(tmp_path, '1.dat')
+
+
+def test_has_valid_index(tmp_path):
+    (tmp_path / 'MaRaCluster.dat_file_list.txt').write_text(f'{tmp_path}/1.dat\n')
+    (tmp_path / 'MaRaCluster.peak_counts.dat').write_bytes(b'')
+    (tmp_path / '1.dat').write_bytes(b'')
+    mzml_file = tmp_path / 'a.mzML'
+    mzml_file.write_text('spectra')
+    batch_file = cluster.create_batch_file(tmp_path, [mzml_file])
+    index_key = cluster.get_index_key(batch_file, [mzml_file])
+    assert not cluster.has_valid_index(tmp_path, index_key)
+
+    cluster.write_marker(tmp_path / cluster.INDEX_MARKER, index_key)
+    assert cluster.has_valid_index(tmp_path, index_key)
+
+    # same path, different content
+    mzml_file.write_text('new spectra')
+    assert not cluster.has_valid_index(tmp_path, cluster.get_index_key(batch_file, [mzml_file]))
+
+    (tmp_path / '1.dat').unlink()
+    assert not cluster.has_valid_index(tmp_path, index_key)
+
+
+def fake_maracluster(monkeypatch, commands):
+    """
+    Replaces the MaRaCluster commands by an index that puts the spectra of all mzML files into a single precursor
+    bin, such that the bin changes whenever an mzML file changes
+    """
+    def index(batch_file, maracluster_folder, dat_folder, num_threads=1):
+        commands.append('index')
+        mzml_files = [Path(line.rstrip()) for line in batch_file.read_text().splitlines()]
+        for mzml_file in mzml_files:
+            dat_file = cluster.get_dat_file(dat_folder, mzml_file)
+            if not dat_file.is_file():
+                dat_file.write_text(mzml_file.read_text())
+        (maracluster_folder / '1.dat').write_text(
+            ''.join(cluster.get_dat_file(dat_folder, f).read_text() for f in mzml_files))
+        (maracluster_folder / 'MaRaCluster.peak_counts.dat').write_bytes(b'peaks')
+        (maracluster_folder / 'MaRaCluster.dat_file_list.txt').write_text(f'{maracluster_folder}/1.dat\n')
+
+    def pvalue(maracluster_folder, dat_bin_file, pvalue_tree_file, num_threads=1):
+        commands.append('pvalue')
+        fake_pvalue_precursor_bin([])(maracluster_folder, dat_bin_file, pvalue_tree_file, num_threads)
+
+    monkeypatch.setattr(cluster, 'run_maracluster_index', index)
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', pvalue)
+    monkeypatch.setattr(cluster, 'run_maracluster_batch', lambda *args: commands.append('batch'))
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_cluster_mzml_files_changed_mzml_content(tmp_path, monkeypatch, incremental):
+    maracluster_folder, dat_folder = tmp_path / 'maracluster_output', tmp_path / 'dat_files'
+    dat_folder.mkdir()
+    mzml_files = [tmp_path / 'a.mzML', tmp_path / 'b.mzML']
+    for mzml_file in mzml_files:
+        mzml_file.write_text(f'spectra of {mzml_file.stem}\n')
+    commands = []
+    fake_maracluster(monkeypatch, commands)
+
+    cluster.cluster_mzml_files(mzml_files, [10], maracluster_folder, dat_folder, 1, 1, incremental=incremental)
+    assert commands == ['index', 'pvalue', 'batch']
+
+    commands.clear()
+    cluster.cluster_mzml_files(mzml_files, [10], maracluster_folder, dat_folder, 1, 1, incremental=incremental)
+    assert commands == ['batch']
+
+    # the mzML file of a changed raw file is converted again under the same path, main.py removes its dat file
+    # through the content store unless clustering is incremental
+    commands.clear()
+    mzml_files[1].write_text('new spectra of b\n')
+    if not incremental:
+        cluster.get_dat_file(dat_folder, mzml_files[1]).unlink()
+    cluster.cluster_mzml_files(mzml_files, [10], maracluster_folder, dat_folder, 1, 1, incremental=incremental)
+    assert commands == ['index', 'pvalue', 'batch']
+    assert 'new spectra of b' in (maracluster_folder / '1.dat').read_text()
+    assert cluster.has_valid_index(maracluster_folder, cluster.get_index_key(maracluster_folder / 'file_list.txt',
+                                                                             mzml_files))
+
+
+def test_cluster_mzml_files_incremental_stale_dat_file(tmp_path, monkeypatch):
+    maracluster_folder, dat_folder = tmp_path / 'maracluster_output', tmp_path / 'dat_files'
+    dat_folder.mkdir()
+    mzml_files = [tmp_path / 'a.mzML', tmp_path / 'b.mzML']
+    for mzml_file in mzml_files:
+        mzml_file.write_text(f'spectra of {mzml_file.stem}\n')
+    commands = []
+    fake_maracluster(monkeypatch, commands)
+    cluster.cluster_mzml_files(mzml_files, [10], maracluster_folder, dat_folder, 1, 1, incremental=True)
+
+    # a dat file of unknown origin is removed, its mzML file has to be indexed again even though it did not change
+    commands.clear()
+    cluster.get_dat_file_marker(cluster.get_dat_file(dat_folder, mzml_files[0])).unlink()
+    cluster.cluster_mzml_files(mzml_files, [10], maracluster_folder, dat_folder, 1, 1, incremental=True)
+    assert commands[0] == 'index'
+    assert cluster.get_dat_file_marker(cluster.get_dat_file(dat_folder, mzml_files[0])).is_file()
+
+
+def test_run_precursor_bins_distributed(tmp_path, monkeypatch):
+    maracluster_folder = tmp_path / 'maracluster_output'
+    maracluster_folder.mkdir()
+    dat_bin_files = [f'{i}.dat' for i in range(6)]
+    for i, name in enumerate(dat_bin_files):
+        (maracluster_folder / name).write_bytes(b'x' * (i + 1))
+    started = []
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', fake_pvalue_precursor_bin(started))
+
+    cluster.run_precursor_bins_distributed(maracluster_folder, dat_bin_files, tmp_path / 'queue', 2, 1,
+                                           num_local_workers=3, poll_interval=0.01)
+    assert sorted(name for name, _ in started) == dat_bin_files
+    assert all(cluster.is_precursor_bin_done(maracluster_folder, x) for x in dat_bin_files)
+    assert (tmp_path / 'queue' / 'closed').is_file()
+
+
+def test_run_precursor_bins_distributed_failure(tmp_path, monkeypatch):
+    (tmp_path / '1.dat').write_bytes(b'x')
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', lambda *args: None)
+    with pytest.raises(RuntimeError, match='1.dat'):
+        cluster.run_precursor_bins_distributed(tmp_path, ['1.dat'], tmp_path / 'queue', 1, 1, poll_interval=0.01)
+
+
+def test_get_incremental_file_order(tmp_path):
+    assert cluster.get_incremental_file_order(tmp_path, [Path('/b.mzML'), Path('/a.mzML')]) == [Path('/b.mzML'), Path('/a.mzML')]
+
+    cluster.create_batch_file(tmp_path, [Path('/c.mzML'), Path('/a.mzML'), Path('/d.mzML')])
+    mzml_files = [Path('/a.mzML'), Path('/b.mzML'), Path('/c.mzML')]
+    assert cluster.get_incremental_file_order(tmp_path, mzml_files) == [Path('/c.mzML'), Path('/a.mzML'), Path('/b.mzML')]
+
+
+def test_remove_stale_dat_files(tmp_path):
+    dat_folder = tmp_path / 'dat_files'
+    dat_folder.mkdir()
+    mzml_files = [tmp_path / 'a.mzML', tmp_path / 'b.mzML']
+    for mzml_file in mzml_files:
+        mzml_file.write_text(f'spectra of {mzml_file.stem}')
+        (dat_folder / f'{mzml_file.stem}.dat').write_bytes(b'dat')
+    cluster.write_dat_file_fingerprints(mzml_files, dat_folder)
+
+    mzml_files[1].write_text('new spectra')
+    (dat_folder / 'c.dat').write_bytes(b'dat')
+    assert cluster.remove_stale_dat_files(mzml_files + [tmp_path / 'c.mzML'], dat_folder) == \
+           [dat_folder / 'b.dat', dat_folder / 'c.dat']
+    assert (dat_folder / 'a.dat').is_file()
+    assert not (dat_folder / 'b.dat').is_file()
+    assert not (dat_folder / 'c.dat').is_file()
+
+
+def test_precursor_bin_reused_if_dat_file_unchanged(tmp_path, monkeypatch):
+    (tmp_path / '1.dat').write_bytes(b'spectra')
+    (tmp_path / '2.dat').write_bytes(b'spectra')
+    started = []
+    monkeypatch.setattr(cluster, 'run_maracluster_pvalue_precursor_bin', fake_pvalue_precursor_bin(started))
+    cluster.run_precursor_bins(tmp_path, ['1.dat', '2.dat'], 1, 1)
+
+    # a new index adds spectra to bin 2 only
+    started.clear()
+    cluster.remove_marker_files(tmp_path, precursor_bins=False)
+    (tmp_path / '2.dat').write_bytes(b'spectra and new spectra')
+    cluster.run_precursor_bins(tmp_path, ['1.dat', '2.dat'], 1, 1)
+    assert started == [('2.dat', 1)]
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import pytest
 
 import simsi_transfer.merging_functions as mf
@@ -87,3 +88,95 @@ class TestMergeSummaryWithEvidence:
         assert merged_summary.loc[1, 'evidence_ID'] == 2
         assert pd.isna(merged_summary.loc[2, 'Intensity'])  # Check NaN value for non-matching row
 
+
+
+class TestPackedKeys:
+    @pytest.fixture
+    def raw_file_dictionary(self):
+        return mf.get_raw_file_dictionary(["file3", "file1", "file2", "file4", "file1"])
+
+    def test_get_raw_file_dictionary(self, raw_file_dictionary):
+        assert raw_file_dictionary.tolist() == ["file1", "file2", "file3", "file4"]
+
+    def test_add_scan_keys(self, raw_file_dictionary):
+        df = pd.DataFrame({"Raw file": ["file2", "file1"], "scanID": [7, 7]})
+        df = mf.add_scan_keys(df, raw_file_dictionary)
+        assert df[mf.SCAN_KEY].tolist() == [(1 << 32) | 7, 7]
+
+    def test_add_scan_keys_unknown_raw_file(self, raw_file_dictionary):
+        df = pd.DataFrame({"Raw file": ["file5"], "scanID": [7]})
+        with pytest.raises(ValueError):
+            mf.add_scan_keys(df, raw_file_dictionary)
+
+    def test_merge_with_msmstxt_scan_keys(self, raw_file_dictionary):
+        tempfile = pd.DataFrame({
+            "Raw file": ["file1", "file2", "file3"],
+            "scanID": [1, 2, 3],
+            "temp_col": ["a", "b", "c"],
+        })
+        msms_df = pd.DataFrame({
+            "Raw file": ["file1", "file2", "file4"],
+            "scanID": [1, 2, 4],
+            "msms_col": ["x", "y", "z"],
+        })
+        expected = mf.merge_with_msmstxt(tempfile, msms_df)
+
+        tempfile = mf.add_scan_keys(tempfile, raw_file_dictionary)
+        msms_df = mf.add_scan_keys(msms_df, raw_file_dictionary)
+        merged_df = mf.merge_with_msmstxt(tempfile, msms_df)
+
+        pd.testing.assert_frame_equal(merged_df.drop(columns=[mf.SCAN_KEY]), expected)
+
+    def test_merge_summary_with_evidence_precursor_keys(self, raw_file_dictionary):
+        summary = pd.DataFrame({'Modified sequence': ['AAA', 'BBB', 'CCC', 'AAA'],
+                                'Raw file': ['file1', 'file2', 'file3', 'file1'],
+                                'Charge': [2, 3, 2, 3]})
+        evidence = pd.DataFrame({'evidence_ID': [1, 2, 3],
+                                 'Modified sequence': ['AAA', 'BBB', 'DDD'],
+                                 'Raw file': ['file1', 'file2', 'file4'],
+                                 'Charge': [2, 3, 2],
+                                 'Intensity': [100, 200, 150],
+                                 'Leading proteins': ['protein1', 'protein2', 'protein3'],
+                                 'Type': ['type1', 'type2', 'type3'],
+                                 'Calibrated retention time': [10.5, 11.2, 9.8],
+                                 'Calibrated retention time start': [10.0, 11.0, 9.0],
+                                 'Calibrated retention time finish': [11.0, 12.0, 10.0],
+                                 'Retention time calibration': [0.1, 0.2, 0.3]})
+        modified_sequence_dictionary = mf.get_modified_sequence_dictionary(evidence)
+        summary = mf.add_precursor_keys(summary, raw_file_dictionary, modified_sequence_dictionary)
+        evidence = mf.add_precursor_keys(evidence, raw_file_dictionary, modified_sequence_dictionary)
+
+        merged_summary = mf.merge_summary_with_evidence(summary, evidence)
+
+        assert merged_summary['evidence_ID'].tolist()[:2] == [1, 2]
+        assert merged_summary['evidence_ID'].iloc[2:].isna().all()
+
+    def test_merge_summary_with_evidence_precursor_keys_unknown(self, raw_file_dictionary):
+        """
+        Rows of both sides with a modified sequence or raw file that is not in the dictionaries do not match each other
+        """
+        summary = pd.DataFrame({'Modified sequence': ['AAA', 'CCC', 'AAA'],
+                                'Raw file': ['file1', 'file1', 'file5'],
+                                'Charge': [2, 2, 2]})
+        evidence = pd.DataFrame({'evidence_ID': [1, 2, 3],
+                                 'Modified sequence': ['AAA', np.nan, 'AAA'],
+                                 'Raw file': ['file1', 'file1', 'file6'],
+                                 'Charge': [2, 2, 2],
+                                 'Intensity': [100, 200, 150],
+                                 'Leading proteins': ['protein1', 'protein2', 'protein3'],
+                                 'Type': ['type1', 'type2', 'type3'],
+                                 'Calibrated retention time': [10.5, 11.2, 9.8],
+                                 'Calibrated retention time start': [10.0, 11.0, 9.0],
+                                 'Calibrated retention time finish': [11.0, 12.0, 10.0],
+                                 'Retention time calibration': [0.1, 0.2, 0.3]})
+        expected = mf.merge_summary_with_evidence(summary, evidence)
+
+        modified_sequence_dictionary = mf.get_modified_sequence_dictionary(evidence)
+        summary = mf.add_precursor_keys(summary, raw_file_dictionary, modified_sequence_dictionary)
+        evidence = mf.add_precursor_keys(evidence, raw_file_dictionary, modified_sequence_dictionary)
+        merged_summary = mf.merge_summary_with_evidence(summary, evidence)
+
+        assert len(merged_summary.index) == len(expected.index) == 3
+        assert merged_summary['evidence_ID'].tolist()[0] == 1
+        assert merged_summary['evidence_ID'].iloc[1:].isna().all()
+        assert expected['evidence_ID'].iloc[1:].isna().all()
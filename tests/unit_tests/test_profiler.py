@@ -0,0 +1,89 @@
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from simsi_transfer.utils import profiler
+
+
+def drop_missing(df):
+    return df.dropna()
+
+
+def build_chunk(df):
+    return profiler.call('drop_missing', drop_missing, df)
+
+
+def test_profiler_nested_stages():
+    profiler.reset()
+    df = pd.DataFrame({'a': [1.0, np.nan, 3.0]})
+    with profiler.stage('p10'):
+        result = profiler.call('drop_missing', drop_missing, df)
+    assert len(result) == 2
+
+    profile = profiler.get_profile()
+    assert list(profile.keys()) == ['p10/drop_missing', 'p10']
+    assert profile['p10/drop_missing']['rows_in'] == 3
+    assert profile['p10/drop_missing']['rows_out'] == 2
+    assert profile['p10/drop_missing']['memory_in'] is None
+    assert profile['p10']['wall_time'] >= profile['p10/drop_missing']['wall_time']
+
+
+def test_profiler_sums_repeated_stages():
+    profiler.reset()
+    profiler.set_dataframe_memory(True)
+    try:
+        for n in [2, 3]:
+            profiler.call('drop_missing', drop_missing, pd.DataFrame({'a': range(n)}))
+    finally:
+        profiler.set_dataframe_memory(False)
+
+    record = profiler.get_profile()['drop_missing']
+    assert record['calls'] == 2
+    assert record['rows_in'] == 5
+    assert record['memory_in'] > 0
+
+
+def test_profiler_collects_worker_stages():
+    profiler.reset()
+    jobs = [(pd.DataFrame({'a': [1.0, np.nan]}),), (pd.DataFrame({'a': [1.0, 2.0]}),)]
+    with profiler.stage('evidence'):
+        outputs = [profiler.profiled(build_chunk)(*args) for args in jobs]
+        assert profiler.get_profile() == {}
+        results = profiler.collect(outputs)
+
+    assert [len(result) for result in results] == [1, 2]
+    profile = profiler.get_profile()
+    assert profile['evidence/drop_missing']['calls'] == 2
+    assert profile['evidence/drop_missing']['rows_out'] == 3
+
+
+def test_profiler_peak_rss_per_stage():
+    profiler.reset()
+    with profiler.stage('allocate'):
+        array = np.ones(100 * 1024 * 1024 // 8)
+        time.sleep(3 * profiler.RSS_SAMPLE_INTERVAL)
+        del array
+    with profiler.stage('after_allocate'):
+        time.sleep(3 * profiler.RSS_SAMPLE_INTERVAL)
+
+    profile = profiler.get_profile()
+    if profiler.get_current_rss() is None:
+        assert profile['allocate']['peak_rss'] is None
+        return
+    # a peak over the lifetime of the process would be the same for both stages
+    assert profile['allocate']['peak_rss'] - profile['after_allocate']['peak_rss'] > 50 * 1024 * 1024
+
+
+def test_write_profile(tmp_path):
+    profiler.reset()
+    with profiler.stage('conversion'):
+        pass
+    profile_file = tmp_path / 'SIMSI.profile.json'
+    profiler.write_profile(profile_file, statistics={'p10': {'scans': np.int64(5)}})
+
+    with open(profile_file) as f:
+        profile = json.load(f)
+    assert profile['statistics'] == {'p10': {'scans': 5}}
+    assert profile['stages']['conversion']['calls'] == 1
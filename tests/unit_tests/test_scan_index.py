@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import simsi_transfer.merging_functions as mf
+import simsi_transfer.scan_index as si
+import simsi_transfer.simsi_output as simsi_output
+
+
+def test_dense_scan_index_lookup():
+    scan_keys = np.array([(1 << 32) | 5, 3, (1 << 32) | 2])
+    index = si.DenseScanIndex.from_scan_keys(scan_keys)
+
+    lookup_keys = np.array([3, (1 << 32) | 2, (1 << 32) | 5, 4, 10, (2 << 32) | 1])
+    np.testing.assert_array_equal(index.lookup(lookup_keys), [1, 2, 0, -1, -1, -1])
+
+
+def test_dense_scan_index_to_memmap(tmp_path):
+    index = si.DenseScanIndex.from_scan_keys(np.array([3, 1]))
+    index.to_memmap(tmp_path / 'index.npy')
+
+    assert isinstance(index.values, np.memmap)
+    np.testing.assert_array_equal(index.lookup(np.array([1, 2, 3])), [1, -1, 0])
+
+
+class TestAnnotateClustersDense:
+    @pytest.fixture
+    def example_dataframes(self):
+        raw_file_dictionary = mf.get_raw_file_dictionary(['file1', 'file2'])
+        cluster_results = pd.DataFrame({
+            'Raw file': ['file1', 'file2', 'file1', 'file2'],
+            'scanID': [1, 2, 3, 4],
+            'clusterID': [1, 1, 2, 2],
+        })
+        msmsscans = pd.DataFrame({
+            'Raw file': ['file1', 'file1', 'file2', 'file2'],
+            'scanID': [1, 3, 2, 4],
+            'm/z': np.array([400.1, 400.2, 400.3, 400.4], dtype='float32'),
+            'MS scan number': np.array([0, 2, 1, 3], dtype='int32'),
+        })
+        msms = pd.DataFrame({
+            'Raw file': ['file1', 'file2'],
+            'scanID': [3, 2],
+            'Sequence': ['AAA', 'BBB'],
+            'Charge': np.array([2, 3], dtype='int8'),
+            'Reverse': pd.Categorical(['+', None]),
+        })
+        rawfile_metadata = pd.DataFrame({'Raw file': ['file1', 'file2'], 'Experiment': ['exp1', 'exp2'],
+                                         'Fraction': [1, 2]})
+        for df in [cluster_results, msmsscans, msms]:
+            mf.add_scan_keys(df, raw_file_dictionary)
+        annotation_index = si.build_annotation_index(msmsscans, msms, raw_file_dictionary)
+        return msmsscans, msms, rawfile_metadata, cluster_results, annotation_index
+
+    def test_annotate_clusters_dense(self, example_dataframes):
+        msmsscans, msms, rawfile_metadata, cluster_results, annotation_index = example_dataframes
+
+        summary_dense = simsi_output.annotate_clusters(msmsscans, msms, rawfile_metadata, cluster_results,
+                                                       annotation_index)
+        summary_merged = simsi_output.annotate_clusters(msmsscans, msms, rawfile_metadata, cluster_results)
+
+        pd.testing.assert_frame_equal(summary_dense, summary_merged)
+        assert pd.isna(summary_dense.loc[0, 'Sequence'])
+        assert summary_dense['Sequence'].tolist()[1:3] == ['BBB', 'AAA']
+
+    def test_build_annotation_index_duplicate_scans(self, example_dataframes):
+        msmsscans, msms, _, _, _ = example_dataframes
+        msms = pd.concat([msms, msms])
+        assert si.build_annotation_index(msmsscans, msms, pd.Index(['file1', 'file2'])) is None
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import pytest
+
+import simsi_transfer.utils.scheduler as scheduler
+from simsi_transfer.utils.scheduler import ScheduledJob, BackgroundStages, run_memory_aware, estimate_makespan
+
+
+class ConcurrencyTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.max_memory = 0
+        self.max_running = 0
+        self.started = []
+
+    def job(self, name, memory):
+        with self.lock:
+            self.started.append(name)
+            self.running[name] = memory
+            self.max_memory = max(self.max_memory, sum(self.running.values()))
+            self.max_running = max(self.max_running, len(self.running))
+        time.sleep(0.02)
+        with self.lock:
+            del self.running[name]
+        return name
+
+
+@pytest.fixture
+def unknown_available_memory(monkeypatch):
+    monkeypatch.setattr(scheduler, 'get_available_memory', lambda: None)
+
+
+def test_run_memory_aware_budget(unknown_available_memory):
+    tracker = ConcurrencyTracker()
+    memories = [1, 8, 2, 5, 1, 1, 3]
+    jobs = [ScheduledJob(tracker.job, (i, m), m, m) for i, m in enumerate(memories)]
+
+    results = run_memory_aware(jobs, max_workers=4, memory_budget=10, poll_interval=0.01)
+    assert results == list(range(len(memories)))
+    assert tracker.max_memory <= 10
+    assert tracker.started[0] == 1
+
+
+def test_run_memory_aware_small_jobs_in_parallel(unknown_available_memory):
+    tracker = ConcurrencyTracker()
+    jobs = [ScheduledJob(tracker.job, (i, 1), 1, 1) for i in range(8)]
+    run_memory_aware(jobs, max_workers=4, memory_budget=100, poll_interval=0.01)
+    assert tracker.max_running == 4
+
+
+def test_run_memory_aware_oversized_job(unknown_available_memory):
+    tracker = ConcurrencyTracker()
+    jobs = [ScheduledJob(tracker.job, (0, 50), 50, 50), ScheduledJob(tracker.job, (1, 5), 5, 5)]
+    assert run_memory_aware(jobs, max_workers=2, memory_budget=10, poll_interval=0.01) == [0, 1]
+    assert tracker.max_running == 1
+
+
+def test_run_memory_aware_available_memory(monkeypatch):
+    monkeypatch.setattr(scheduler, 'get_available_memory', lambda: 1)
+    tracker = ConcurrencyTracker()
+    jobs = [ScheduledJob(tracker.job, (i, 2), 2, 2) for i in range(3)]
+    run_memory_aware(jobs, max_workers=3, memory_budget=100, poll_interval=0.01)
+    assert tracker.max_running == 1
+
+
+def test_run_memory_aware_error(unknown_available_memory):
+    def fail():
+        raise ValueError('conversion failed')
+
+    with pytest.raises(ValueError, match='conversion failed'):
+        run_memory_aware([ScheduledJob(fail, (), 1, 1)], max_workers=2, memory_budget=10, poll_interval=0.01)
+
+
+def test_estimate_makespan():
+    def job(cost, duration):
+        return ScheduledJob(None, (), cost, duration)
+
+    # longest first: the long job starts right away, the short jobs fill the remaining threads
+    assert estimate_makespan([job(1, 1), job(1, 1), job(1, 1), job(1, 3)], max_workers=2, budget=2) == 3
+    assert estimate_makespan([job(2, 4), job(1, 1), job(1, 1)], max_workers=4, budget=2) == 5
+    assert estimate_makespan([job(4, 4), job(1, 1)], max_workers=4, budget=2) == 5
+
+
+def test_background_stages_overlap():
+    started = threading.Event()
+    release = threading.Event()
+
+    def stage():
+        started.set()
+        release.wait(timeout=5)
+        return 'clustered'
+
+    stages = BackgroundStages(num_threads=1)
+    stages.submit('clustering', stage)
+    assert started.wait(timeout=5)
+    # the main thread continues while the stage is running
+    release.set()
+    assert stages.wait('clustering') == 'clustered'
+    stages.close()
+
+
+def test_background_stages_synchronous():
+    calls = []
+    stages = BackgroundStages(num_threads=0)
+    stages.submit('clustering', calls.append, 'clustering')
+    assert calls == ['clustering']
+    stages.close()
+
+
+def test_background_stages_error():
+    def fail():
+        raise ValueError('clustering failed')
+
+    stages = BackgroundStages(num_threads=1)
+    stages.submit('clustering', fail)
+    with pytest.raises(ValueError, match='clustering failed'):
+        stages.close()
@@ -0,0 +1,74 @@
+import argparse
+from pathlib import Path
+
+import pytest
+
+from simsi_transfer import shards
+
+
+def get_run(tmp_path, stringencies=[20, 15]):
+    args = argparse.Namespace(output_folder=tmp_path, cache_folder=tmp_path / Path('cache'))
+    return shards.ShardRun(args=args, raw_files=[], correction_factor_paths=[], mzml_files=[], mq_txt_folders=[],
+                           stringencies=stringencies, shard_folder=tmp_path / Path('shards'))
+
+
+def test_select_shard_round_robin():
+    items = ['a', 'b', 'c', 'd', 'e']
+    assert shards.select_shard(items, 0, 2) == [(0, 'a'), (2, 'c'), (4, 'e')]
+    assert shards.select_shard(items, 1, 2) == [(1, 'b'), (3, 'd')]
+
+
+def test_select_shard_one_per_item():
+    items = ['a', 'b', 'c']
+    assert [shards.select_shard(items, i, 0) for i in range(3)] == [[(0, 'a')], [(1, 'b')], [(2, 'c')]]
+    assert shards.select_shard(items, 2, 10) == [(2, 'c')]
+
+
+def test_select_shard_out_of_range():
+    with pytest.raises(ValueError, match='out of range'):
+        shards.select_shard(['a', 'b'], 2, 0)
+
+
+def test_parse_args_splits_shard_arguments():
+    shard_args, args = shards.parse_args(['evidence', '--shard_index', '3', '--num_shards', '4',
+                                          '--mq_txt_folder', 'txt', '--raw_folder', 'raw',
+                                          '--output_folder', 'out', '--stringencies', '20'])
+    assert shard_args.command == 'evidence'
+    assert shard_args.shard_index == 3
+    assert shard_args.num_shards == 4
+    assert args.output_folder == Path('out')
+    assert args.stringencies == '20'
+
+
+def test_manifests(tmp_path):
+    run = get_run(tmp_path)
+    assert run.pvals == ['p20', 'p15']
+
+    shards.write_manifest(run, 'transfer', 1, [tmp_path / 'in.tsv'], [tmp_path / 'out.txt'], pvals=['p15'])
+    shards.write_manifest(run, 'transfer', 0, [], [], pvals=['p20'])
+    manifests = shards.read_manifests(run, 'transfer')
+    assert [manifest['shard_index'] for manifest in manifests] == [0, 1]
+    assert manifests[1]['inputs'] == [str(tmp_path / 'in.tsv')]
+    assert manifests[1]['pvals'] == ['p15']
+
+
+def test_check_inputs(tmp_path):
+    existing = tmp_path / 'a.mzML'
+    existing.write_text('')
+    shards.check_inputs([existing], 'cluster', 'convert')
+    with pytest.raises(FileNotFoundError, match='run the convert shards first'):
+        shards.check_inputs([existing, tmp_path / 'b.mzML'], 'cluster', 'convert')
+
+
+def test_merge_requires_all_transfer_shards(tmp_path):
+    run = get_run(tmp_path)
+    shards.write_manifest(run, 'transfer', 0, [], [], pvals=['p20'])
+    with pytest.raises(FileNotFoundError, match='p15'):
+        shards.run_merge(run, 0, 0)
+
+
+def test_get_evidence_chunks_requires_all_chunks(tmp_path):
+    run = get_run(tmp_path)
+    manifests = [{'chunks': {'p20': {'num_chunks': 3, 'chunk_indices': [0, 2]}}}]
+    with pytest.raises(FileNotFoundError, match='p20'):
+        shards.get_evidence_chunks(run, 'p20', manifests)
@@ -0,0 +1,72 @@
+import pytest
+
+import pandas as pd
+
+import simsi_transfer.simsi_output as simsi_output
+
+
+def _example_df():
+    return pd.DataFrame({'Raw file': ['b', 'a', 'a'], 'scanID': [1, 2, 1], 'scan_key': [4294967297, 2, 1]})
+
+
+@pytest.mark.parametrize('num_writers', [0, 2])
+def test_export_queue(tmp_path, num_writers):
+    export_queue = simsi_output.ExportQueue(num_writers, max_pending=1)
+    df = _example_df()
+    export_queue.submit(simsi_output.export_msmsscans, df, tmp_path, 'p10')
+    export_queue.submit(simsi_output.export_annotated_clusters, df, tmp_path, 'p10', 'both')
+    df['new_column'] = 1
+    export_queue.close()
+
+    assert sorted(p.name for p in export_queue.written_files) == [
+        'p10_annotated_clusters.parquet', 'p10_annotated_clusters.txt', 'p10_msmsScans.txt']
+    result = pd.read_csv(tmp_path / 'summaries' / 'p10' / 'p10_msmsScans.txt', sep='\t')
+    assert result.columns.tolist() == ['Raw file', 'scanID']
+    assert result['Raw file'].tolist() == ['a', 'a', 'b']
+    assert result['scanID'].tolist() == [1, 2, 1]
+
+
+def test_export_queue_raises_writer_errors(tmp_path):
+    def failing_export(df, mainpath, pval):
+        raise ValueError('disk full')
+
+    export_queue = simsi_output.ExportQueue(1)
+    export_queue.submit(failing_export, _example_df(), tmp_path, 'p10')
+    with pytest.raises(ValueError, match='disk full'):
+        export_queue.close()
+
+
+def test_check_output_files_empty_file(tmp_path):
+    (tmp_path / 'empty.txt').touch()
+    with pytest.raises(RuntimeError):
+        simsi_output.check_output_files([tmp_path / 'empty.txt'])
+
+
+def test_read_output_columns(tmp_path):
+    (tmp_path / 'columns.yaml').write_text('msmsScans: [Raw file, scanID]\nevidence:\n  - Sequence\n')
+    (tmp_path / 'columns.json').write_text('{"msmsScans": ["Raw file", "scanID"], "evidence": ["Sequence"]}')
+
+    expected = {'msmsScans': ['Raw file', 'scanID'], 'evidence': ['Sequence']}
+    assert simsi_output.read_output_columns(tmp_path / 'columns.yaml') == expected
+    assert simsi_output.read_output_columns(tmp_path / 'columns.json') == expected
+
+
+def test_read_output_columns_unknown_table(tmp_path):
+    (tmp_path / 'columns.json').write_text('{"peptides": ["Sequence"]}')
+    with pytest.raises(ValueError, match='Unknown output table'):
+        simsi_output.read_output_columns(tmp_path / 'columns.json')
+
+
+def test_export_csv_output_columns(tmp_path):
+    simsi_output.export_csv(_example_df(), 'msmsScans', tmp_path, 'p10', output_columns=['scanID', 'Raw file', 'Score'])
+    result = pd.read_csv(tmp_path / 'summaries' / 'p10' / 'p10_msmsScans.txt', sep='\t')
+    assert result.columns.tolist() == ['scanID', 'Raw file']
+
+
+def test_drop_unused_columns():
+    df = _example_df()
+    required_columns = simsi_output.get_required_columns(['Raw file'], ['Raw file', 'Score'])
+    assert simsi_output.drop_unused_columns(df, required_columns).columns.tolist() == ['Raw file', 'scan_key']
+
+    required_columns = simsi_output.get_required_columns(['Raw file'], None)
+    assert simsi_output.drop_unused_columns(df, required_columns).columns.tolist() == df.columns.tolist()
@@ -0,0 +1,114 @@
+import io
+
+import pandas as pd
+import numpy as np
+
+import simsi_transfer.utils.table_writer as table_writer
+
+
+def _pandas_tsv(df, sort_columns=None):
+    if sort_columns:
+        df = df.sort_values(by=sort_columns)
+    return df.to_csv(sep='\t', index=False, na_rep='NaN', lineterminator='\n')
+
+
+def _table_writer_tsv(df, sort_columns=None, chunk_size=table_writer.CHUNK_SIZE):
+    sink = io.BytesIO()
+    table_writer.write_tsv(df, sink, sort_columns=sort_columns, chunk_size=chunk_size)
+    return sink.getvalue().decode('utf-8')
+
+
+def _example_df():
+    return pd.DataFrame({
+        'Raw file': pd.Categorical(['b', 'a', 'b', 'a', np.nan]),
+        'scanID': [5, 3, 1, 2, 4],
+        'Sequence': ['PEPTIDE', np.nan, 'AAA', 'AAA', 'KK'],
+        'Score': [1.0, np.nan, 123.456, 1e-7, 3e16],
+        'Intensity': np.array([0.0, 2.5, -1.0, np.nan, 1e-4], dtype='float32'),
+        'Charge': pd.array([2, None, 3, 2, 4], dtype='Int64'),
+        'Reverse': [True, False, False, True, False],
+        'Mixed': [1, 'a', np.nan, 2.5, 'b'],
+    })
+
+
+def test_write_tsv_matches_pandas():
+    df = _example_df()
+    assert _table_writer_tsv(df) == _pandas_tsv(df)
+
+
+def test_write_tsv_large_floats_match_pandas():
+    # MaxQuant intensities are often above 1e10, where pyarrow switches to scientific notation but pandas does not
+    values = [9999999999.5, 1e10, 1.5e10, 125730221093.3933, 3.2e12, 999999999999999.9, 1e15, -2.5e11, 1e16]
+    df = pd.DataFrame({'Intensity': np.array(values, dtype='float64'),
+                       'Intensity 32': np.array(values, dtype='float32')})
+    assert _table_writer_tsv(df) == _pandas_tsv(df)
+
+
+def test_write_tsv_sorted_matches_pandas():
+    df = _example_df()
+    assert _table_writer_tsv(df, ['Sequence', 'scanID']) == _pandas_tsv(df, ['Sequence', 'scanID'])
+    assert _table_writer_tsv(df, ['Raw file', 'scanID'], chunk_size=2) == _pandas_tsv(df, ['Raw file', 'scanID'])
+
+
+def test_write_tsv_quotes_special_characters():
+    df = pd.DataFrame({'Proteins': ['P1;P2', 'P"3', 'P\t4'], 'Score': [1.0, 2.0, 3.0]})
+    assert _table_writer_tsv(df, chunk_size=1) == _pandas_tsv(df)
+
+
+def test_write_tsv_empty():
+    df = pd.DataFrame({'Raw file': pd.Series([], dtype=object), 'scanID': pd.Series([], dtype='int64')})
+    assert _table_writer_tsv(df, ['Raw file']) == _pandas_tsv(df)
+
+
+def test_write_parquet_sorted_and_typed():
+    import pyarrow.parquet as pq
+
+    df = _example_df()
+    sink = io.BytesIO()
+    table_writer.write_parquet(df, sink, sort_columns=['Sequence', 'scanID'], row_group_size=2)
+
+    parquet_file = pq.ParquetFile(io.BytesIO(sink.getvalue()))
+    assert parquet_file.metadata.num_row_groups == 3
+    assert parquet_file.metadata.row_group(0).sorting_columns[0].column_index == 2
+
+    result = parquet_file.read().to_pandas()
+    expected = df.sort_values(by=['Sequence', 'scanID']).reset_index(drop=True)
+    assert result['scanID'].tolist() == expected['scanID'].tolist()
+    assert result['Score'].dtype == np.float64
+    assert isinstance(result['Raw file'].dtype, pd.CategoricalDtype)
+    assert result['Mixed'].tolist() == [None, '2.5', 'b', '1', 'a']
+
+
+def test_merge_sorted_chunks_matches_stable_sort(tmp_path):
+    rng = np.random.default_rng(42)
+    sort_columns = ['Sequence', 'Modified sequence']
+
+    chunks = []
+    for i in range(4):
+        n = int(rng.integers(0, 40))
+        chunk = pd.DataFrame({
+            'Sequence': rng.choice(['AAA', 'KK', 'PEPTIDE', np.nan], size=n),
+            'Modified sequence': rng.choice(['_A_', '_B_', np.nan], size=n),
+            'id': np.arange(n),
+        })
+        chunks.append(chunk.sort_values(by=sort_columns, kind='stable'))
+
+    chunk_files = []
+    for i, chunk in enumerate(chunks):
+        chunk_files.append(tmp_path / f'chunk_{i}.pkl')
+        table_writer.write_sorted_chunk(chunk, chunk_files[-1], batch_size=3)
+    offsets = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]]).tolist()
+    sorted_chunks = table_writer.SortedChunks(chunk_files, chunks[0].iloc[:0], 'id', offsets)
+
+    result = pd.concat(table_writer.merge_sorted_chunks(sorted_chunks, sort_columns), ignore_index=True)
+
+    for chunk, offset in zip(chunks, offsets):
+        chunk['id'] += offset
+    expected = pd.concat(chunks, ignore_index=True).sort_values(by=sort_columns, kind='stable')
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
+
+
+def test_write_tsv_batches_matches_write_tsv(tmp_path):
+    df = _example_df()
+    table_writer.write_tsv_batches([df.iloc[:2], df.iloc[2:]], tmp_path / 'batches.txt', df.columns.tolist())
+    assert (tmp_path / 'batches.txt').read_text() == _pandas_tsv(df)
@@ -0,0 +1,85 @@
+import re
+from pathlib import Path
+
+import pytest
+
+import simsi_transfer.thermo_raw as raw
+
+
+class FakeConverter:
+    """Mimics ThermoRawFileParser's directory mode"""
+
+    def __init__(self, fail_on=None):
+        self.commands = []
+        self.fail_on = fail_on
+
+    def run(self, command):
+        self.commands.append(command)
+        input_folder, output_folder = re.search(r'-d "(.*)" -o "(.*)"', command).groups()
+        input_folder, output_folder = Path(input_folder), Path(output_folder)
+        for raw_file in input_folder.iterdir():
+            if raw_file.stem != self.fail_on:
+                (output_folder / f'{raw_file.stem}.mzML').write_bytes(b'mzML of ' + raw_file.read_bytes())
+
+
+def make_raw_files(folder, sizes):
+    raw_files = []
+    for i, size in enumerate(sizes):
+        raw_file = folder / f'run{i}.raw'
+        raw_file.write_bytes(b'x' * size)
+        raw_files.append(raw_file)
+    return raw_files
+
+
+def test_convert_raw_mzml_batch_directory(tmp_path, monkeypatch):
+    converter = FakeConverter()
+    monkeypatch.setattr(raw.subprocess, 'run', converter.run)
+    raw_files = make_raw_files(tmp_path, [1, 2, 3, 4])
+    mzml_folder = tmp_path / 'mzML'
+
+    mzml_files = raw.convert_raw_mzml_batch(raw_files, mzml_folder, num_threads=1, batch_conversion=True)
+    assert len(converter.commands) == 1
+    assert mzml_files == [mzml_folder / f'run{i}.mzML' for i in range(4)]
+    assert [f.read_bytes() for f in mzml_files] == [b'mzML of ' + b'x' * (i + 1) for i in range(4)]
+    assert sorted(p.name for p in mzml_folder.iterdir()) == [f'run{i}.mzML' for i in range(4)]
+
+    # converted files are not converted again
+    raw.convert_raw_mzml_batch(raw_files, mzml_folder, num_threads=1, batch_conversion=True)
+    assert len(converter.commands) == 1
+
+
+def test_convert_raw_mzml_batch_on_converted(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw.subprocess, 'run', FakeConverter().run)
+    raw_files = make_raw_files(tmp_path, [1, 2, 3])
+    mzml_file = tmp_path / 'run3.mzML'
+    mzml_file.write_bytes(b'mzML')
+    converted = []
+
+    mzml_files = raw.convert_raw_mzml_batch(raw_files + [mzml_file], tmp_path / 'mzML', num_threads=1,
+                                            batch_conversion=True, on_converted=converted.append)
+    assert converted[0] == [mzml_file]
+    assert sorted(f for files in converted for f in files) == sorted(mzml_files)
+
+
+def test_convert_raw_mzml_directory_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw.subprocess, 'run', FakeConverter(fail_on='run1').run)
+    raw_files = make_raw_files(tmp_path, [1, 2])
+    mzml_folder = tmp_path / 'mzML'
+    mzml_folder.mkdir()
+    output_paths = [mzml_folder / f'run{i}.mzML' for i in range(2)]
+
+    with pytest.raises(RuntimeError, match='run1.mzML'):
+        raw.convert_raw_mzml_directory(raw_files, output_paths)
+    assert list(mzml_folder.iterdir()) == []
+
+
+def test_split_conversion_groups(tmp_path):
+    raw_files = make_raw_files(tmp_path, [10, 1, 4, 5, 3, 7])
+    (tmp_path / 'other').mkdir()
+    duplicate_file = tmp_path / 'other' / 'run0.raw'
+    duplicate_file.write_bytes(b'x')
+
+    groups = raw.split_conversion_groups(raw_files + [duplicate_file], 2)
+    assert [sum(f.stat().st_size for f in group) for group in groups] == [15, 16]
+    assert all(len({f.name for f in group}) == len(group) for group in groups)
+    assert sorted(f for group in groups for f in group) == sorted(raw_files + [duplicate_file])
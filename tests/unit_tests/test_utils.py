@@ -51,4 +51,40 @@ def test_process_and_concat(summary_df):
         return df
 
     merged_df = utils.process_and_concat(mq_txt_folders, read_txt)
-    assert len(merged_df.index) == 7 * 3
\ No newline at end of file
+    assert len(merged_df.index) == 7 * 3
+
+def test_unify_categories():
+    df1 = pd.DataFrame({'Raw file': pd.Categorical(['b', 'a']), 'Charge': [2, 3]})
+    df2 = pd.DataFrame({'Raw file': pd.Categorical(['c', 'a', np.nan])})
+
+    df1, df2 = utils.unify_categories([df1, df2])
+
+    assert df1['Raw file'].dtype == df2['Raw file'].dtype
+    assert df1['Raw file'].cat.categories.tolist() == ['a', 'b', 'c']
+    assert pd.concat([df1, df2])['Raw file'].dtype == df1['Raw file'].dtype
+    assert df1['Raw file'].tolist() == ['b', 'a']
+
+
+def test_add_categories():
+    x = pd.Series(pd.Categorical(['b', 'c', np.nan]))
+    x = utils.add_categories(x, pd.Series(['a', np.nan, 'c']))
+    assert x.cat.categories.tolist() == ['a', 'b', 'c']
+    assert x.tolist()[:2] == ['b', 'c']
+
+
+def test_csv_list_unique_grouped():
+    values = pd.Series(['BCD;ABC', 'ABC', 'BCD;ABC', np.nan, 'XYZ', np.nan])
+    groups = pd.Series([1, 1, 2, 2, 3, 4])
+    result = utils.csv_list_unique_grouped(values, groups)
+
+    assert result.index.tolist() == [1, 2, 3, 4]
+    assert result.tolist()[:3] == ['ABC;BCD', 'BCD;ABC', 'XYZ']
+    assert pd.isna(result[4])
+
+
+def test_csv_unique_grouped():
+    values = pd.Series(['BCD;ABC', 'ABC;', 'nan', '101', '99'])
+    groups = pd.Series([1, 1, 2, 3, 3])
+    result = utils.csv_unique_grouped(values, groups)
+
+    assert result.tolist() == ['ABC;BCD', 'nan', '101;99']
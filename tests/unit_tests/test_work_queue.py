@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+from simsi_transfer.utils.work_queue import WorkQueue, run_worker, PENDING, CLAIMED, DONE
+
+
+def test_claim_each_task_once(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue')
+    queue.create()
+    for i in range(50):
+        queue.put(f'{i:03d}', {'i': i})
+
+    claimed = []
+    def claim_all():
+        while (task := queue.claim()) is not None:
+            claimed.append(task[1]['i'])
+
+    threads = [threading.Thread(target=claim_all) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(50))
+    assert queue.count(CLAIMED) == 50
+
+
+def test_requeue_stale(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue')
+    queue.create()
+    queue.put('a', {})
+    queue.put('b', {})
+    name, _, token = queue.claim()
+    assert name == 'a'
+    assert queue.claim()[0] == 'b'
+
+    os.utime(queue.get_claimed_file('a', token), (time.time() - 100, time.time() - 100))
+    assert queue.requeue_stale(timeout=50) == ['a']
+    assert queue.count(PENDING) == 1
+
+    # the original worker finishing late does not fail
+    queue.complete('a', token)
+    assert queue.count(DONE) == 0
+    _, _, new_token = queue.claim()
+    queue.complete('a', new_token)
+    assert queue.count(DONE) == 1
+
+
+def test_requeued_task_not_completed_by_previous_worker(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue')
+    queue.create()
+    queue.put('a.dat', {})
+    _, _, token = queue.claim()
+    os.utime(queue.get_claimed_file('a.dat', token), (time.time() - 100, time.time() - 100))
+    assert queue.requeue_stale(timeout=50) == ['a.dat']
+    _, _, new_token = queue.claim()
+
+    # the previous worker finishes or fails while the new worker still holds the task
+    queue.heartbeat('a.dat', token)
+    queue.complete('a.dat', token)
+    queue.fail('a.dat', token, 'too late')
+    assert queue.count(CLAIMED) == 1 and queue.count(DONE) == 0
+    assert queue.get_failed_tasks() == []
+
+    queue.fail('a.dat', new_token, 'bin failed')
+    assert queue.get_failed_tasks() == [('a.dat', 'bin failed')]
+
+
+def test_run_worker(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue')
+    queue.create()
+    for i in range(3):
+        queue.put(f'{i}', {'i': i})
+
+    def handler(task):
+        if task['i'] == 1:
+            raise ValueError('bin failed')
+
+    run_worker(queue, handler, poll_interval=0.01, exit_when_empty=True)
+    assert queue.count(DONE) == 2
+    failed_tasks = queue.get_failed_tasks()
+    assert [name for name, _ in failed_tasks] == ['1']
+    assert 'bin failed' in failed_tasks[0][1]